@@ -0,0 +1,84 @@
+''' Per-call overhead of the Python -> libwebsurface.so boundary, for the calls made every frame or every event.
+
+    python benchmarks/binding_overhead.py
+
+core.py finds libwebsurface.so (next to itself, or $WEBSURFACE_LIBRARY); the working directory is where Ultralight
+looks for resources/, so run it from the repo root. It times the untyped ctypes calls with fresh c_int wrappers that
+websurface.py used to make, the typed ctypes calls, and the cffi binding if _websurface_cffi has been built
+(python build_binding.py). The untyped rows go through a second handle of the library that has no argtypes declared,
+as core.lib had none before. Numbers are nanoseconds per call. '''
+import os
+import sys
+import timeit
+from ctypes import CDLL, byref, c_bool, c_char_p, c_int
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import core
+
+
+N = 200000
+
+
+def per_call(stmt, number=N):
+    ''' Best of 5 runs, in nanoseconds per call '''
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number * 1e9
+
+
+def old_kivy_to_ultralight_vk(keycode):
+    ''' The previous implementation, which built its mapping dict on every call '''
+    if 32 <= keycode <= 126:
+        return keycode
+    mapping = dict(core._vk_mapping)
+    if 282 <= keycode <= 293:
+        return 0x70 + (keycode - 282)
+    return mapping.get(keycode, 0)
+
+
+def main():
+    surface = core.lib.initWebSurface(64, 64, b"<p>bench</p>")
+    untyped = CDLL(core.LIBRARY_PATH) # the same loaded library, through a handle of its own with nothing declared
+    results = {}
+
+    # Keycode translation, no native call involved
+    results["keycode: dict per call"] = per_call(lambda: old_kivy_to_ultralight_vk(276))
+    results["keycode: lookup table"] = per_call(lambda: core.kivy_to_ultralight_vk(276))
+
+    # isFocused: one int in, one bool out
+    untyped_is_focused, typed_is_focused = untyped.isFocused, core.lib.isFocused
+    results["isFocused: ctypes, c_int wrapped"] = per_call(lambda: untyped_is_focused(c_int(surface)))
+    results["isFocused: ctypes, typed"] = per_call(lambda: typed_is_focused(surface))
+
+    # stageSurfacePixels: four out parameters
+    ctypes_binding = core.CtypesBinding()
+    results["stage: ctypes, fresh out params"] = per_call(
+        lambda: untyped.stageSurfacePixels(c_int(surface), c_bool(False), byref(c_int()), byref(c_int()), byref(c_int()),
+                                           byref(c_int())))
+    results["stage: ctypes binding"] = per_call(lambda: ctypes_binding.stage_surface_pixels(surface, False))
+
+    # Input: one mouse move per call vs one batched call
+    results["mouse move: dispatchMouseEvent"] = per_call(
+        lambda: untyped.dispatchMouseEvent(c_int(surface), c_int(10), c_int(10), c_int(0), c_char_p(b"move")))
+    events = ctypes_binding.new_input_events(1)
+    events[0].surface_id, events[0].type = surface, core.INPUT_MOUSE_MOVE
+    results["mouse move: dispatchInputEvents, ctypes"] = per_call(
+        lambda: ctypes_binding.dispatch_input_events(events, 1))
+
+    if isinstance(core.binding, core.CffiBinding):
+        cffi_binding = core.binding
+        results["isFocused: cffi"] = per_call(lambda: cffi_binding.is_focused(surface))
+        results["stage: cffi binding"] = per_call(lambda: cffi_binding.stage_surface_pixels(surface, False))
+        cffi_events = cffi_binding.new_input_events(1)
+        cffi_events[0].surface_id, cffi_events[0].type = surface, core.INPUT_MOUSE_MOVE
+        results["mouse move: dispatchInputEvents, cffi"] = per_call(
+            lambda: cffi_binding.dispatch_input_events(cffi_events, 1))
+    else:
+        print("_websurface_cffi is not built, skipping the cffi rows")
+
+    core.lib.destroySurface(surface)
+    width = max(map(len, results))
+    for name, ns in results.items():
+        print(f"{name:<{width}}  {ns:8.1f} ns")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+''' Pages for the benchmarks: test.html from the repo root plus generated heavy pages. Each generator returns an HTML string. '''
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_page():
+    with open(os.path.join(ROOT, "test.html"), encoding="utf8") as f:
+        return f.read()
+
+
+def large_table(rows=2000, cols=8):
+    cells = "".join(f"<td>r{{r}}c{c}</td>" for c in range(cols))
+    body = "".join(f"<tr>{cells.format(r=r)}</tr>" for r in range(rows))
+    return f'''<!doctype html><html><head><style>
+table {{ border-collapse: collapse; font: 12px sans-serif; }}
+td {{ border: 1px solid #999; padding: 2px 6px; }}
+tr:nth-child(odd) {{ background: #eef; }}
+</style></head><body><table>{body}</table></body></html>'''
+
+
+def css_animations(count=200):
+    ''' `count` boxes that animate continuously, so every frame repaints most of the surface '''
+    boxes = "".join(f'<div class="box" style="animation-delay:-{i * 37 % 1000}ms"></div>' for i in range(count))
+    return f'''<!doctype html><html><head><style>
+body {{ margin: 0; display: flex; flex-wrap: wrap; }}
+.box {{ width: 40px; height: 40px; margin: 2px; background: #2196f3; border-radius: 6px;
+        animation: spin 1s linear infinite; }}
+@keyframes spin {{ from {{ transform: rotate(0deg); background: #2196f3; }} to {{ transform: rotate(360deg); background: #c319d2; }} }}
+</style></head><body>{boxes}</body></html>'''
+
+
+def long_text(paragraphs=500):
+    sentence = "The quick brown fox jumps over the lazy dog while the renderer lays out yet another line of text. "
+    body = "".join(f"<p>{i}. {sentence * 6}</p>" for i in range(paragraphs))
+    return f'''<!doctype html><html><head><style>
+body {{ font: 15px/1.5 Georgia, serif; margin: 20px; }}
+</style></head><body>{body}</body></html>'''
+
+
+# Input latency pages: the whole surface flips color on the event, so any staged pixel shows whether it has been handled
+CLICK_PAGE = '''<!doctype html><html><head><style>
+html, body { margin: 0; height: 100%; background: rgb(0, 0, 0); }
+</style></head><body onmousedown="document.body.style.background = document.body.style.background == 'rgb(255, 255, 255)' ? 'rgb(0, 0, 0)' : 'rgb(255, 255, 255)'">
+</body></html>'''
+
+KEY_PAGE = '''<!doctype html><html><head><style>
+html, body { margin: 0; height: 100%; background: rgb(0, 0, 0); }
+input { position: absolute; left: 0; top: 0; width: 10px; height: 10px; opacity: 0; }
+</style></head><body>
+<input id="target" autofocus>
+<script>
+var target = document.getElementById("target");
+target.focus();
+target.addEventListener("keydown", function () {
+    document.body.style.background = document.body.style.background == "rgb(255, 255, 255)" ? "rgb(0, 0, 0)" : "rgb(255, 255, 255)";
+});
+</script></body></html>'''
+
+
+PAGES = {
+    "test_html": test_page,
+    "large_table": large_table,
+    "css_animations": css_animations,
+    "long_text": long_text,
+}
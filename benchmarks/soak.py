@@ -0,0 +1,307 @@
+''' Soak / leak harness. Keeps creating and destroying surfaces, loading local files, resizing and firing input storms
+for a given duration while sampling RSS, open file descriptors, threads and the library's own memory, then fits a line
+through each series and fails when one grows faster than its threshold.
+
+    python benchmarks/soak.py --duration 600                    # native surfaces, no window at all
+    python benchmarks/soak.py --duration 600 --kivy             # real WebSurface widgets (needs a display or Xvfb)
+    python benchmarks/soak.py --report soak_1.4.json            # keep the time series to compare releases
+
+Run it from the repo root. Exit status 1 when a slope threshold is exceeded or a page load doesn't finish. '''
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import *
+import memory
+import pages
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MIB = 1 << 20
+
+# Default growth limits per minute, after the warm-up
+THRESHOLDS = {
+    "rss_bytes": 1 * MIB,
+    "fds": 1.0,
+    "threads": 1.0,
+    "views": 0.1,
+    "staging_bytes": 64 * 1024,
+    "textures": 1.0,
+}
+
+
+def count_entries(path):
+    try:
+        return len(os.listdir(path))
+    except OSError:
+        return None
+
+
+def sample(start, cycle, texture_type=None):
+    ''' One point of the time series '''
+    native = memory.memory_report()
+    point = {
+        "t": time.monotonic() - start,
+        "cycle": cycle,
+        "rss_bytes": native["rss_bytes"],
+        "fds": count_entries("/proc/self/fd"),
+        "threads": count_entries("/proc/self/task"), # native threads included
+        "views": native["views"],
+        "pooled_views": native["pooled_views"],
+        "staging_bytes": native["staging_bytes"],
+    }
+    if texture_type is not None:
+        point["textures"] = sum(1 for o in gc.get_objects() if isinstance(o, texture_type))
+    return point
+
+
+def slope_per_minute(samples, key):
+    ''' Least-squares slope of samples[key] over time, per minute, or None with too few points '''
+    points = [(s["t"], s[key]) for s in samples if s.get(key) is not None]
+    if len(points) < 3:
+        return None
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    var = sum((t - mean_t) ** 2 for t, _ in points)
+    if var == 0:
+        return None
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / var * 60
+
+
+def write_pages(directory):
+    ''' The benchmark pages as local files, for load_url. file:/// URLs are relative to Ultralight's file_system_dir,
+    the working directory by default, so `directory` has to be below it. '''
+    urls = []
+    for name, make in pages.PAGES.items():
+        path = os.path.join(directory, f"{name}.html")
+        with open(path, "w", encoding="utf8") as f:
+            f.write(make())
+        urls.append("file:///" + os.path.relpath(path).replace(os.sep, "/"))
+    return urls
+
+
+def input_storm(surface_id, width, height, count, rng):
+    ''' `count` random mouse, scroll, key and text events for one surface, in a single native call '''
+    events = binding.new_input_events(count)
+    for ev in events:
+        ev.surface_id = surface_id
+        ev.type = rng.choice((INPUT_MOUSE_MOVE, INPUT_MOUSE_MOVE, INPUT_MOUSE_DOWN, INPUT_MOUSE_UP, INPUT_SCROLL,
+                              INPUT_KEY_DOWN, INPUT_KEY_UP, INPUT_CHAR))
+        ev.x, ev.y = rng.randrange(width), rng.randrange(height)
+        ev.button = rng.randrange(4)
+        ev.keycode = kivy_to_ultralight_vk(rng.randrange(32, 127))
+        ev.text = bytes([rng.randrange(97, 123)])
+    binding.dispatch_input_events(events, count)
+
+
+class NativeSoak:
+    ''' One cycle: create surfaces, load a local file in each, render, resize, storm, render, destroy '''
+
+    def __init__(self, args, urls, rng, load_failures):
+        self.args, self.urls, self.rng = args, urls, rng
+        self.load_failures = load_failures # "url: reason" of every load that failed or didn't finish in time
+
+    def cycle(self):
+        args, rng = self.args, self.rng
+        surfaces = []
+        for _ in range(args.surfaces):
+            w, h = rng.randrange(200, 1200), rng.randrange(150, 900)
+            surfaces.append([lib.initWebSurface(w, h, b"<p>soak</p>"), w, h])
+        urls = {}
+        for s in surfaces:
+            urls[s[0]] = rng.choice(self.urls)
+            lib.loadURL(s[0], urls[s[0]].encode("utf8"))
+        self.wait_loaded(urls)
+        self.frames(surfaces, args.frames)
+        for s in surfaces:
+            s[1], s[2] = rng.randrange(200, 1200), rng.randrange(150, 900)
+            lib.resizeSurface(s[0], s[1], s[2])
+            for slot in range(lib.getStagingSlotCount(s[0])): # what a widget does after a resize
+                wrap_staging_buffer(s[0], slot)
+            input_storm(s[0], s[1], s[2], args.storm, rng)
+        self.frames(surfaces, args.frames)
+        for s in surfaces:
+            lib.destroySurface(s[0])
+
+    def wait_loaded(self, urls):
+        ''' Renders until the load just requested on each surface ({surface id: url}) has finished or failed '''
+        pending, requested = set(urls), set() # events before a surface's LOAD_REQUESTED marker are stale
+        deadline = time.monotonic() + self.args.load_timeout
+        while pending and time.monotonic() < deadline:
+            binding.render()
+            for surface_id, type, url, error_code, description in poll_load_events():
+                if surface_id not in pending:
+                    continue
+                if type == LOAD_REQUESTED:
+                    requested.add(surface_id)
+                elif surface_id in requested and type in (LOAD_FINISH, LOAD_FAIL):
+                    pending.discard(surface_id)
+                    if type == LOAD_FAIL:
+                        self.load_failures.append(f"{urls[surface_id]}: {description} ({error_code})")
+            time.sleep(0.002)
+        self.load_failures += [f"{urls[surface_id]}: not loaded after {self.args.load_timeout}s" for surface_id in pending]
+
+    def frames(self, surfaces, count):
+        for _ in range(count):
+            binding.render()
+            for s in surfaces:
+                binding.stage_surface_pixels(s[0], False)
+
+
+def run_native(args, urls, rng, load_failures):
+    soak = NativeSoak(args, urls, rng, load_failures)
+    start = time.monotonic()
+    samples, cycle, next_sample = [], 0, 0.0
+    while True:
+        now = time.monotonic() - start
+        if now >= next_sample:
+            samples.append(sample(start, cycle))
+            next_sample += args.interval
+        if now >= args.duration:
+            break
+        soak.cycle()
+        cycle += 1
+    return samples
+
+
+def run_kivy(args, urls, rng, load_failures):
+    ''' The same cycle with WebSurface widgets in a hidden Kivy window, driven by the Clock '''
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+    from kivy.config import Config
+    Config.set("graphics", "window_state", "hidden")
+    from kivy.app import App
+    from kivy.clock import Clock
+    from kivy.core.window import Window
+    from kivy.graphics.texture import Texture
+    from websurface import WebSurface
+
+    samples = []
+    state = {"cycle": 0, "step": 0, "surfaces": [], "loading": {}, "load_started": 0.0}
+    start = time.monotonic()
+
+    class SoakApp(App):
+        def load_failed(self, surface, url, error_code, description):
+            load_failures.append(f"{state['loading'].pop(surface, url)}: {description} ({error_code})")
+
+        def build(self):
+            Clock.schedule_interval(self.step, 0)
+            Clock.schedule_interval(lambda dt: samples.append(sample(start, state["cycle"], Texture)), args.interval)
+            samples.append(sample(start, 0, Texture))
+            return None
+
+        def step(self, dt):
+            if time.monotonic() - start >= args.duration:
+                for surface in state["surfaces"]:
+                    surface.destroy_self()
+                    Window.remove_widget(surface)
+                samples.append(sample(start, state["cycle"], Texture))
+                self.stop()
+                return False
+            step = state["step"]
+            state["step"] += 1
+            if step == 0:
+                state["load_started"] = time.monotonic()
+                for _ in range(args.surfaces):
+                    surface = WebSurface(width=rng.randrange(200, 1200), height=rng.randrange(150, 900), fps=60)
+                    Window.add_widget(surface)
+                    url = rng.choice(urls)
+                    state["loading"][surface] = url
+                    surface.bind(on_load_finish=lambda surface, _: state["loading"].pop(surface, None),
+                                 on_load_fail=self.load_failed)
+                    surface.load_url(url)
+                    state["surfaces"].append(surface)
+            elif step == args.frames:
+                # Resize and storm only once every page has loaded
+                if state["loading"] and time.monotonic() - state["load_started"] < args.load_timeout:
+                    state["step"] = step
+                    return
+                for surface, url in state["loading"].items():
+                    load_failures.append(f"{url}: not loaded after {args.load_timeout}s")
+                state["loading"] = {}
+                for surface in state["surfaces"]:
+                    surface.size = (rng.randrange(200, 1200), rng.randrange(150, 900))
+                    surface._apply_resize() # skip the debounce, the point is to resize a lot
+                    for _ in range(args.storm):
+                        surface.on_mouse_move(rng.randrange(int(surface.width)), rng.randrange(int(surface.height)))
+            elif step >= 2 * args.frames:
+                for surface in state["surfaces"]:
+                    surface.destroy_self()
+                    Window.remove_widget(surface)
+                state["surfaces"] = []
+                state["step"] = 0
+                state["cycle"] += 1
+
+    SoakApp().run()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--duration", type=float, default=300.0, help="seconds to run")
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between samples")
+    parser.add_argument("--warmup", type=float, default=0.2, help="fraction of the run left out of the slopes")
+    parser.add_argument("--surfaces", type=int, default=4, help="surfaces created per cycle")
+    parser.add_argument("--frames", type=int, default=10, help="frames rendered between the steps of a cycle")
+    parser.add_argument("--storm", type=int, default=500, help="input events per surface per cycle")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--load-timeout", type=float, default=10.0, help="seconds a page may take to load")
+    parser.add_argument("--kivy", action="store_true", help="use WebSurface widgets instead of bare native surfaces")
+    for key, limit in THRESHOLDS.items():
+        parser.add_argument(f"--max-{key.replace('_', '-')}-slope", type=float, default=limit, dest=f"max_{key}",
+                            help=f"allowed growth per minute (default {limit})")
+    parser.add_argument("--report", default=os.path.join(HERE, "soak_report.json"))
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    load_failures = []
+    # Below the working directory, Ultralight's file system root (core.configure() isn't called)
+    with tempfile.TemporaryDirectory(prefix=".soak-pages-", dir=os.getcwd()) as directory:
+        urls = write_pages(directory)
+        samples = (run_kivy if args.kivy else run_native)(args, urls, rng, load_failures)
+
+    steady = [s for s in samples if s["t"] >= args.duration * args.warmup]
+    slopes, failures = {}, []
+    for key in THRESHOLDS:
+        slope = slope_per_minute(steady, key)
+        if slope is None:
+            continue
+        slopes[key] = slope
+        if slope > getattr(args, f"max_{key}"):
+            failures.append(key)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "mode": "kivy" if args.kivy else "native",
+            "args": vars(args),
+        },
+        "slopes_per_minute": slopes,
+        "failed": failures,
+        "load_failures": load_failures,
+        "samples": samples,
+    }
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=1)
+
+    cycles = samples[-1]["cycle"] if samples else 0
+    print(f"{cycles} cycles in {args.duration:.0f}s, report written to {args.report}")
+    for key, slope in slopes.items():
+        limit = getattr(args, f"max_{key}")
+        print(f"{key:<14} {slope:14.1f} /min (limit {limit}) {'FAIL' if key in failures else 'ok'}")
+    if load_failures:
+        print(f"{len(load_failures)} page loads failed, e.g. {load_failures[0]}")
+    if not args.kivy:
+        lib.destroyRenderer()
+    sys.exit(1 if failures or load_failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+''' Rendering and input benchmarks. Runs without a window; Kivy is only used for the optional blit timings.
+
+    python benchmarks/suite.py                              # prints a summary, writes benchmarks/results.json
+    python benchmarks/suite.py --save-baseline              # also stores the results as the baseline
+    python benchmarks/suite.py --baseline benchmarks/baseline.json --tolerance 0.15
+    python benchmarks/suite.py --kivy                       # adds Texture.blit_buffer timings (needs a display or Xvfb)
+
+libwebsurface.so is loaded next to core.py, or from $WEBSURFACE_LIBRARY. Run it from the repo root all the same:
+Ultralight's file system root, where it finds resources/, is the working directory. With --baseline the exit status is
+1 when any metric is worse than the baseline by more than --tolerance (a fraction). '''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import *
+import pages
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WHITE, BLACK = 255, 0
+
+
+def summarize(samples, unit="ms", better="lower"):
+    ''' Mean and percentiles of a list of samples '''
+    ordered = sorted(samples)
+    if not ordered:
+        return {"unit": unit, "better": better, "count": 0}
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    return {
+        "unit": unit,
+        "better": better,
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "max": ordered[-1],
+    }
+
+
+class Surface:
+    ''' A benchmark view with its staging buffers wrapped '''
+
+    def __init__(self, html, width, height):
+        self.width, self.height = width, height
+        self.index = lib.initWebSurface(width, height, html.encode("utf8"))
+        slots = range(lib.getStagingSlotCount(self.index))
+        self.frames = [wrap_staging_buffer(self.index, slot, frame=True) for slot in slots]
+        self.patches = [wrap_staging_buffer(self.index, slot) for slot in slots]
+
+    def stage(self, full=False):
+        return binding.stage_surface_pixels(self.index, full)
+
+    def center_pixel(self, slot):
+        ''' Blue channel of the center pixel in a staged frame '''
+        return self.frames[slot][((self.height // 2) * self.width + self.width // 2) * 4]
+
+    def close(self):
+        lib.destroySurface(self.index)
+
+
+def wait_loaded(surfaces, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    binding.render()
+    while any(lib.isLoading(s.index) for s in surfaces):
+        if time.monotonic() > deadline:
+            raise TimeoutError("Benchmark page did not finish loading")
+        time.sleep(0.002)
+        binding.render()
+    # Let layout and the first paints settle, then drop them so they don't count
+    for _ in range(3):
+        binding.render()
+        for s in surfaces:
+            s.stage()
+
+
+def kivy_texture(width, height):
+    ''' A Kivy texture for the blit timings, or None when no GL context can be created '''
+    try:
+        os.environ.setdefault("KIVY_NO_ARGS", "1")
+        from kivy.config import Config
+        Config.set("graphics", "window_state", "hidden")
+        from kivy.core.window import Window # creates the GL context
+        if Window is None:
+            raise RuntimeError("no window provider")
+        from kivy.graphics.texture import Texture
+        return Texture.create(size=(width, height), colorfmt="bgra")
+    except Exception as err:
+        print(f"Kivy texture unavailable, skipping blit timings ({err})")
+        return None
+
+
+def bench_page(name, html, args, texture, results):
+    ''' Per-frame render, staging and blit times while the page is scrolled up and down '''
+    surface = Surface(html, args.width, args.height)
+    wait_loaded([surface])
+    events = binding.new_input_events(1)
+    scroll = events[0]
+    scroll.surface_id, scroll.type = surface.index, INPUT_SCROLL
+
+    render_ms, stage_ms, full_ms, blit_ms = [], [], [], []
+    clock = time.perf_counter
+    for frame in range(args.frames):
+        # 30 frames down, 30 frames back up
+        scroll.y = -40 if (frame // 30) % 2 == 0 else 40
+        binding.dispatch_input_events(events, 1)
+
+        start = clock()
+        binding.render()
+        render_ms.append((clock() - start) * 1000)
+
+        start = clock()
+        slot, x, y, w, h = surface.stage()
+        stage_ms.append((clock() - start) * 1000)
+
+        if slot >= 0 and texture is not None:
+            source = surface.frames[slot] if (w, h) == (surface.width, surface.height) else surface.patches[slot][:w * h * 4]
+            start = clock()
+            texture.blit_buffer(source, size=(w, h), pos=(x, y), colorfmt="bgra", bufferfmt="ubyte")
+            blit_ms.append((clock() - start) * 1000)
+
+    for _ in range(max(args.frames // 4, 1)):
+        start = clock()
+        surface.stage(full=True)
+        full_ms.append((clock() - start) * 1000)
+
+    results[f"render.{name}"] = summarize(render_ms)
+    results[f"stage_dirty.{name}"] = summarize(stage_ms)
+    results[f"stage_full.{name}"] = summarize(full_ms)
+    if texture is not None:
+        results[f"blit.{name}"] = summarize(blit_ms)
+    surface.close()
+
+
+def bench_latency(kind, args, results):
+    ''' Time from handing an input event to the native side until a staged frame shows its effect '''
+    html = pages.CLICK_PAGE if kind == "mouse" else pages.KEY_PAGE
+    surface = Surface(html, args.width, args.height)
+    if kind == "key":
+        lib.focusView(surface.index)
+    wait_loaded([surface])
+    slot = surface.stage(full=True)[0]
+    color = surface.center_pixel(slot)
+
+    events = binding.new_input_events(1)
+    ev = events[0]
+    ev.surface_id = surface.index
+    if kind == "mouse":
+        ev.type, ev.x, ev.y, ev.button = INPUT_MOUSE_DOWN, surface.width // 2, surface.height // 2, 1
+    else:
+        ev.type, ev.keycode = INPUT_KEY_DOWN, kivy_to_ultralight_vk(ord("a"))
+    release = binding.new_input_events(1)
+    release[0].surface_id = surface.index
+    release[0].type = INPUT_MOUSE_UP if kind == "mouse" else INPUT_KEY_UP
+    release[0].x, release[0].y, release[0].button, release[0].keycode = ev.x, ev.y, ev.button, ev.keycode
+
+    latency_ms, latency_frames, missed = [], [], 0
+    for _ in range(args.latency_runs):
+        start = time.perf_counter()
+        binding.dispatch_input_events(events, 1)
+        for frame in range(1, args.latency_max_frames + 1):
+            binding.render()
+            slot = surface.stage()[0]
+            if slot >= 0 and surface.center_pixel(slot) != color:
+                latency_ms.append((time.perf_counter() - start) * 1000)
+                latency_frames.append(frame)
+                color = surface.center_pixel(slot)
+                break
+        else:
+            missed += 1
+        binding.dispatch_input_events(release, 1)
+        binding.render()
+        surface.stage()
+
+    results[f"latency.{kind}"] = summarize(latency_ms)
+    results[f"latency_frames.{kind}"] = summarize(latency_frames, unit="frames")
+    if missed:
+        print(f"latency.{kind}: {missed} of {args.latency_runs} events never showed up on screen")
+    surface.close()
+
+
+def bench_throughput(count, args, results):
+    ''' Frames per second with `count` animated surfaces rendered and staged every tick '''
+    width, height = args.width // 2, args.height // 2
+    surfaces = [Surface(pages.css_animations(40), width, height) for _ in range(count)]
+    wait_loaded(surfaces)
+    tick_ms = []
+    clock = time.perf_counter
+    end = clock() + args.duration
+    while clock() < end:
+        start = clock()
+        binding.render()
+        for s in surfaces:
+            s.stage()
+        tick_ms.append((clock() - start) * 1000)
+    results[f"throughput.{count}_surfaces"] = summarize(tick_ms)
+    results[f"throughput_fps.{count}_surfaces"] = {
+        "unit": "fps", "better": "higher", "count": len(tick_ms), "mean": len(tick_ms) / args.duration,
+    }
+    for s in surfaces:
+        s.close()
+
+
+def compare(results, baseline, tolerance):
+    ''' Prints the change against the baseline per metric and returns the names of the regressed ones '''
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if not previous or not previous.get("count") or not current.get("count"):
+            continue
+        key = "p50" if "p50" in current else "mean"
+        old, new = previous[key], current[key]
+        if old == 0:
+            continue
+        change = (new - old) / old
+        worse = change > tolerance if current["better"] == "lower" else change < -tolerance
+        mark = "REGRESSION" if worse else ""
+        print(f"{name:<34} {key} {old:10.3f} -> {new:10.3f} {current['unit']:<6} {change:+7.1%} {mark}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--frames", type=int, default=240, help="frames per page benchmark")
+    parser.add_argument("--latency-runs", type=int, default=50)
+    parser.add_argument("--latency-max-frames", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per throughput benchmark")
+    parser.add_argument("--surfaces", default="1,4,16", help="surface counts for the throughput benchmark")
+    parser.add_argument("--pages", default=",".join(pages.PAGES), help="pages to benchmark")
+    parser.add_argument("--kivy", action="store_true", help="also time Texture.blit_buffer")
+    parser.add_argument("-o", "--output", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--baseline", default=None, help="baseline results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help=f"write the results to {os.path.join(HERE, 'baseline.json')}")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args()
+
+    texture = kivy_texture(args.width, args.height) if args.kivy else None
+    results = {}
+    for name in args.pages.split(","):
+        bench_page(name, pages.PAGES[name](), args, texture, results)
+    bench_latency("mouse", args, results)
+    bench_latency("key", args, results)
+    for count in map(int, args.surfaces.split(",")):
+        bench_throughput(count, args, results)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "binding": binding.name,
+            "size": [args.width, args.height],
+        },
+        "metrics": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    if args.save_baseline:
+        with open(os.path.join(HERE, "baseline.json"), "w") as f:
+            json.dump(report, f, indent=1)
+
+    for name, metric in results.items():
+        if metric.get("count"):
+            extra = f"  p95 {metric['p95']:9.3f}" if "p95" in metric else ""
+            print(f"{name:<34} mean {metric['mean']:9.3f} {metric['unit']:<6}{extra}")
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["metrics"]
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    lib.destroyRenderer()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+''' Builds the optional compiled binding for libwebsurface.so (cffi, API mode).
+
+    python build_binding.py
+
+produces _websurface_cffi.*.so next to this file. core.py picks it up automatically and falls
+back to ctypes when it isn't there. Build libwebsurface.so first (compile_actual_lib.sh). '''
+import os
+
+from cffi import FFI
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_cdef():
+    with open(os.path.join(here, "websurface.h")) as f:
+        header = f.read()
+    return header.split("// cdef-begin", 1)[1].split("// cdef-end", 1)[0]
+
+
+ffibuilder = FFI()
+ffibuilder.cdef(read_cdef())
+ffibuilder.set_source(
+    "_websurface_cffi",
+    '#include "websurface.h"',
+    include_dirs=[here],
+    library_dirs=[here],
+    libraries=["websurface"],
+    extra_link_args=["-Wl,-rpath,$ORIGIN"], # find libwebsurface.so next to the extension
+)
+
+if __name__ == "__main__":
+    ffibuilder.compile(tmpdir=here, verbose=True)
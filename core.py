@@ -1,3 +1,6 @@
+import importlib.util
+import os
+from collections import namedtuple
 from ctypes import (
     byref,
     cdll,
@@ -8,31 +11,453 @@ from ctypes import (
     c_bool,
     POINTER,
     string_at,
-    c_int32
+    c_int32,
+    c_ubyte,
+    c_char,
+    c_float,
+    c_double,
+    c_uint64,
+    Structure,
 )
 
-# Loads the shared library
-lib = cdll.LoadLibrary("./libwebsurface.so")
-lib.initWebSurface.argtypes = [c_int, c_int, c_void_p]  # html as const char*
-lib.initWebSurface.restype = c_int
-lib.renderWebSurface.argtypes = []
-lib.getSurfacePixels.argtypes = [c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int)]
-lib.getSurfacePixels.restype = c_void_p
-lib.releaseSurfacePixels.argtypes = [c_int]
-lib.destroySurface.argtypes = [c_int]
-lib.isFocused.argtypes = [c_int]
-lib.isFocused.restype = c_bool
-lib.dispatchKeyEvent.argtypes = [c_int, c_void_p, c_int, c_int]
+# Integer input event types, must match InputEventType in websurface.cpp
+INPUT_MOUSE_DOWN = 0
+INPUT_MOUSE_UP = 1
+INPUT_MOUSE_MOVE = 2
+INPUT_SCROLL = 3 # x/y hold the scroll deltas
+INPUT_KEY_DOWN = 4
+INPUT_KEY_UP = 5
+INPUT_CHAR = 6 # text holds UTF-8 characters
+
+class InputEvent(Structure):
+    ''' Mirrors the native InputEvent struct '''
+    _fields_ = [
+        ("surface_id", c_int32),
+        ("type", c_int32),
+        ("x", c_int32),
+        ("y", c_int32),
+        ("button", c_int32),
+        ("keycode", c_int32),
+        ("modifiers", c_int32),
+        ("text", c_char * 8), # NUL terminated, so at most 7 bytes of text per event
+    ]
+
+# Load event types, must match LoadEventType in websurface.cpp
+LOAD_BEGIN = 0
+LOAD_DOM_READY = 1
+LOAD_FINISH = 2
+LOAD_FAIL = 3 # error_code and description are set
+LOAD_REQUESTED = 4 # a loadURL/loadHTML call took effect, the events after it belong to that load
+
+class LoadEvent(Structure):
+    ''' Mirrors the native LoadEvent struct '''
+    _fields_ = [
+        ("surface_id", c_int32),
+        ("type", c_int32),
+        ("error_code", c_int32),
+        ("url", c_char * 1024),
+        ("description", c_char * 256),
+    ]
+
+class LoadError(Exception):
+    ''' A page failed to load '''
+
+    def __init__(self, url, error_code=0, description=""):
+        super().__init__(f"Loading {url!r} failed ({error_code}): {description}")
+        self.url = url
+        self.error_code = error_code
+        self.description = description
+
+# Script message types, must match ScriptMessageType in websurface.cpp
+SCRIPT_RESULT = 0
+SCRIPT_EXCEPTION = 1
+SCRIPT_MESSAGE = 2 # posted by the page with websurface.post(), data is JSON
+
+class ScriptMessage(Structure):
+    ''' Mirrors the native ScriptMessage struct '''
+    _fields_ = [
+        ("surface_id", c_int32),
+        ("type", c_int32),
+        ("request_id", c_int32),
+        ("length", c_int32),
+        ("data", c_void_p), # valid until the next pollScriptMessages call
+    ]
+
+class ScriptError(Exception):
+    ''' A script evaluated in a page threw; the message is the JS exception '''
+
+class SurfaceStats(Structure):
+    ''' Mirrors the native SurfaceStats struct '''
+    _fields_ = [
+        ("frames_staged", c_uint64),
+        ("bytes_staged", c_uint64),
+        ("dirty_pixels", c_uint64),
+        ("events_dispatched", c_uint64),
+        ("last_dirty_pixels", c_int32),
+        ("last_copy_ms", c_float),
+    ]
+
+class MemoryStats(Structure):
+    ''' Mirrors the native MemoryStats struct '''
+    _fields_ = [
+        ("views", c_int32),
+        ("pooled_views", c_int32),
+        ("staging_bytes", c_uint64),
+    ]
+
+class AssetStats(Structure):
+    ''' Mirrors the native AssetStats struct '''
+    _fields_ = [
+        ("cache_hits", c_uint64),
+        ("bundle_hits", c_uint64),
+        ("disk_reads", c_uint64),
+        ("evictions", c_uint64),
+        ("invalidations", c_uint64),
+        ("cache_bytes", c_uint64),
+        ("cache_budget", c_uint64),
+        ("cache_entries", c_int32),
+        ("bundle_entries", c_int32),
+    ]
+
+
+def _declare(lib):
+    ''' Argument and return types of every exported function '''
+    lib.initWebSurface.argtypes = [c_int, c_int, c_void_p]  # html as const char*
+    lib.initWebSurface.restype = c_int
+    lib.renderWebSurface.argtypes = []
+    lib.renderWebSurface.restype = c_bool
+    lib.getSurfacePixels.argtypes = [c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+    lib.getSurfacePixels.restype = c_void_p
+    lib.releaseSurfacePixels.argtypes = [c_int]
+    lib.getSurfaceDirtyBounds.argtypes = [c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+    lib.getSurfaceDirtyBounds.restype = c_bool
+    lib.stageSurfacePixels.argtypes = [c_int, c_bool, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+    lib.stageSurfacePixels.restype = c_int
+    lib.getStagingBuffer.argtypes = [c_int, c_int, c_bool, POINTER(c_int)]
+    lib.getStagingBuffer.restype = c_void_p
+    lib.resizeSurface.argtypes = [c_int, c_int, c_int]
+    lib.resizeSurface.restype = c_bool
+    lib.setSurfaceScale.argtypes = [c_int, c_double]
+    lib.getStagingSlotCount.argtypes = [c_int]
+    lib.getStagingSlotCount.restype = c_int
+    lib.startRenderThread.argtypes = [c_int]
+    lib.startRenderThread.restype = c_bool
+    lib.isRenderThreadRunning.argtypes = []
+    lib.isRenderThreadRunning.restype = c_bool
+    lib.setSurfaceVisible.argtypes = [c_int, c_bool]
+    lib.setSurfaceBackgroundInterval.argtypes = [c_int, c_int]
+    lib.getSurfaceStats.argtypes = [c_int, POINTER(SurfaceStats)]
+    lib.getSurfaceStats.restype = c_bool
+    lib.getRendererFrameTimes.argtypes = [POINTER(c_float), POINTER(c_float), c_int, POINTER(c_uint64)]
+    lib.getRendererFrameTimes.restype = c_int
+    lib.dispatchInputEvents.argtypes = [POINTER(InputEvent), c_int]
+    lib.dispatchInputEvents.restype = c_int
+    lib.destroySurface.argtypes = [c_int]
+    lib.prewarmViews.argtypes = [c_int, c_int, c_int]
+    lib.getPooledViewCount.argtypes = []
+    lib.getPooledViewCount.restype = c_int
+    lib.prewarmRenderer.argtypes = []
+    lib.prewarmRenderer.restype = None
+    lib.clearViewPool.argtypes = []
+    lib.clearViewPool.restype = None
+    lib.isFocused.argtypes = [c_int]
+    lib.isFocused.restype = c_bool
+    lib.pollLoadEvents.argtypes = [POINTER(LoadEvent), c_int]
+    lib.pollLoadEvents.restype = c_int
+    lib.evaluateScript.argtypes = [c_int, c_char_p, c_int]
+    lib.evaluateScript.restype = c_bool
+    lib.pollScriptMessages.argtypes = [POINTER(ScriptMessage), c_int]
+    lib.pollScriptMessages.restype = c_int
+    lib.dispatchKeyEvent.argtypes = [c_int, c_char_p, c_int, c_int, c_char_p]
+    lib.dispatchMouseEvent.argtypes = [c_int, c_int, c_int, c_int, c_char_p]
+    lib.dispatchScrollEvent.argtypes = [c_int, c_int, c_int]
+    lib.dispatchCharEvent.argtypes = [c_int, c_char_p]
+    lib.focusView.argtypes = [c_int]
+    lib.loadURL.argtypes = [c_int, c_char_p]
+    lib.loadURL.restype = c_bool
+    lib.loadHTML.argtypes = [c_int, c_char_p]
+    lib.loadHTML.restype = c_bool
+    lib.isLoading.argtypes = [c_int]
+    lib.isLoading.restype = c_bool
+    lib.configurePlatform.argtypes = [c_char_p, c_char_p, c_char_p]
+    lib.configurePlatform.restype = c_bool
+    lib.purgeMemory.argtypes = [c_bool]
+    lib.logMemoryUsage.argtypes = []
+    lib.logMemoryUsage.restype = None
+    lib.getMemoryStats.argtypes = [POINTER(MemoryStats)]
+    lib.configureAssetCache.argtypes = [c_uint64, c_double]
+    lib.mountAssetBundle.argtypes = [c_char_p]
+    lib.mountAssetBundle.restype = c_bool
+    lib.getAssetStats.argtypes = [POINTER(AssetStats)]
+    lib.clearAssetCache.argtypes = []
+    lib.clearAssetCache.restype = None
+    lib.destroyRenderer.argtypes = []
+    lib.destroyRenderer.restype = None
+
+
+# Next to this file unless WEBSURFACE_LIBRARY says otherwise, so the working directory doesn't matter
+LIBRARY_PATH = os.environ.get("WEBSURFACE_LIBRARY") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "libwebsurface.so")
+
+
+class _Library:
+    ''' Loads libwebsurface.so on first use rather than at import. Each function is looked up once and then
+    cached as a plain attribute, so calls cost the same as on the CDLL itself. '''
+    _cdll = None
+
+    def load(self):
+        if self._cdll is None:
+            cdll_ = cdll.LoadLibrary(LIBRARY_PATH)
+            _declare(cdll_)
+            _Library._cdll = cdll_
+        return self._cdll
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        function = getattr(self.load(), name)
+        setattr(self, name, function)
+        return function
+
+lib = _Library()
+
+
+def configure(file_system_dir=None, resource_prefix=None, log_path=None):
+    ''' Sets where Ultralight reads files from (`file_system_dir`, the root of file:/// URLs, default the working directory),
+    where its resources are inside it (`resource_prefix`, default "resources/") and its log file (default "ultralight.log").
+    Only possible before the first surface (or prewarm()); returns False afterwards. '''
+    encode = lambda value: None if value is None else os.fsencode(value)
+    return lib.configurePlatform(encode(file_system_dir), encode(resource_prefix), encode(log_path))
+
+
+def configure_assets(cache_bytes=64 << 20, revalidate_after=0):
+    ''' Byte budget of the in-memory cache for files read from disk, and how often (seconds) a cached file is checked
+    against the disk again. 0 checks it on every open (a stat, the file is only read again when that changed), so
+    edits show up right away; a negative value never checks, clear_asset_cache() forgets everything. Possible at any
+    time. '''
+    lib.configureAssetCache(cache_bytes, revalidate_after)
+
+
+def mount_bundle(path):
+    ''' Serves files from the bundle built by pack_assets.py ahead of the disk, replacing any bundle mounted before.
+    Paths in the bundle are relative to file_system_dir (see configure()). None unmounts. Returns False for a
+    file that isn't a valid bundle. '''
+    return lib.mountAssetBundle(None if path is None else os.fsencode(path))
+
+
+def clear_asset_cache():
+    lib.clearAssetCache()
+
+
+def asset_stats():
+    ''' Cache, bundle and disk hits of the asset file system since startup, and the cache's size '''
+    stats = AssetStats()
+    lib.getAssetStats(byref(stats))
+    return {name: getattr(stats, name) for name, _ in AssetStats._fields_}
+
+
+def prewarm():
+    ''' Loads the library, initializes the platform, creates the renderer and warms its font caches now, so the first
+    WebSurface doesn't pay for it. Runs on the render thread if one was started, without blocking. '''
+    lib.prewarmRenderer()
+
+
+_load_events = None
+
+def poll_load_events():
+    ''' Load events of all surfaces since the last call, oldest first, as (surface_id, type, url, error_code, description)
+    tuples. Whoever calls this consumes them; with Kivy that is frame_scheduler, once per tick. '''
+    global _load_events
+    if _load_events is None:
+        _load_events = (LoadEvent * 16)()
+    result = []
+    while True:
+        count = lib.pollLoadEvents(_load_events, len(_load_events))
+        for ev in _load_events[:count]:
+            result.append((ev.surface_id, ev.type, ev.url.decode("utf8", "replace"), ev.error_code,
+                           ev.description.decode("utf8", "replace")))
+        if count < len(_load_events):
+            return result
+
+
+_script_messages = None
+
+def poll_script_messages():
+    ''' Script results and page messages of all surfaces since the last call, oldest first, as
+    (surface_id, type, request_id, data) tuples with `data` decoded to str. Consumes them, like poll_load_events(). '''
+    global _script_messages
+    if _script_messages is None:
+        _script_messages = (ScriptMessage * 64)()
+    result = []
+    while True:
+        count = lib.pollScriptMessages(_script_messages, len(_script_messages))
+        for message in _script_messages[:count]:
+            # Copied right away, the next poll frees the native strings
+            data = string_at(message.data, message.length).decode("utf8", "replace") if message.length else ""
+            result.append((message.surface_id, message.type, message.request_id, data))
+        if count < len(_script_messages):
+            return result
 
 
 button_codes = {'none': 0, 'left': 1, 'middle': 2, 'right': 3}
-non_printable_keycodes = [27, 9, 277, 279, 278, 127, 8, 13, 303, 304, 305, 273, 275, 274, 276, 306, 280, 281, 307, 308, 301] + list(range(282, 294))
+non_printable_keycodes = frozenset([27, 9, 277, 279, 278, 127, 8, 13, 303, 304, 305, 273, 275, 274, 276, 306, 280, 281, 307, 308, 301] + list(range(282, 294)))
 
 MOD_SHIFT = 1 << 1
 MOD_CTRL  = 1 << 0
 MOD_ALT   = 1 << 2
 MOD_META  = 1 << 3
 
+def wrap_staging_buffer(surface_id, slot, frame=False):
+    '''Wraps one of the native staging buffers of a surface as a writable byte memoryview, without copying.
+    `frame` selects the full-frame copy instead of the packed dirty patch. Returns None for an invalid surface.'''
+    size = c_int()
+    address = lib.getStagingBuffer(surface_id, slot, frame, byref(size))
+    if not address:
+        return None
+    return memoryview((c_ubyte * size.value).from_address(address)).cast('B')
+
+class CtypesBinding:
+    ''' The calls made every frame (or every event), through ctypes. Out parameters are allocated once and reused. '''
+    name = "ctypes"
+
+    _functions = {"render": "renderWebSurface", "is_focused": "isFocused",
+                  "dispatch_input_events": "dispatchInputEvents", "_stage": "stageSurfacePixels"}
+
+    def __init__(self):
+        self._out = (c_int(), c_int(), c_int(), c_int())
+
+    def __getattr__(self, name):
+        # The functions are looked up on first use (loading the library then), and stay plain attributes afterwards
+        if name not in self._functions:
+            raise AttributeError(name)
+        function = getattr(lib, self._functions[name])
+        setattr(self, name, function)
+        return function
+
+    def stage_surface_pixels(self, surface_id, full):
+        ''' Returns (slot, x, y, w, h); slot is -1 when nothing was staged '''
+        x, y, w, h = self._out
+        slot = self._stage(surface_id, full, x, y, w, h)
+        return slot, x.value, y.value, w.value, h.value
+
+    def new_input_events(self, count):
+        return (InputEvent * count)()
+
+
+class CffiBinding:
+    ''' Same interface as CtypesBinding, through the compiled cffi extension built by build_binding.py '''
+    name = "cffi"
+
+    _functions = CtypesBinding._functions
+
+    def __getattr__(self, name):
+        # Importing the extension loads libwebsurface.so, so that too waits for the first use
+        if name not in self._functions and name not in ("_ffi", "_out"):
+            raise AttributeError(name)
+        from _websurface_cffi import ffi, lib as clib
+        self._ffi = ffi
+        self._out = ffi.new("int[4]")
+        for attribute, function in self._functions.items():
+            setattr(self, attribute, getattr(clib, function))
+        return getattr(self, name)
+
+    def stage_surface_pixels(self, surface_id, full):
+        out = self._out
+        slot = self._stage(surface_id, full, out, out + 1, out + 2, out + 3)
+        return slot, out[0], out[1], out[2], out[3]
+
+    def new_input_events(self, count):
+        return self._ffi.new("InputEvent[]", count)
+
+
+# The compiled binding is optional, ctypes is the fallback
+binding = CffiBinding() if importlib.util.find_spec("_websurface_cffi") else CtypesBinding()
+
+
+# What a WebSurface renders through: the in-process library, or a worker process (see remote.py)
+Backend = namedtuple("Backend", "lib binding input_queue wrap_staging_buffer poll_load_events poll_script_messages")
+
+
+class InputQueue:
+    '''Collects input for any number of surfaces during a frame and hands it to the native side in a single call on `flush()`.
+    Consecutive mouse moves (with the same button) and consecutive scroll deltas of a surface are merged into one event,
+    so a high-rate mouse costs one event per frame instead of one call per report.'''
+    capacity = 256 # events buffered before an early flush
+
+    def __init__(self):
+        self._events = None # allocated on the first event, so creating a queue doesn't load the library
+        self._count = 0
+
+    def _append(self, surface_id, type):
+        if self._count == self.capacity:
+            self.flush()
+        if self._events is None:
+            self._events = self._new_events()
+        ev = self._events[self._count]
+        self._count += 1
+        ev.surface_id = surface_id
+        ev.type = type
+        ev.x = ev.y = ev.button = ev.keycode = ev.modifiers = 0
+        ev.text = b""
+        return ev
+
+    def _last(self, surface_id, type):
+        ''' The most recently queued event if it has the given surface and type, else None '''
+        if self._count:
+            ev = self._events[self._count - 1]
+            if ev.surface_id == surface_id and ev.type == type:
+                return ev
+        return None
+
+    def mouse(self, surface_id, type, x, y, button):
+        if type == INPUT_MOUSE_MOVE:
+            last = self._last(surface_id, INPUT_MOUSE_MOVE)
+            if last is not None and last.button == button:
+                last.x, last.y = x, y
+                return
+        ev = self._append(surface_id, type)
+        ev.x, ev.y, ev.button = x, y, button
+
+    def scroll(self, surface_id, dx, dy):
+        last = self._last(surface_id, INPUT_SCROLL)
+        if last is not None:
+            last.x += dx
+            last.y += dy
+            return
+        ev = self._append(surface_id, INPUT_SCROLL)
+        ev.x, ev.y = dx, dy
+
+    def key(self, surface_id, type, keycode, modifiers):
+        ev = self._append(surface_id, type)
+        ev.keycode, ev.modifiers = keycode, modifiers
+
+    def char(self, surface_id, text):
+        ''' Queues typed text (str or UTF-8 bytes), split over as many events as needed '''
+        if isinstance(text, str):
+            text = text.encode("utf8")
+        start = 0
+        while start < len(text):
+            end = min(len(text), start + 7)
+            # Never cut a UTF-8 sequence in half
+            while end < len(text) and end > start and (text[end] & 0xC0) == 0x80:
+                end -= 1
+            self._append(surface_id, INPUT_CHAR).text = text[start:end]
+            start = end
+
+    def flush(self):
+        if self._count:
+            self._dispatch(self._events, self._count)
+            self._count = 0
+
+    # Where the events go; remote.py sends them to a worker process instead
+    def _new_events(self):
+        return binding.new_input_events(self.capacity)
+
+    def _dispatch(self, events, count):
+        binding.dispatch_input_events(events, count)
+
+    def __len__(self):
+        return self._count
+
 def make_modmask(modifiers):
     mask = 0
     if 'shift' in modifiers:
@@ -45,46 +470,50 @@ def make_modmask(modifiers):
         mask |= MOD_META
     return mask
 
-def kivy_to_ultralight_vk(keycode: int) -> int:
-    """Translate Kivy/SDL2 keycodes to Ultralight-compatible virtual key codes (VK_*)."""
-    
-    # Core printable range (A-Z, 0-9, punctuation) are same as ASCII, so pass them through.
-    if 32 <= keycode <= 126:
-        return keycode
-
-    # Custom mapping for non-printables you listed
-    mapping = {
-        27: 0x1B,   # Escape
-        278: 0x24,  # Home
-        279: 0x23,  # End
-        281: 0x22,  # Page Down (VK_NEXT)
-        280: 0x21,  # Page Up (VK_PRIOR)
-        277: 0x2D,  # Insert
-        8:   0x08,  # Backspace
-        9:   0x09,  # Tab
-        13:  0x0D,  # Enter / Return
-
-        # Arrows (assuming Kivy uses SDL defaults)
-        273: 0x26,  # Up
-        274: 0x28,  # Down
-        275: 0x27,  # Right
-        276: 0x25,  # Left
-
-        # Modifier keys
-        303: 0xA0,  # Left Shift (VK_LSHIFT)
-        304: 0xA1,  # Right Shift (VK_RSHIFT)
-        307: 0xA5,  # Right Alt (VK_RMENU)
-        308: 0xA4,  # Left Alt (VK_LMENU)
-        305: 0xA2,  # Left Ctrl (VK_LCONTROL)
-        306: 0xA3,  # Right Ctrl (VK_RCONTROL)
-        301: 0x14,  # Caps Lock
-    }
+# Custom mapping for non-printables you listed
+_vk_mapping = {
+    27: 0x1B,   # Escape
+    278: 0x24,  # Home
+    279: 0x23,  # End
+    281: 0x22,  # Page Down (VK_NEXT)
+    280: 0x21,  # Page Up (VK_PRIOR)
+    277: 0x2D,  # Insert
+    8:   0x08,  # Backspace
+    9:   0x09,  # Tab
+    13:  0x0D,  # Enter / Return
+
+    # Arrows (assuming Kivy uses SDL defaults)
+    273: 0x26,  # Up
+    274: 0x28,  # Down
+    275: 0x27,  # Right
+    276: 0x25,  # Left
 
+    # Modifier keys
+    303: 0xA0,  # Left Shift (VK_LSHIFT)
+    304: 0xA1,  # Right Shift (VK_RSHIFT)
+    307: 0xA5,  # Right Alt (VK_RMENU)
+    308: 0xA4,  # Left Alt (VK_LMENU)
+    305: 0xA2,  # Left Ctrl (VK_LCONTROL)
+    306: 0xA3,  # Right Ctrl (VK_RCONTROL)
+    301: 0x14,  # Caps Lock
+}
+
+# Lookup table built once at import, indexed by Kivy keycode. Unknown keys map to 0.
+_vk_table = [0] * 512
+for _code in range(32, 127):
+    # Core printable range (A-Z, 0-9, punctuation) are same as ASCII, so pass them through.
+    _vk_table[_code] = _code
+for _code in range(282, 294):
     # Function keys (F1–F12)
-    if 282 <= keycode <= 293:
-        return 0x70 + (keycode - 282)
+    _vk_table[_code] = 0x70 + (_code - 282)
+for _code, _vk in _vk_mapping.items():
+    _vk_table[_code] = _vk
+del _code, _vk
 
-    # Return mapped value or fallback
-    return mapping.get(keycode, 0)
+def kivy_to_ultralight_vk(keycode: int) -> int:
+    """Translate Kivy/SDL2 keycodes to Ultralight-compatible virtual key codes (VK_*)."""
+    if 0 <= keycode < 512:
+        return _vk_table[keycode]
+    return 0
 
 
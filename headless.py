@@ -0,0 +1,186 @@
+''' Window-less rendering of HTML strings and URLs to images, for batch jobs such as thumbnails.
+Nothing in here imports Kivy. Pillow is only needed for the "png"/"webp" formats, NumPy only for "array". '''
+import io
+import multiprocessing
+import os
+import queue
+import time
+from collections import deque, namedtuple
+from itertools import islice
+
+from core import *
+
+
+URL_SCHEMES = ("http://", "https://", "file://", "data:")
+
+# index: position of the source in the input, data: the rendered image (None on failure), error: message or None
+RenderResult = namedtuple("RenderResult", "index source data error")
+
+
+def is_url(source):
+    return source.startswith(URL_SCHEMES)
+
+
+class HeadlessRenderer:
+    ''' Renders one page at a time into a single reusable Ultralight view of a fixed size. '''
+
+    def __init__(self, width=800, height=600):
+        self.width = width
+        self.height = height
+        self.index = lib.initWebSurface(width, height, b"")
+        # The full-frame staging copies are tightly packed, so a frame is a plain BGRA image
+        self._frames = [wrap_staging_buffer(self.index, slot, frame=True) for slot in range(lib.getStagingSlotCount(self.index))]
+
+    def render(self, source, timeout=30.0, settle_frames=2, ready="load"):
+        ''' Loads `source` (an HTML string or a URL), waits until it has finished loading and returns the
+        page as BGRA bytes of width*height*4. With `ready="dom_ready"` the page is captured as soon as its DOM is ready,
+        without waiting for images and other subresources. Raises TimeoutError if that takes longer than `timeout`
+        seconds and LoadError if the page fails to load. '''
+        if is_url(source):
+            lib.loadURL(self.index, source.encode("utf8"))
+        else:
+            lib.loadHTML(self.index, source.encode("utf8"))
+        self._wait(LOAD_DOM_READY if ready == "dom_ready" else LOAD_FINISH, timeout, source)
+
+        # Layout and paint can trail the load by a frame or two
+        for _ in range(settle_frames):
+            binding.render()
+
+        slot = binding.stage_surface_pixels(self.index, True)[0]
+        if slot < 0:
+            raise RuntimeError("Could not read the surface pixels")
+        return bytes(self._frames[slot])
+
+    def _wait(self, until, timeout, source):
+        ''' Renders until the load event `until` (or LOAD_FINISH) arrives for the load just requested. Consumes the
+        load events of every surface in this process. '''
+        deadline = time.monotonic() + timeout
+        requested = False # events before our LOAD_REQUESTED marker belong to the previous page
+        while True:
+            binding.render()
+            for surface_id, type, url, error_code, description in poll_load_events():
+                if surface_id != self.index:
+                    continue
+                if type == LOAD_REQUESTED:
+                    requested = True
+                elif requested and type == LOAD_FAIL:
+                    raise LoadError(url, error_code, description)
+                elif requested and (type == until or type == LOAD_FINISH):
+                    return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Loading did not finish within {timeout}s: {source[:80]!r}")
+            time.sleep(0.002) # network and decoding happen off this thread, don't spin on them
+
+    def close(self):
+        lib.destroySurface(self.index)
+
+
+def encode_frame(bgra, width, height, format="png"):
+    ''' Converts BGRA bytes to the requested output format:
+    "bgra" (the bytes as they are), "array" (NumPy RGBA array of shape (height, width, 4)),
+    or any format Pillow can save, such as "png" or "webp" (encoded bytes). '''
+    format = format.lower()
+    if format == "bgra":
+        return bgra
+    if format == "array":
+        import numpy
+        return numpy.frombuffer(bgra, dtype=numpy.uint8).reshape(height, width, 4)[..., [2, 1, 0, 3]]
+
+    from PIL import Image
+    image = Image.frombuffer("RGBA", (width, height), bgra, "raw", "BGRA", 0, 1)
+    out = io.BytesIO()
+    image.save(out, format=format.upper())
+    return out.getvalue()
+
+
+def render(source, width=800, height=600, format="png", timeout=30.0):
+    ''' Renders a single HTML string or URL in this process. See encode_frame() for `format`. '''
+    renderer = HeadlessRenderer(width, height)
+    try:
+        return encode_frame(renderer.render(source, timeout), width, height, format)
+    finally:
+        renderer.close()
+
+
+## { Process pool workers. Each worker owns one renderer for its whole life.
+_worker = None
+
+def _init_worker(width, height, format, timeout):
+    global _worker
+    _worker = (HeadlessRenderer(width, height), format, timeout)
+
+def _render_job(job):
+    index, source = job
+    renderer, format, timeout = _worker
+    try:
+        data = encode_frame(renderer.render(source, timeout), renderer.width, renderer.height, format)
+        return RenderResult(index, source, data, None)
+    except Exception as err:
+        return RenderResult(index, source, None, f"{type(err).__name__}: {err}")
+
+def _render_chunk(jobs):
+    return [_render_job(job) for job in jobs]
+## }
+
+
+def render_many(sources, width=800, height=600, format="png", processes=None, timeout=30.0, ordered=True, chunksize=1,
+                max_pending=None):
+    ''' Renders an iterable of HTML strings and/or URLs across a pool of `processes` workers (default: one per core),
+    each with its own Ultralight renderer, and yields a RenderResult per source as soon as it is done.
+    Results come in input order unless `ordered` is False. A failing source yields a result with `error` set
+    instead of stopping the batch. `sources` is consumed as results are taken: at most `max_pending` sources
+    (default: four per worker) are submitted and not yet yielded at any time, so a long generator is never held in
+    memory all at once. '''
+    processes = processes or os.cpu_count() or 1
+    limit = max(1, (max_pending or 4 * processes) // chunksize) # chunks in flight
+    jobs = enumerate(sources)
+    submitted = deque() # AsyncResults in submission order (ordered)
+    finished = queue.SimpleQueue() # chunks as they complete (unordered)
+    outstanding = 0
+    # Spawned rather than forked workers: a forked child would inherit this process' Ultralight state
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, initializer=_init_worker, initargs=(width, height, format, timeout)) as pool:
+        while True:
+            while outstanding < limit:
+                chunk = list(islice(jobs, chunksize))
+                if not chunk:
+                    break
+                if ordered:
+                    submitted.append(pool.apply_async(_render_chunk, (chunk,)))
+                else:
+                    pool.apply_async(_render_chunk, (chunk,), callback=finished.put, error_callback=finished.put)
+                outstanding += 1
+            if not outstanding:
+                return
+            outstanding -= 1
+            results = submitted.popleft().get() if ordered else finished.get()
+            if isinstance(results, BaseException):
+                raise results
+            yield from results
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description="Render HTML files or URLs to images without a window.")
+    parser.add_argument("sources", nargs="+", help="HTML files or URLs")
+    parser.add_argument("-o", "--output-dir", default=".")
+    parser.add_argument("-f", "--format", default="png")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("-j", "--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    def load(source):
+        return source if is_url(source) else open(source, encoding="utf8").read()
+
+    for result in render_many(map(load, args.sources), args.width, args.height, args.format, args.processes):
+        name = args.sources[result.index]
+        if result.error:
+            print(f"{name}: {result.error}")
+            continue
+        path = os.path.join(args.output_dir, f"{os.path.splitext(os.path.basename(name))[0] or 'page'}_{result.index}.{args.format}")
+        with open(path, "wb") as f:
+            f.write(result.data)
+        print(f"{name} -> {path}")
@@ -0,0 +1,51 @@
+''' Memory reporting and purging. Nothing in here imports Kivy; the policy that decides when to purge lives in
+websurface.py (MemoryPolicy). '''
+import os
+from ctypes import byref
+
+from core import lib, MemoryStats
+
+# Totals since startup, also reported by stats.renderer_stats()
+counters = {
+    "purges": 0,
+    "reclaimed_bytes": 0,      # RSS given back by all purges together
+    "last_reclaimed_bytes": 0,
+    "last_purge_reason": None,
+    "evictions": 0,            # views evicted to a snapshot
+    "restores": 0,             # evicted views recreated
+}
+
+_page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    ''' Current resident set size of this process, or None where /proc isn't available '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _page_size
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_report():
+    ''' RSS, the library's own native memory (views, pooled views, staging bytes) and the purge/eviction totals '''
+    native = MemoryStats()
+    lib.getMemoryStats(byref(native))
+    report = {name: getattr(native, name) for name, _ in MemoryStats._fields_}
+    report["rss_bytes"] = rss_bytes()
+    report.update(counters)
+    return report
+
+
+def purge(reason="manual", clear_view_pool=False):
+    ''' Purges the renderer's caches (and the view pool if asked) and returns how much RSS that gave back.
+    Freed memory isn't always returned to the OS right away, so this can be 0 even when caches were dropped. '''
+    before = rss_bytes()
+    lib.purgeMemory(clear_view_pool)
+    after = rss_bytes()
+    reclaimed = max(0, before - after) if before is not None and after is not None else 0
+    counters["purges"] += 1
+    counters["reclaimed_bytes"] += reclaimed
+    counters["last_reclaimed_bytes"] = reclaimed
+    counters["last_purge_reason"] = reason
+    return reclaimed
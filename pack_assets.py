@@ -0,0 +1,145 @@
+''' Packs a directory of local content (HTML, CSS, JS, fonts, images) into a single bundle file that the native
+file system maps into memory and serves ahead of the disk, see core.mount_bundle().
+
+    python pack_assets.py site -o site.bundle                 # site/index.html is served as file:///index.html
+    python pack_assets.py site -o site.bundle --prefix app    # ... as file:///app/index.html
+    python pack_assets.py site -o site.bundle --check         # exit status 1 if the bundle is out of date
+
+Paths are relative to Ultralight's file_system_dir (see core.configure()). Every file carries a content hash; the
+bundle is only rewritten when a file was added, removed or changed. The hashes are only read here, the library
+doesn't check them (files in a bundle are served as they are).
+
+The layout below is parsed again by AssetBundle::parseIndex in websurface.cpp, which hard-codes the sizes of HEADER
+(24 bytes) and ENTRY (32 bytes); keep the two in step, tests/test_pack_assets.py round-trips a bundle through both. '''
+import argparse
+import hashlib
+import mimetypes
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b"WSBUNDLE"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")   # magic, version, entry count, index size
+ENTRY = struct.Struct("<HHIQQQ")   # path length, mime length, 0, offset, size, hash
+ALIGN = 16
+
+
+def content_hash(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def collect(directory, prefix=""):
+    ''' {bundle path: file path} of every file below `directory`, hidden ones left out '''
+    files = {}
+    for top, dirs, names in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+            path = os.path.join(top, name)
+            relative = os.path.relpath(path, directory).replace(os.sep, "/")
+            files[f"{prefix.strip('/')}/{relative}" if prefix.strip("/") else relative] = path
+    return files
+
+
+def parse_index(data):
+    ''' {bundle path: (mime type, offset, size, hash)} of the bundle in `data` (bytes-like, the whole file), or None if
+    it isn't a valid one. Accepts and rejects exactly what the library's parser does. '''
+    if len(data) < HEADER.size:
+        return None
+    magic, version, count, index_size = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or index_size > len(data) - HEADER.size:
+        return None
+    entries, at, end = {}, HEADER.size, HEADER.size + index_size
+    for _ in range(count):
+        if end - at < ENTRY.size:
+            return None
+        path_length, mime_length, _, offset, size, hash = ENTRY.unpack_from(data, at)
+        at += ENTRY.size
+        if end - at < path_length + mime_length or offset > len(data) or size > len(data) - offset:
+            return None
+        path = bytes(data[at:at + path_length]).decode("utf8", "replace")
+        mime = bytes(data[at + path_length:at + path_length + mime_length]).decode("utf8", "replace")
+        entries[path] = (mime, offset, size, hash)
+        at += path_length + mime_length
+    return entries
+
+
+def read_index(path):
+    ''' {bundle path: hash} of an existing bundle, or None if there is no valid one '''
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            entries = parse_index(data)
+    except (OSError, ValueError): # ValueError: an empty file can't be mapped
+        return None
+    return None if entries is None else {path: entry[3] for path, entry in entries.items()}
+
+
+def write_bundle(output, entries):
+    ''' entries: (bundle path, mime type, data) '''
+    index = bytearray()
+    offset = HEADER.size + sum(ENTRY.size + len(p.encode("utf8")) + len(m.encode("utf8")) for p, m, _ in entries)
+    offsets = []
+    for _, _, data in entries:
+        offset = -(-offset // ALIGN) * ALIGN
+        offsets.append(offset)
+        offset += len(data)
+    for (path, mime, data), offset in zip(entries, offsets):
+        path_bytes, mime_bytes = path.encode("utf8"), mime.encode("utf8")
+        index += ENTRY.pack(len(path_bytes), len(mime_bytes), 0, offset, len(data), content_hash(data))
+        index += path_bytes + mime_bytes
+
+    temporary = output + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries), len(index)))
+        f.write(index)
+        for (_, _, data), offset in zip(entries, offsets):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(data)
+    os.replace(temporary, output) # a mounted bundle keeps its old mapping, nothing reads a half-written file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("directory")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("--prefix", default="", help="directory the files appear under, relative to file_system_dir")
+    parser.add_argument("--check", action="store_true", help="only report whether the bundle is up to date")
+    parser.add_argument("--force", action="store_true", help="rewrite the bundle even if nothing changed")
+    args = parser.parse_args()
+
+    files = collect(args.directory, args.prefix)
+    entries = []
+    for path, file_path in files.items():
+        with open(file_path, "rb") as f:
+            data = f.read()
+        entries.append((path, mimetypes.guess_type(path)[0] or "", data))
+    hashes = {path: content_hash(data) for path, _, data in entries}
+
+    old = read_index(args.output)
+    if old is not None:
+        added = sorted(hashes.keys() - old.keys())
+        removed = sorted(old.keys() - hashes.keys())
+        changed = sorted(path for path in hashes.keys() & old.keys() if hashes[path] != old[path])
+        for label, paths in (("added", added), ("removed", removed), ("changed", changed)):
+            for path in paths:
+                print(f"{label:<8} {path}")
+        stale = bool(added or removed or changed)
+    else:
+        stale = True
+    if args.check:
+        print(f"{args.output} is {'out of date' if stale else 'up to date'}")
+        sys.exit(1 if stale else 0)
+    if not stale and not args.force:
+        print(f"{args.output} is up to date ({len(entries)} files)")
+        return
+
+    write_bundle(args.output, entries)
+    total = sum(len(data) for _, _, data in entries)
+    print(f"{len(entries)} files, {total / 1048576:.1f} MiB -> {args.output}")
+
+
+if __name__ == "__main__":
+    main()
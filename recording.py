@@ -0,0 +1,178 @@
+''' Recording of surface frames, for QA replays and previews. Nothing in here imports Kivy; WebSurface.start_recording()
+feeds a Recorder from its updates, anything else holding BGRA frames (e.g. headless.HeadlessRenderer) can do the same.
+
+The capturing side only copies the frame into a free slot of a small ring buffer; encoding and writing happen on a
+background thread. When the writer falls behind and no slot is free, the frame is dropped and counted instead of
+waiting for it. Frames that didn't change since the last capture are recorded as repeats, without pixel data.
+
+Formats:
+- "png": a directory of PNG files (frame_000000.png, ...) plus index.txt, one "timestamp file" line per capture
+  (repeats name the previous file). Encoded with zlib only, Pillow isn't needed.
+- "raw" / "zlib": a single frame archive, BGRA pixels as they are or zlib-compressed. read_frames() replays either. '''
+import logging
+import os
+import queue
+import struct
+import threading
+import zlib
+from time import perf_counter
+
+log = logging.getLogger(__name__)
+
+FORMATS = ("png", "raw", "zlib")
+
+MAGIC = b"WSFRAMES"
+VERSION = 1
+HEADER = struct.Struct("<8sI")        # magic, version
+RECORD = struct.Struct("<dIIBxxxI")   # timestamp, width, height, kind, payload length
+KIND_RAW, KIND_ZLIB, KIND_REPEAT = 0, 1, 2
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_chunk(type, data):
+    return struct.pack(">I", len(data)) + type + data + struct.pack(">I", zlib.crc32(type + data))
+
+
+def encode_png(bgra, width, height, level=1):
+    ''' Encodes a BGRA frame as PNG. `bgra` must be a writable buffer: it is turned into RGBA in place. '''
+    pixels = memoryview(bgra)[:width * height * 4]
+    pixels[0::4], pixels[2::4] = pixels[2::4].tobytes(), pixels[0::4].tobytes()
+    stride = width * 4
+    # Every row starts with its filter type, 0 (none): fast, and zlib still finds the runs of flat page content
+    rows = b"".join(b"\0" + pixels[at:at + stride] for at in range(0, stride * height, stride))
+    return (PNG_SIGNATURE + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + _png_chunk(b"IDAT", zlib.compress(rows, level)) + _png_chunk(b"IEND", b""))
+
+
+def read_frames(path):
+    ''' Yields (timestamp, width, height, bgra bytes) for every capture of a "raw" or "zlib" archive, repeats
+    included (they yield the previous frame, and its size, again) '''
+    with open(path, "rb") as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a frame archive")
+        frame, size = None, (0, 0)
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp, width, height, kind, length = RECORD.unpack(record)
+            if kind != KIND_REPEAT:
+                frame, size = f.read(length), (width, height)
+                if kind == KIND_ZLIB:
+                    frame = zlib.decompress(frame)
+            else:
+                width, height = size
+            yield timestamp, width, height, frame
+
+
+class Recorder:
+    ''' Writes the frames passed to offer() to `path` on a background thread, see the module docstring.
+    `buffer_frames` is the size of the ring buffer, `level` the zlib level of "png" and "zlib" (1 is fastest). '''
+
+    def __init__(self, path, format="png", buffer_frames=8, level=1):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown recording format {format!r}, expected one of {FORMATS}")
+        self.path = path
+        self.format = format
+        self.level = level
+        self.start = perf_counter()
+        self.error = None # set by the writer thread when writing failed; nothing is written after that
+        # Counters. The capturing thread only touches the first three, the writer only "written"
+        self.captured = 0
+        self.dropped = 0
+        self.repeated = 0
+        self.written = 0
+        self._last_size = None # (width, height) of the last offered frame, repeats are recorded with it
+        self._buffers = [bytearray() for _ in range(buffer_frames)]
+        self._free = queue.SimpleQueue() # indices of ring slots the capturing side may fill
+        for slot in range(buffer_frames):
+            self._free.put(slot)
+        self._pending = queue.SimpleQueue() # (slot or None for a repeat, timestamp, width, height), None to stop
+
+        if format == "png":
+            os.makedirs(path, exist_ok=True)
+            self._file = open(os.path.join(path, "index.txt"), "w")
+        else:
+            self._file = open(path, "wb")
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+        self._last_name = None
+        self._thread = threading.Thread(target=self._write_frames, name="websurface-recorder", daemon=True)
+        self._thread.start()
+
+    def offer(self, frame, width, height, timestamp=None):
+        ''' Copies a BGRA frame of width*height*4 bytes into the ring buffer. Returns False if it was dropped
+        because the writer is behind (or has failed) '''
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+        if self.error is not None:
+            self._free.put(slot)
+            self.dropped += 1
+            return False
+        size = width * height * 4
+        buffer = self._buffers[slot]
+        if len(buffer) < size:
+            buffer = self._buffers[slot] = bytearray(size)
+        buffer[:size] = frame[:size]
+        self._pending.put((slot, (timestamp or perf_counter()) - self.start, width, height))
+        self.captured += 1
+        self._last_size = (width, height)
+        return True
+
+    def repeat(self, timestamp=None):
+        ''' Records that the last offered frame is still what is shown, without copying it '''
+        if self._last_size is None: # nothing to repeat yet
+            return
+        self._pending.put((None, (timestamp or perf_counter()) - self.start, *self._last_size))
+        self.repeated += 1
+
+    def stats(self):
+        return {"captured": self.captured, "dropped": self.dropped, "repeated": self.repeated, "written": self.written,
+                "error": self.error}
+
+    def close(self):
+        ''' Writes the frames still in the ring buffer, then closes the output. Blocks until that is done. '''
+        if self._thread is None:
+            return
+        self._pending.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    def _write_frames(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            slot, timestamp, width, height = item
+            try:
+                if self.error is None:
+                    self._write(slot, timestamp, width, height)
+                    if slot is not None:
+                        self.written += 1
+            except Exception as err: # e.g. a full disk: stop writing, the capturing side drops everything from now on
+                self.error = f"{type(err).__name__}: {err}"
+                log.warning("Recording to %s failed: %s", self.path, self.error)
+            if slot is not None:
+                self._free.put(slot)
+
+    def _write(self, slot, timestamp, width, height):
+        if self.format == "png":
+            if slot is not None:
+                self._last_name = f"frame_{self.written:06d}.png"
+                with open(os.path.join(self.path, self._last_name), "wb") as f:
+                    f.write(encode_png(self._buffers[slot], width, height, self.level))
+            self._file.write(f"{timestamp:.6f} {self._last_name}\n")
+            return
+        if slot is None:
+            self._file.write(RECORD.pack(timestamp, width, height, KIND_REPEAT, 0))
+            return
+        data = memoryview(self._buffers[slot])[:width * height * 4]
+        if self.format == "zlib":
+            data = zlib.compress(data, self.level)
+        self._file.write(RECORD.pack(timestamp, width, height, KIND_ZLIB if self.format == "zlib" else KIND_RAW, len(data)))
+        self._file.write(data)
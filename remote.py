@@ -0,0 +1,530 @@
+''' Out-of-process rendering: each RemoteWorker runs its own Ultralight renderer in a separate process, so heavy
+surfaces spread over several cores and a crashing page only takes down its worker.
+
+Frames travel through one multiprocessing.shared_memory block per surface, laid out as a header followed by three
+slots used as a triple buffer, each a packed dirty rectangle plus a full copy of the frame (like the native staging
+slots). The worker packs each frame's dirty rectangle into a free slot, brings that slot's full frame up to date and
+publishes it; WebSurface.update takes the newest published slot and uploads straight from the shared memory. Commands and input
+go over a Pipe: small pickled tuples, input as raw InputEvent bytes, once per tick. Script results and page messages
+come back over a second Pipe, one message per frame that has any.
+
+Nothing in here imports Kivy. WebSurface.start_worker_processes() sets this up for widgets. '''
+import logging
+import multiprocessing
+import time
+from ctypes import addressof, sizeof, string_at
+from multiprocessing import shared_memory
+
+from core import InputEvent, InputQueue
+
+log = logging.getLogger(__name__)
+
+# Header layout, int32 fields
+PUBLISHED = 0  # slot of the newest published frame, -1 before the first one
+READING = 1    # slot the parent is uploading from, never written by the worker
+CONSUMED = 2   # 1 once the parent has taken the published frame
+NEED_FULL = 3  # set by the parent: publish the whole surface next
+WIDTH = 4
+HEIGHT = 5
+FRAMES = 6     # frames published so far
+FOCUSED = 7    # the view's HasFocus(), refreshed every frame
+LOADING = 8    # the view's is_loading(), refreshed every frame
+LOAD_SEQ = 9   # load events written so far
+RECTS = 12     # x, y, w, h of the frame in each slot, 4 fields per slot
+LOAD_EVENTS = 32 # ring of the last LOAD_RING_SIZE load events, (type, error_code) each
+LOAD_RING_SIZE = 16
+HEADER_FIELDS = 64
+HEADER_SIZE = HEADER_FIELDS * 4
+SLOTS = 3
+
+
+def frames_size(width, height):
+    return HEADER_SIZE + 2 * SLOTS * width * height * 4 # packed rects, then full frames
+
+
+def _union(a, b):
+    if not a[2] or not a[3]:
+        return b
+    if not b[2] or not b[3]:
+        return a
+    x, y = min(a[0], b[0]), min(a[1], b[1])
+    return x, y, max(a[0] + a[2], b[0] + b[2]) - x, max(a[1] + a[3], b[1] + b[3]) - y
+
+
+class SharedFrames:
+    ''' One surface's shared memory, seen from either side '''
+
+    def __init__(self, shm, width, height):
+        self.shm = shm
+        self.width, self.height = width, height
+        self.header = shm.buf[:HEADER_SIZE].cast('i')
+        self.slot_size = width * height * 4
+        self.load_seen = 0 # parent side: load events already read
+
+    def slot(self, index):
+        ''' The packed rect of a slot '''
+        start = HEADER_SIZE + index * self.slot_size
+        return self.shm.buf[start:start + self.slot_size]
+
+    def frame(self, index):
+        ''' The full frame of a slot, stride width * 4 '''
+        start = HEADER_SIZE + (SLOTS + index) * self.slot_size
+        return self.shm.buf[start:start + self.slot_size]
+
+    def rect(self, index):
+        h = self.header
+        base = RECTS + 4 * index
+        return h[base], h[base + 1], h[base + 2], h[base + 3]
+
+    def push_load_event(self, type, error_code, lock):
+        header = self.header
+        with lock:
+            seq = header[LOAD_SEQ]
+            base = LOAD_EVENTS + 2 * (seq % LOAD_RING_SIZE)
+            header[base], header[base + 1] = type, error_code
+            header[LOAD_SEQ] = seq + 1
+
+    def read_load_events(self, lock):
+        ''' (type, error_code) of the load events written since the last call '''
+        header = self.header
+        if header[LOAD_SEQ] == self.load_seen:
+            return []
+        with lock:
+            seq = header[LOAD_SEQ]
+            start = max(self.load_seen, seq - LOAD_RING_SIZE) # anything older has been overwritten
+            bases = [LOAD_EVENTS + 2 * (i % LOAD_RING_SIZE) for i in range(start, seq)]
+            events = [(header[base], header[base + 1]) for base in bases]
+        self.load_seen = seq
+        return events
+
+    def release(self):
+        ''' Drops our own views; returns False while someone else still holds one '''
+        self.header.release()
+        try:
+            self.shm.close()
+            return True
+        except BufferError:
+            return False
+
+
+## { Worker process
+class _WorkerSurface:
+    def __init__(self, lib, binding, wrap_staging_buffer, handle, frames):
+        self.lib, self.binding, self.handle, self.frames = lib, binding, handle, frames
+        self.wrap = wrap_staging_buffer
+        self.rewrap()
+
+    def rewrap(self):
+        slots = range(self.lib.getStagingSlotCount(self.handle))
+        self.native_frames = [self.wrap(self.handle, slot, frame=True) for slot in slots]
+        self.native_patches = [self.wrap(self.handle, slot) for slot in slots]
+        # Per shared slot, the part of its full frame that is out of date: what was published through the other slots
+        # since it was last written. None until it has been filled once
+        self.stale = [None] * SLOTS
+
+    def publish(self, lock):
+        frames, header = self.frames, self.frames.header
+        header[FOCUSED] = int(self.binding.is_focused(self.handle))
+        header[LOADING] = int(self.lib.isLoading(self.handle))
+        full = header[NEED_FULL] != 0
+        slot, x, y, w, h = self.binding.stage_surface_pixels(self.handle, full)
+        if slot < 0:
+            return
+        if full:
+            header[NEED_FULL] = 0
+
+        with lock:
+            published, reading = header[PUBLISHED], header[READING]
+            unconsumed = published >= 0 and not header[CONSUMED]
+            back = next(i for i in range(SLOTS) if i != published and i != reading)
+        packed = self.native_patches[slot]
+        if unconsumed:
+            # The parent never saw the previous frame, so its rect has to come along with this one
+            px, py, pw, ph = frames.rect(published)
+            if pw and ph:
+                right, bottom = max(x + w, px + pw), max(y + h, py + ph)
+                x, y = min(x, px), min(y, py)
+                w, h = right - x, bottom - y
+                packed = None
+
+        target = frames.slot(back)
+        if packed is not None:
+            target[:w * h * 4] = packed[:w * h * 4]
+        else:
+            # Repack the rect from the full native frame
+            source, stride, row = self.native_frames[slot], frames.width * 4, w * 4
+            for r in range(h):
+                start = (y + r) * stride + x * 4
+                target[r * row:(r + 1) * row] = source[start:start + row]
+        target.release()
+
+        # Bring the slot's full frame up to date from the native one
+        stale = self.stale[back]
+        sx, sy, sw, sh = (0, 0, frames.width, frames.height) if stale is None else _union(stale, (x, y, w, h))
+        source, target, stride = self.native_frames[slot], frames.frame(back), frames.width * 4
+        if sw == frames.width:
+            target[sy * stride:(sy + sh) * stride] = source[sy * stride:(sy + sh) * stride]
+        else:
+            for start in range(sy * stride + sx * 4, (sy + sh) * stride, stride):
+                target[start:start + sw * 4] = source[start:start + sw * 4]
+        target.release()
+        for other in range(SLOTS):
+            if other != back and self.stale[other] is not None:
+                self.stale[other] = _union(self.stale[other], (x, y, w, h))
+        self.stale[back] = (0, 0, 0, 0)
+
+        with lock:
+            base = RECTS + 4 * back
+            header[base], header[base + 1], header[base + 2], header[base + 3] = x, y, w, h
+            header[PUBLISHED] = back
+            header[CONSUMED] = 0
+            header[FRAMES] += 1
+
+
+def _worker_main(conn, messages, lock, fps):
+    from core import lib, binding, wrap_staging_buffer, poll_load_events, poll_script_messages
+
+    def attach(name, width, height):
+        return SharedFrames(shared_memory.SharedMemory(name=name), width, height)
+
+    surfaces = {}
+    period = 1 / max(fps, 1)
+    next_frame = time.monotonic()
+    running = True
+    while running:
+        # Commands until the next frame is due
+        timeout = max(0.0, next_frame - time.monotonic())
+        while running and conn.poll(timeout):
+            timeout = 0.0
+            try:
+                message = conn.recv()
+            except EOFError:
+                running = False # the parent is gone
+                break
+            command, args = message[0], message[1:]
+            if command == "input":
+                data = args[0]
+                count = len(data) // sizeof(InputEvent)
+                lib.dispatchInputEvents((InputEvent * count).from_buffer_copy(data), count)
+            elif command == "create":
+                width, height, html, name = args
+                handle = lib.initWebSurface(width, height, html)
+                if handle >= 0:
+                    surfaces[handle] = _WorkerSurface(lib, binding, wrap_staging_buffer, handle, attach(name, width, height))
+                conn.send(handle)
+            elif command == "resize":
+                handle, width, height, name = args
+                surface = surfaces.get(handle)
+                ok = surface is not None and lib.resizeSurface(handle, width, height)
+                if ok:
+                    surface.frames.release()
+                    surface.frames = attach(name, width, height)
+                    surface.rewrap()
+                conn.send(ok)
+            elif command == "destroy":
+                surface = surfaces.pop(args[0], None)
+                if surface is not None:
+                    lib.destroySurface(args[0])
+                    surface.frames.release()
+                conn.send(True)
+            elif command == "load_url":
+                lib.loadURL(args[0], args[1])
+            elif command == "load_html":
+                lib.loadHTML(args[0], args[1])
+            elif command == "eval":
+                lib.evaluateScript(args[0], args[1], args[2])
+            elif command == "focus":
+                lib.focusView(args[0])
+            elif command == "visible":
+                lib.setSurfaceVisible(args[0], args[1])
+            elif command == "background":
+                lib.setSurfaceBackgroundInterval(args[0], args[1])
+            elif command == "scale":
+                lib.setSurfaceScale(args[0], args[1])
+            elif command == "quit":
+                running = False
+        if not running:
+            break
+
+        binding.render()
+        for surface in surfaces.values():
+            surface.publish(lock)
+        for handle, type, url, error_code, description in poll_load_events():
+            surface = surfaces.get(handle)
+            if surface is not None:
+                surface.frames.push_load_event(type, error_code, lock)
+        script_messages = poll_script_messages()
+        if script_messages:
+            messages.send(script_messages) # all of this frame's results and page messages in one go
+
+        next_frame += period
+        now = time.monotonic()
+        if next_frame < now:
+            next_frame = now # running behind, don't try to catch up with a burst of frames
+
+    for surface in surfaces.values():
+        surface.frames.release()
+    lib.destroyRenderer()
+## }
+
+
+## { Parent process
+class _RemoteLibrary:
+    ''' The subset of the native library a WebSurface uses, forwarded to a worker '''
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    def initWebSurface(self, width, height, html):
+        return self._worker.create_surface(width, height, html)
+
+    def resizeSurface(self, handle, width, height):
+        return self._worker.resize_surface(handle, width, height)
+
+    def destroySurface(self, handle):
+        self._worker.destroy_surface(handle)
+
+    def loadURL(self, handle, url):
+        self._worker.send("load_url", handle, url)
+        return True
+
+    def loadHTML(self, handle, html):
+        self._worker.send("load_html", handle, html)
+        return True
+
+    def evaluateScript(self, handle, script, request_id):
+        if handle not in self._worker.frames:
+            return False
+        self._worker.send("eval", handle, script, request_id)
+        return True
+
+    def focusView(self, handle):
+        self._worker.send("focus", handle)
+
+    def setSurfaceVisible(self, handle, visible):
+        self._worker.send("visible", handle, bool(visible))
+
+    def setSurfaceBackgroundInterval(self, handle, frames):
+        self._worker.send("background", handle, frames)
+
+    def setSurfaceScale(self, handle, scale):
+        self._worker.send("scale", handle, scale)
+
+    def isLoading(self, handle):
+        frames = self._worker.frames.get(handle)
+        return frames is not None and bool(frames.header[LOADING])
+
+    def getStagingSlotCount(self, handle):
+        return SLOTS if handle in self._worker.frames else 0
+
+
+class _RemoteBinding:
+    ''' The per-frame calls, answered from the shared memory without talking to the worker '''
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    def render(self):
+        ''' The worker renders by itself; reports whether any surface has a frame waiting, like renderWebSurface() '''
+        worker = self._worker
+        worker.check()
+        return any(frames.header[PUBLISHED] >= 0 and not frames.header[CONSUMED] for frames in worker.frames.values())
+
+    def is_focused(self, handle):
+        frames = self._worker.frames.get(handle)
+        return frames is not None and bool(frames.header[FOCUSED])
+
+    def stage_surface_pixels(self, handle, full):
+        frames = self._worker.frames.get(handle)
+        if frames is None:
+            return -1, 0, 0, 0, 0
+        header = frames.header
+        if full and not header[NEED_FULL]:
+            header[NEED_FULL] = 1
+        with self._worker.lock:
+            if header[PUBLISHED] < 0 or header[CONSUMED]:
+                return -1, 0, 0, 0, 0
+            slot = header[PUBLISHED]
+            header[READING] = slot
+            header[CONSUMED] = 1
+        x, y, w, h = frames.rect(slot)
+        if full and (w, h) != (frames.width, frames.height):
+            return -1, 0, 0, 0, 0 # a partial frame is no use on a fresh texture; the full one is on its way
+        return slot, x, y, w, h
+
+
+class _PipeInputQueue(InputQueue):
+    def __init__(self, worker):
+        super().__init__()
+        self._worker = worker
+
+    def _new_events(self):
+        return (InputEvent * self.capacity)()
+
+    def _dispatch(self, events, count):
+        self._worker.send("input", string_at(addressof(events), count * sizeof(InputEvent)))
+
+
+class RemoteWorker:
+    ''' A renderer process. Has the same attributes as core.Backend, so a WebSurface can render through it.
+    If the process dies, its surfaces keep their last frame, the process is started again, and every callback in
+    `restart_callbacks` is called so the surfaces can recreate their views. '''
+
+    def __init__(self, fps=60):
+        self.fps = fps
+        self.lib = _RemoteLibrary(self)
+        self.binding = _RemoteBinding(self)
+        self.input_queue = _PipeInputQueue(self)
+        self.restart_callbacks = []
+        self._load_events = [] # read from frames that were replaced before anyone polled them
+        self.frames = {} # handle -> SharedFrames
+        self._shm = {}   # handle -> SharedMemory we created (and unlink)
+        self._retired = [] # SharedFrames still referenced by someone, closed once possible
+        self._start()
+
+    def _start(self):
+        context = multiprocessing.get_context("spawn")
+        self.conn, child = context.Pipe()
+        self.messages, child_messages = context.Pipe(duplex=False) # script results and page messages, worker -> parent
+        self.lock = context.Lock()
+        self.process = context.Process(target=_worker_main, args=(child, child_messages, self.lock, self.fps), daemon=True)
+        self.process.start()
+        child.close()
+        child_messages.close()
+        self.alive = True
+
+    def __len__(self):
+        return len(self.frames)
+
+    def send(self, *message):
+        if not self.alive:
+            return
+        try:
+            self.conn.send(message)
+        except (OSError, EOFError):
+            self._died()
+
+    def call(self, *message):
+        ''' Sends a command and waits for its reply; None if the worker died meanwhile '''
+        self.send(*message)
+        if not self.alive:
+            return None
+        try:
+            return self.conn.recv()
+        except (OSError, EOFError):
+            self._died()
+            return None
+
+    def check(self):
+        if self.alive and not self.process.is_alive():
+            self._died()
+        self._close_retired()
+
+    def _died(self):
+        if not self.alive:
+            return
+        self.alive = False
+        log.warning("Renderer process %s died (exit code %s), restarting it", self.process.pid, self.process.exitcode)
+        for handle in list(self.frames):
+            self._drop(handle)
+        self._start()
+        for callback in list(self.restart_callbacks):
+            callback()
+
+    def _new_frames(self, width, height):
+        shm = shared_memory.SharedMemory(create=True, size=frames_size(width, height))
+        frames = SharedFrames(shm, width, height)
+        header = frames.header
+        header[PUBLISHED] = header[READING] = -1
+        header[CONSUMED] = header[NEED_FULL] = 1
+        header[WIDTH], header[HEIGHT] = width, height
+        return shm, frames
+
+    def _drop(self, handle):
+        frames = self.frames.pop(handle, None)
+        shm = self._shm.pop(handle, None)
+        if shm is not None:
+            shm.unlink() # the mapping itself stays valid until every view of it is gone
+        if frames is not None and not frames.release():
+            self._retired.append(frames)
+
+    def _close_retired(self):
+        if self._retired:
+            self._retired = [frames for frames in self._retired if not frames.release()]
+
+    def create_surface(self, width, height, html):
+        shm, frames = self._new_frames(width, height)
+        handle = self.call("create", width, height, html, shm.name)
+        if handle is None or handle < 0:
+            frames.release()
+            shm.unlink()
+            return -1
+        self.frames[handle], self._shm[handle] = frames, shm
+        return handle
+
+    def resize_surface(self, handle, width, height):
+        if handle not in self.frames:
+            return False
+        shm, frames = self._new_frames(width, height)
+        if not self.call("resize", handle, width, height, shm.name):
+            frames.release()
+            shm.unlink()
+            return False
+        self._load_events += [(handle, type, "", error_code, "") for type, error_code in self.frames[handle].read_load_events(self.lock)]
+        self._drop(handle) # the caller re-wraps its views right after, then the old block can go
+        self.frames[handle], self._shm[handle] = frames, shm
+        return True
+
+    def destroy_surface(self, handle):
+        if handle in self.frames:
+            self.call("destroy", handle)
+            self._drop(handle)
+
+    def poll_load_events(self):
+        ''' Like core.poll_load_events(), read from the surfaces' headers. Only types and error codes cross over,
+        url and description are empty. '''
+        events, self._load_events = self._load_events, []
+        for handle, frames in self.frames.items():
+            events += [(handle, type, "", error_code, "") for type, error_code in frames.read_load_events(self.lock)]
+        return events
+
+    def poll_script_messages(self):
+        ''' Like core.poll_script_messages(), as sent by the worker after each frame '''
+        result = []
+        try:
+            while self.messages.poll():
+                result += self.messages.recv()
+        except (OSError, EOFError):
+            pass # died; check() restarts it
+        return result
+
+    def wrap_staging_buffer(self, handle, slot, frame=False):
+        ''' The packed rect of a shared slot, or with `frame` its full frame, like core.wrap_staging_buffer() '''
+        frames = self.frames.get(handle)
+        if frames is None:
+            return None
+        return frames.frame(slot) if frame else frames.slot(slot)
+
+    def close(self):
+        for handle in list(self.frames):
+            self.destroy_surface(handle)
+        self.send("quit")
+        self.process.join(5)
+        self.alive = False
+        self._close_retired()
+
+
+class WorkerPool:
+    ''' `count` renderer processes; each new surface goes to the one with the fewest surfaces '''
+
+    def __init__(self, count=None, fps=60):
+        count = count or multiprocessing.cpu_count()
+        self.workers = [RemoteWorker(fps) for _ in range(count)]
+
+    def assign(self):
+        return min(self.workers, key=len)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+## }
@@ -0,0 +1,140 @@
+''' Frame timing and counters: rolling percentiles over the native renderer and per-surface counters,
+and optional per-frame hooks (e.g. a Chrome trace file) for finding out where a janky frame went. '''
+import json
+import os
+import threading
+from collections import deque
+from ctypes import byref, c_float, c_uint64
+
+from core import lib, SurfaceStats
+import memory
+
+WINDOW = 256 # samples kept per rolling window, matches the native frame time history
+
+
+def percentiles(samples):
+    ''' p50/p95/p99/max/mean of an iterable of numbers, or just the count (0) when it's empty '''
+    ordered = sorted(samples)
+    n = len(ordered)
+    if not n:
+        return {"count": 0}
+    pick = lambda p: ordered[min(n - 1, int(p * n))]
+    return {"count": n, "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1], "mean": sum(ordered) / n}
+
+
+class RollingWindow:
+    ''' The last `size` samples of something, with percentiles computed only when asked for '''
+
+    def __init__(self, size=WINDOW):
+        self._samples = deque(maxlen=size)
+        self.add = self._samples.append
+
+    def percentiles(self):
+        return percentiles(self._samples)
+
+    def clear(self):
+        self._samples.clear()
+
+
+# Duration of each FrameScheduler tick (input flush + renderer frame + uploads), filled by websurface.py
+tick_times = RollingWindow()
+
+_update_buffer = (c_float * WINDOW)()
+_render_buffer = (c_float * WINDOW)()
+
+
+def renderer_stats():
+    ''' Rolling percentiles (milliseconds) of the renderer's Update and Render calls over the last frames,
+    the total number of frames rendered, the scheduler tick times and the memory purge/eviction totals. '''
+    frames = c_uint64()
+    count = lib.getRendererFrameTimes(_update_buffer, _render_buffer, WINDOW, byref(frames))
+    return {
+        "frames": frames.value,
+        "update_ms": percentiles(_update_buffer[:count]),
+        "render_ms": percentiles(_render_buffer[:count]),
+        "tick_ms": tick_times.percentiles(),
+        "memory": dict(memory.counters),
+    }
+
+
+def last_frame_times():
+    ''' (update_ms, render_ms, frames) of the most recent renderer frame '''
+    frames = c_uint64()
+    if lib.getRendererFrameTimes(_update_buffer, _render_buffer, 1, byref(frames)):
+        return _update_buffer[0], _render_buffer[0], frames.value
+    return 0.0, 0.0, frames.value
+
+
+def surface_counters(surface_id):
+    ''' The native counters of a surface as a dict, or None for an invalid surface '''
+    stats = SurfaceStats()
+    if not lib.getSurfaceStats(surface_id, byref(stats)):
+        return None
+    return {name: getattr(stats, name) for name, _ in SurfaceStats._fields_}
+
+
+## { Per-frame hooks
+# Each hook is called with one record per event: a dict with "name", "surface" (handle or None),
+# "start" (time.perf_counter() seconds), "duration" (seconds) and event specific fields.
+# Nothing is built while the list is empty.
+frame_hooks = []
+
+def add_frame_hook(hook):
+    frame_hooks.append(hook)
+
+def remove_frame_hook(hook):
+    if hook in frame_hooks:
+        frame_hooks.remove(hook)
+
+def emit(record):
+    for hook in frame_hooks:
+        hook(record)
+## }
+
+
+class ChromeTrace:
+    ''' A frame hook that writes records in Chrome trace-event format (JSON array of complete "X" events),
+    which chrome://tracing and Perfetto open directly. Usable as a context manager:
+
+        with ChromeTrace("frames.json") as trace:
+            add_frame_hook(trace)
+            ...
+            remove_frame_hook(trace)
+    '''
+
+    def __init__(self, path):
+        self._file = open(path, "w")
+        self._file.write("[\n")
+        self._first = True
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        args = {k: v for k, v in record.items() if k not in ("name", "surface", "start", "duration")}
+        event = {
+            "name": record["name"],
+            "ph": "X",
+            "ts": record["start"] * 1e6,
+            "dur": record["duration"] * 1e6,
+            "pid": self._pid,
+            # One track per surface, renderer-wide events on track 0
+            "tid": record["surface"] if record.get("surface") is not None else 0,
+            "args": args,
+        }
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(("" if self._first else ",\n") + json.dumps(event))
+            self._first = False
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.write("\n]\n")
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
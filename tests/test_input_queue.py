@@ -0,0 +1,107 @@
+''' core.InputQueue coalescing: merged mouse moves and scrolls, text split into UTF-8 chunks. Pure Python, the native
+library isn't loaded. '''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import core
+from core import INPUT_CHAR, INPUT_KEY_DOWN, INPUT_MOUSE_DOWN, INPUT_MOUSE_MOVE, INPUT_MOUSE_UP, INPUT_SCROLL
+
+
+class RecordingQueue(core.InputQueue):
+    ''' Keeps what would be dispatched as (surface, type, x, y, button, keycode, modifiers, text) tuples '''
+    def __init__(self, capacity=None):
+        super().__init__()
+        if capacity is not None:
+            self.capacity = capacity
+        self.batches = []
+
+    def _new_events(self):
+        return (core.InputEvent * self.capacity)()
+
+    def _dispatch(self, events, count):
+        self.batches.append([(ev.surface_id, ev.type, ev.x, ev.y, ev.button, ev.keycode, ev.modifiers, ev.text)
+                             for ev in events[:count]])
+
+    def events(self):
+        self.flush()
+        return [event for batch in self.batches for event in batch]
+
+
+def test_merges_consecutive_moves_with_the_same_button():
+    queue = RecordingQueue()
+    for x in range(5):
+        queue.mouse(1, INPUT_MOUSE_MOVE, x, 2 * x, 0)
+    assert len(queue) == 1
+    assert queue.events() == [(1, INPUT_MOUSE_MOVE, 4, 8, 0, 0, 0, b"")]
+
+
+def test_keeps_moves_apart_across_buttons_surfaces_and_other_events():
+    queue = RecordingQueue()
+    queue.mouse(1, INPUT_MOUSE_MOVE, 1, 1, 0)
+    queue.mouse(1, INPUT_MOUSE_MOVE, 2, 2, 1)   # dragging now
+    queue.mouse(2, INPUT_MOUSE_MOVE, 3, 3, 1)   # another surface
+    queue.mouse(1, INPUT_MOUSE_MOVE, 4, 4, 1)   # back to the first one: not merged over surface 2
+    queue.mouse(1, INPUT_MOUSE_UP, 4, 4, 1)
+    queue.mouse(1, INPUT_MOUSE_MOVE, 5, 5, 1)   # not merged into the button release
+    assert [(ev[0], ev[1], ev[2], ev[4]) for ev in queue.events()] == [
+        (1, INPUT_MOUSE_MOVE, 1, 0), (1, INPUT_MOUSE_MOVE, 2, 1), (2, INPUT_MOUSE_MOVE, 3, 1),
+        (1, INPUT_MOUSE_MOVE, 4, 1), (1, INPUT_MOUSE_UP, 4, 1), (1, INPUT_MOUSE_MOVE, 5, 1)]
+
+
+def test_never_merges_button_presses():
+    queue = RecordingQueue()
+    queue.mouse(1, INPUT_MOUSE_DOWN, 1, 1, 1)
+    queue.mouse(1, INPUT_MOUSE_DOWN, 1, 1, 1)
+    assert len(queue.events()) == 2
+
+
+def test_sums_consecutive_scrolls_per_surface():
+    queue = RecordingQueue()
+    queue.scroll(1, 0, -40)
+    queue.scroll(1, 10, -40)
+    queue.scroll(1, -5, 20)
+    queue.scroll(2, 0, 7)
+    queue.scroll(2, 0, 7)
+    queue.scroll(1, 0, 1)                      # surface 2 came in between
+    queue.key(1, INPUT_KEY_DOWN, 40, 0)
+    queue.scroll(1, 0, 1)                      # a key event came in between
+    assert [(ev[0], ev[1], ev[2], ev[3]) for ev in queue.events()] == [
+        (1, INPUT_SCROLL, 5, -60), (2, INPUT_SCROLL, 0, 14), (1, INPUT_SCROLL, 0, 1),
+        (1, INPUT_KEY_DOWN, 0, 0), (1, INPUT_SCROLL, 0, 1)]
+
+
+def test_does_not_merge_into_flushed_events():
+    queue = RecordingQueue()
+    queue.scroll(1, 0, 10)
+    queue.flush()
+    queue.scroll(1, 0, 10)
+    assert [[ev[3] for ev in batch] for batch in queue.batches] == [[10]]
+    queue.flush()
+    assert [[ev[3] for ev in batch] for batch in queue.batches] == [[10], [10]]
+
+
+def test_splits_text_into_utf8_chunks():
+    queue = RecordingQueue()
+    queue.char(1, "abcdefghijklmnopqrst")
+    queue.char(1, "ééééé")                     # 2 bytes each: 6 + 4, never 7 + 3
+    queue.char(1, "a\U0001F600\U0001F600")     # 1 + 4 + 4 bytes
+    queue.char(1, "日本".encode("utf8"))        # bytes are taken as they are
+    queue.char(1, "")
+    texts = [ev[7] for ev in queue.events()]
+    assert all(ev_type == INPUT_CHAR for ev_type in (ev[1] for ev in queue.events()))
+    assert texts == [b"abcdefg", b"hijklmn", b"opqrst", "ééé".encode(), "éé".encode(), "a\U0001F600".encode(),
+                     "\U0001F600".encode(), "日本".encode()]
+    assert all(len(text) <= 7 for text in texts)
+    assert b"".join(texts).decode("utf8") == "abcdefghijklmnopqrstééééé" + "a\U0001F600\U0001F600" + "日本"
+
+
+def test_flushes_early_when_full():
+    queue = RecordingQueue(capacity=4)
+    for keycode in range(6):
+        queue.key(3, INPUT_KEY_DOWN, keycode, core.MOD_SHIFT)
+    assert [len(batch) for batch in queue.batches] == [4]
+    assert len(queue) == 2
+    queue.flush()
+    assert [ev[5] for batch in queue.batches for ev in batch] == list(range(6))
+    assert all(ev[6] == core.MOD_SHIFT for batch in queue.batches for ev in batch)
@@ -0,0 +1,37 @@
+''' The Kivy -> Ultralight key translation, checked against the per-call mapping it replaced. Pure Python. '''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import core
+
+
+def old_kivy_to_ultralight_vk(keycode):
+    ''' The translation as it was before the lookup table, kept to check the table against '''
+    if 32 <= keycode <= 126:
+        return keycode
+    mapping = {
+        27: 0x1B, 278: 0x24, 279: 0x23, 281: 0x22, 280: 0x21, 277: 0x2D, 8: 0x08, 9: 0x09, 13: 0x0D,
+        273: 0x26, 274: 0x28, 275: 0x27, 276: 0x25,
+        303: 0xA0, 304: 0xA1, 307: 0xA5, 308: 0xA4, 305: 0xA2, 306: 0xA3, 301: 0x14,
+    }
+    if 282 <= keycode <= 293:
+        return 0x70 + (keycode - 282)
+    return mapping.get(keycode, 0)
+
+
+OLD_NON_PRINTABLE_KEYCODES = [27, 9, 277, 279, 278, 127, 8, 13, 303, 304, 305, 273, 275, 274, 276, 306, 280, 281, 307,
+                              308, 301] + list(range(282, 294))
+
+
+def test_vk_table_matches_the_old_mapping():
+    # Everything Kivy reports: the SDL keycodes below 512, and the large ones of keys SDL has no ASCII code for
+    keycodes = list(range(-16, 1100)) + [1 << 30 | code for code in range(0, 300)] + [2 ** 31 - 1]
+    for keycode in keycodes:
+        assert core.kivy_to_ultralight_vk(keycode) == old_kivy_to_ultralight_vk(keycode), keycode
+
+
+def test_non_printable_keycodes_unchanged():
+    assert core.non_printable_keycodes == frozenset(OLD_NON_PRINTABLE_KEYCODES)
+    assert all((keycode in core.non_printable_keycodes) == (keycode in OLD_NON_PRINTABLE_KEYCODES)
+               for keycode in range(-16, 1100))
@@ -0,0 +1,95 @@
+''' Round trip of pack_assets.py bundles: packed files come back out of pack_assets.parse_index() unchanged, and the
+library's parser (AssetBundle::parseIndex in websurface.cpp) accepts and rejects the same bundles. The native part is
+skipped when libwebsurface.so isn't built. '''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pack_assets
+
+FILES = {
+    "index.html": b"<html><body><h1>Hello</h1><script src='js/app.js'></script></body></html>",
+    "js/app.js": b"document.title = 'packed';\n",
+    "css/style.css": b"body { margin: 0 }\n",
+    "img/dot.png": bytes(range(256)) * 3,
+    "empty.txt": b"",
+    "café/menu.json": b'{"items": []}',
+    ".hidden": b"left out",
+}
+
+
+def pack(tmp_path, prefix=""):
+    site = tmp_path / "site"
+    for path, data in FILES.items():
+        (site / path).parent.mkdir(parents=True, exist_ok=True)
+        (site / path).write_bytes(data)
+    entries = []
+    for path, file_path in pack_assets.collect(str(site), prefix).items():
+        with open(file_path, "rb") as f:
+            entries.append((path, pack_assets.mimetypes.guess_type(path)[0] or "", f.read()))
+    output = str(tmp_path / "site.bundle")
+    pack_assets.write_bundle(output, entries)
+    return output
+
+
+def native_library():
+    import core
+    try:
+        core.lib.mountAssetBundle
+    except (OSError, AttributeError) as err:
+        pytest.skip(f"libwebsurface.so isn't available: {err}")
+    return core
+
+
+def test_layout_matches_native_parser():
+    # AssetBundle::parseIndex reads fields at these offsets
+    assert pack_assets.HEADER.size == 24
+    assert pack_assets.ENTRY.size == 32
+
+
+@pytest.mark.parametrize("prefix", ["", "app"])
+def test_round_trip(tmp_path, prefix):
+    output = pack(tmp_path, prefix)
+    with open(output, "rb") as f:
+        data = f.read()
+    entries = pack_assets.parse_index(data)
+    expected = {(f"{prefix}/{path}" if prefix else path): content for path, content in FILES.items()
+                if not path.startswith(".")}
+    assert entries.keys() == expected.keys()
+    for path, (mime, offset, size, hash) in entries.items():
+        assert offset % pack_assets.ALIGN == 0
+        assert data[offset:offset + size] == expected[path]
+        assert hash == pack_assets.content_hash(expected[path])
+        assert mime == (pack_assets.mimetypes.guess_type(path)[0] or "")
+    assert pack_assets.read_index(output) == {path: entry[3] for path, entry in entries.items()}
+
+
+def test_rejects_damaged_bundles(tmp_path):
+    output = pack(tmp_path)
+    with open(output, "rb") as f:
+        data = f.read()
+    assert pack_assets.parse_index(data[:-1]) is None # the last file runs past the end
+    assert pack_assets.parse_index(data[:pack_assets.HEADER.size + 8]) is None # index cut off
+    assert pack_assets.parse_index(b"WSBUNDLX" + data[8:]) is None
+    assert pack_assets.parse_index(b"") is None
+    (tmp_path / "empty.bundle").write_bytes(b"")
+    assert pack_assets.read_index(str(tmp_path / "empty.bundle")) is None
+
+
+def test_native_parser_agrees(tmp_path):
+    core = native_library()
+    output = pack(tmp_path)
+    with open(output, "rb") as f:
+        data = f.read()
+    damaged = {"truncated": data[:-1], "index": data[:pack_assets.HEADER.size + 8], "magic": b"WSBUNDLX" + data[8:]}
+    try:
+        assert core.mount_bundle(output)
+        for name, content in damaged.items():
+            path = tmp_path / f"{name}.bundle"
+            path.write_bytes(content)
+            assert pack_assets.parse_index(content) is None
+            assert not core.mount_bundle(str(path)), name
+    finally:
+        core.mount_bundle(None)
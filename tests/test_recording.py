@@ -0,0 +1,119 @@
+''' Round trip of recording.Recorder archives through read_frames(), and of PNG frames through zlib: repeats, frames
+dropped while the writer is behind, and the stats counters. Needs neither Kivy nor the native library. '''
+import os
+import struct
+import sys
+import threading
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import recording
+
+
+def frame(width, height, seed):
+    return bytes((seed + i) % 251 for i in range(width * height * 4))
+
+
+def hold_writer(recorder):
+    ''' Makes the writer thread wait in _write() until the returned event is set, so the ring fills up '''
+    gate = threading.Event()
+    write = recorder._write
+    def held(*args):
+        gate.wait(5)
+        write(*args)
+    recorder._write = held
+    return gate
+
+
+def decode_png(data):
+    assert data.startswith(recording.PNG_SIGNATURE)
+    at, chunks = len(recording.PNG_SIGNATURE), {}
+    while at < len(data):
+        length, = struct.unpack_from(">I", data, at)
+        type, body = data[at + 4:at + 8], data[at + 8:at + 8 + length]
+        crc, = struct.unpack_from(">I", data, at + 8 + length)
+        assert crc == zlib.crc32(type + body)
+        chunks[type] = chunks.get(type, b"") + body
+        at += 12 + length
+    width, height, depth, color, _, _, _ = struct.unpack(">IIBBBBB", chunks[b"IHDR"])
+    assert (depth, color) == (8, 6)
+    rows, stride = zlib.decompress(chunks[b"IDAT"]), width * 4
+    assert all(rows[y * (stride + 1)] == 0 for y in range(height)) # filter type none
+    return width, height, b"".join(rows[y * (stride + 1) + 1:(y + 1) * (stride + 1)] for y in range(height))
+
+
+@pytest.mark.parametrize("format", ["raw", "zlib"])
+def test_archive_round_trip(tmp_path, format):
+    path = str(tmp_path / f"frames.{format}")
+    recorder = recording.Recorder(path, format)
+    first, second = frame(16, 8, 0), frame(4, 2, 7)
+    recorder.repeat(0.5) # nothing to repeat yet
+    assert recorder.offer(first, 16, 8, recorder.start + 1.0)
+    recorder.repeat(recorder.start + 1.5)
+    assert recorder.offer(second, 4, 2, recorder.start + 2.0)
+    recorder.repeat(recorder.start + 2.5)
+    recorder.close()
+
+    frames = list(recording.read_frames(path))
+    assert [(pytest.approx(t), w, h) for t, w, h, _ in frames] == [(1.0, 16, 8), (1.5, 16, 8), (2.0, 4, 2), (2.5, 4, 2)]
+    assert [data for _, _, _, data in frames] == [first, first, second, second]
+    assert recorder.stats() == {"captured": 2, "dropped": 0, "repeated": 2, "written": 2, "error": None}
+
+
+def test_png_round_trip(tmp_path):
+    path = str(tmp_path / "frames")
+    recorder = recording.Recorder(path, "png")
+    bgra = frame(5, 3, 3)
+    recorder.offer(bgra, 5, 3, recorder.start + 1.0)
+    recorder.repeat(recorder.start + 2.0)
+    recorder.close()
+
+    with open(os.path.join(path, "index.txt")) as f:
+        index = [line.split() for line in f]
+    assert index == [["1.000000", "frame_000000.png"], ["2.000000", "frame_000000.png"]]
+    with open(os.path.join(path, "frame_000000.png"), "rb") as f:
+        width, height, rgba = decode_png(f.read())
+    assert (width, height) == (5, 3)
+    expected = bytearray(bgra)
+    expected[0::4], expected[2::4] = bgra[2::4], bgra[0::4]
+    assert rgba == bytes(expected)
+
+
+def test_drops_frames_while_the_ring_is_full(tmp_path):
+    path = str(tmp_path / "frames.raw")
+    recorder = recording.Recorder(path, "raw", buffer_frames=2)
+    gate = hold_writer(recorder)
+    frames = [frame(4, 4, seed) for seed in range(4)]
+    accepted = [recorder.offer(data, 4, 4) for data in frames]
+    assert accepted == [True, True, False, False]
+    assert (recorder.captured, recorder.dropped) == (2, 2)
+    gate.set()
+    recorder.close()
+
+    assert [data for _, _, _, data in recording.read_frames(path)] == frames[:2]
+    assert recorder.stats() == {"captured": 2, "dropped": 2, "repeated": 0, "written": 2, "error": None}
+    assert recorder._free.qsize() == 2 # the slots were handed back
+
+
+def test_write_errors_stop_the_recording(tmp_path):
+    path = str(tmp_path / "frames.raw")
+    recorder = recording.Recorder(path, "raw", buffer_frames=1)
+    def fail(*args):
+        raise OSError("No space left on device")
+    recorder._write = fail
+    assert recorder.offer(frame(2, 2, 0), 2, 2)
+    recorder.close() # waits for the writer, which has failed by then
+    assert recorder.error == "OSError: No space left on device"
+    assert not recorder.offer(frame(2, 2, 0), 2, 2)
+    stats = recorder.stats()
+    assert (stats["captured"], stats["dropped"], stats["written"]) == (1, 1, 0)
+
+
+def test_rejects_unknown_formats_and_files(tmp_path):
+    with pytest.raises(ValueError):
+        recording.Recorder(str(tmp_path / "frames"), "gif")
+    (tmp_path / "other.bin").write_bytes(b"NOTFRAME" + bytes(8))
+    with pytest.raises(ValueError):
+        list(recording.read_frames(str(tmp_path / "other.bin")))
@@ -0,0 +1,95 @@
+''' stats.percentiles / RollingWindow edge cases and the trace-event JSON ChromeTrace writes. Pure Python, the native
+library isn't loaded. '''
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stats
+
+
+def test_percentiles_of_nothing():
+    assert stats.percentiles([]) == {"count": 0}
+    assert stats.percentiles(iter(())) == {"count": 0}
+    assert stats.RollingWindow().percentiles() == {"count": 0}
+
+
+def test_percentiles_of_a_single_sample():
+    assert stats.percentiles([4.5]) == {"count": 1, "p50": 4.5, "p95": 4.5, "p99": 4.5, "max": 4.5, "mean": 4.5}
+
+
+def test_percentiles_pick_samples():
+    result = stats.percentiles(reversed(range(1, 101)))  # any order, any iterable
+    assert result == {"count": 100, "p50": 51, "p95": 96, "p99": 100, "max": 100, "mean": 50.5}
+    two = stats.percentiles([1, 3])
+    assert (two["p50"], two["p99"], two["max"], two["mean"]) == (3, 3, 3, 2)
+
+
+def test_rolling_window_keeps_the_last_samples():
+    window = stats.RollingWindow(size=3)
+    for sample in (100, 1, 2, 3):
+        window.add(sample)
+    assert window.percentiles() == {"count": 3, "p50": 2, "p95": 3, "p99": 3, "max": 3, "mean": 2}
+    window.clear()
+    assert window.percentiles() == {"count": 0}
+    window.add(7)
+    assert window.percentiles()["max"] == 7
+
+
+def test_chrome_trace_writes_complete_events(tmp_path):
+    path = str(tmp_path / "trace.json")
+    with stats.ChromeTrace(path) as trace:
+        trace({"name": "tick", "surface": None, "start": 1.5, "duration": 0.004})
+        trace({"name": "upload", "surface": 3, "start": 1.501, "duration": 0.0005, "bytes": 4096, "rects": 2})
+    trace({"name": "late", "surface": None, "start": 2, "duration": 0}) # after close(): ignored
+    trace.close() # closing twice is fine
+
+    with open(path) as f:
+        events = json.load(f)
+    assert [event["name"] for event in events] == ["tick", "upload"]
+    tick, upload = events
+    assert tick["ph"] == upload["ph"] == "X"
+    assert tick["pid"] == upload["pid"] == os.getpid()
+    assert (tick["tid"], upload["tid"]) == (0, 3) # renderer-wide events on track 0, one track per surface
+    assert abs(tick["ts"] - 1.5e6) < 1e-6 and abs(tick["dur"] - 4000) < 1e-6 # microseconds
+    assert abs(upload["ts"] - 1.501e6) < 1e-3 and abs(upload["dur"] - 500) < 1e-6
+    assert tick["args"] == {}
+    assert upload["args"] == {"bytes": 4096, "rects": 2}
+
+
+def test_chrome_trace_without_events_is_valid_json(tmp_path):
+    path = str(tmp_path / "trace.json")
+    stats.ChromeTrace(path).close()
+    with open(path) as f:
+        assert json.load(f) == []
+
+
+def test_chrome_trace_from_several_threads(tmp_path):
+    path = str(tmp_path / "trace.json")
+    trace = stats.ChromeTrace(path)
+    def emit(surface):
+        for i in range(200):
+            trace({"name": "frame", "surface": surface, "start": i / 1000, "duration": 0.001})
+    threads = [threading.Thread(target=emit, args=(surface,)) for surface in range(1, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    trace.close()
+    with open(path) as f:
+        events = json.load(f)
+    assert len(events) == 800
+    assert sorted({event["tid"] for event in events}) == [1, 2, 3, 4]
+
+
+def test_frame_hooks_receive_emitted_records():
+    seen = []
+    stats.add_frame_hook(seen.append)
+    try:
+        stats.emit({"name": "tick"})
+    finally:
+        stats.remove_frame_hook(seen.append)
+    stats.remove_frame_hook(seen.append) # removing twice is fine
+    stats.emit({"name": "ignored"})
+    assert seen == [{"name": "tick"}]
@@ -1,6 +1,28 @@
 #include <AppCore/AppCore.h>
 #include <Ultralight/Ultralight.h>
+#include <JavaScriptCore/JavaScript.h>
+#include "websurface.h"
 #include <iostream>
+#include <vector>
+#include <deque>
+#include <string>
+#include <algorithm>
+#include <cstring>
+#include <cstdio>
+#include <cstdint>
+#include <memory>
+#include <thread>
+#include <atomic>
+#include <mutex>
+#include <functional>
+#include <future>
+#include <chrono>
+#include <list>
+#include <unordered_map>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
 
 #define print std::cout<<
 
@@ -12,99 +34,436 @@ static RefPtr<Renderer> g_renderer;
 // static RefPtr<View> g_view;
 static vector<RefPtr<View>> g_views;
 
-void initPlatform() {
-  Platform::instance().set_font_loader(GetPlatformFontLoader());
+// Python refers to views by handle: the slot index in g_views in the low 16 bits and the slot's
+// generation above it. Destroying a view bumps its slot's generation and puts the slot on the free
+// list, so a stale handle can never reach the view that reuses the slot.
+static vector<int> g_generations; // indexed like g_views, always 1..0x7FFF so handles stay positive
+static vector<int> g_free_slots;
+static const int kMaxSlots = 0x10000;
 
-  Platform::instance().set_file_system(GetPlatformFileSystem("."));
+// Blank views created ahead of time (see prewarmViews), handed out by initWebSurface
+static vector<RefPtr<View>> g_view_pool;
+// Views in the pool plus those requested by prewarmViews/prewarmRenderer and not created yet. Readable from any
+// thread without waiting for the render thread (see getPooledViewCount)
+static atomic<int> g_pooled_views{0};
 
-  Platform::instance().set_logger(GetDefaultLogger("ultralight.log"));
+static void clearPool() {
+    g_pooled_views -= (int)g_view_pool.size();
+    g_view_pool.clear();
 }
 
-// Initialize renderer and load HTML
-extern "C"{
+// Persistent staging memory shared with Python.
+//
+// Without the render thread each view owns two slots; every stageSurfacePixels() call fills
+// the slot that Python is *not* currently looking at, so a frame handed out stays intact
+// until the next-but-one stage.
+//
+// With the render thread (see startRenderThread) each view owns three slots used as a
+// triple buffer: the render thread writes `back`, publishes it by swapping it with `middle`,
+// and Python takes the newest published frame by swapping `middle` with `front`. Neither
+// side ever blocks the other.
+struct StagingSlot {
+    vector<uint8_t> patch;  // the staged dirty rectangle, tightly packed (what gets uploaded)
+    vector<uint8_t> frame;  // full copy of the surface, stride = width * 4
+    IntRect rect = {0, 0, 0, 0}; // region held in `patch`
+    bool valid = false;     // false until `frame` has been filled once
+    IntRect stale = {0, 0, 0, 0}; // triple buffer: what was published through the other slots since this one's last publish
+};
 
-int initWebSurface(int width, int height, const char* html) {
-    ViewConfig config;
-    config.is_accelerated = false; // Ensure we use CPU renderer
+static const int kFreshFrame = 4; // flag on Staging::middle, set while the frame there hasn't been taken yet
 
-    initPlatform();
-    
-    if (!g_renderer){
-        print "Renderer created" <<endl;
-        g_renderer = Renderer::Create();
-    }
-    
-    auto view = g_renderer->CreateView(width, height, config, nullptr);
+struct Staging {
+    vector<StagingSlot> slots;
+    int front = -1;          // slot Python currently holds, -1 before the first stage (double buffer)
+    atomic<int> middle{1};   // last published slot, possibly | kFreshFrame (triple buffer only)
+    int back = 2;            // slot the render thread writes next (triple buffer only)
+    int width = 0;
+    int height = 0;
+    atomic<bool> focused{false}; // cached View::HasFocus() so Python can ask without crossing threads
+    atomic<bool> visible{true};    // hidden views are left out of Render() and not published (see setSurfaceVisible)
+    atomic<bool> republish{false}; // publish the whole surface next frame, set when a hidden view is shown again
+    atomic<int> background_interval{0}; // while hidden, still painted every that many frames (see setSurfaceBackgroundInterval)
+    int background_countdown = 0;       // frames until the next background paint, renderer thread only
 
-    g_views.push_back(view);
+    // Counters for getSurfaceStats. Relaxed atomics, they're written and read from either thread.
+    atomic<uint64_t> frames_staged{0};
+    atomic<uint64_t> bytes_staged{0};
+    atomic<uint64_t> dirty_pixels{0};
+    atomic<uint64_t> events_dispatched{0};
+    atomic<int> last_dirty_pixels{0};
+    atomic<float> last_copy_ms{0};
+};
+// Indexed like g_views. Both vectors are only resized by calls that block Python until they finish.
+static vector<unique_ptr<Staging>> g_staging;
 
-    view->LoadHTML(html);
-    g_renderer->Update();
-    g_renderer->Render();
+// Durations of the last kFrameTimeCount renderer Update and Render calls, for getRendererFrameTimes
+static const int kFrameTimeCount = 256;
+static float g_update_ms[kFrameTimeCount];
+static float g_render_ms[kFrameTimeCount];
+static uint64_t g_frame_count = 0;
+static mutex g_frame_times_mutex;
+
+// Set by the render thread whenever a frame had something to paint, cleared by renderWebSurface()
+static atomic<bool> g_painted_since_poll{false};
+
+// Render thread state (see startRenderThread)
+static thread g_render_thread;
+static atomic<bool> g_render_thread_running{false};
+static thread::id g_render_thread_id;
 
-    return g_views.size() - 1; // return index of the created view
+static float msSince(chrono::steady_clock::time_point start) {
+    return chrono::duration<float, milli>(chrono::steady_clock::now() - start).count();
 }
 
-// Force a redraw (useful when you change something)
-void renderWebSurface() {
+// One renderer frame, timed. Returns whether any view had something to paint (or is still loading)
+// after the update, i.e. whether the page is animating, reacting to input or running timers that change it.
+static bool updateAndRender() {
+    auto start = chrono::steady_clock::now();
     g_renderer->Update();
-    g_renderer->Render();
+    float update_ms = msSince(start);
+
+    // Hidden views keep their pending paints until they are shown again, unless they are painted in the
+    // background every few frames (prerendered views); those only count as painting while they load
+    static vector<View*> rendered;
+    rendered.clear();
+    bool painting = false;
+    int view_count = 0;
+    for (int i = 0; i < (int)g_views.size(); i++) {
+        View* view = g_views[i].get();
+        if (!view)
+            continue;
+        view_count++;
+        Staging& staging = *g_staging[i];
+        if (!staging.visible.load(memory_order_relaxed)) {
+            int interval = staging.background_interval.load(memory_order_relaxed);
+            if (interval <= 0)
+                continue;
+            if (view->is_loading())
+                painting = true; // let the load finish at the full tick rate
+            if (--staging.background_countdown > 0)
+                continue;
+            staging.background_countdown = interval;
+            rendered.push_back(view); // painted, but not published: publishFrame skips hidden views
+            continue;
+        }
+        rendered.push_back(view);
+        if (view->needs_paint() || view->is_loading())
+            painting = true;
+    }
+
+    start = chrono::steady_clock::now();
+    if ((int)rendered.size() == view_count)
+        g_renderer->Render();
+    else
+        g_renderer->RenderOnly(rendered.data(), rendered.size());
     g_renderer->RefreshDisplay(0);
+    float render_ms = msSince(start);
+
+    lock_guard<mutex> lock(g_frame_times_mutex);
+    g_update_ms[g_frame_count % kFrameTimeCount] = update_ms;
+    g_render_ms[g_frame_count % kFrameTimeCount] = render_ms;
+    g_frame_count++;
+    return painting;
 }
 
-// Retrieve the pixel buffer pointer (RGBA8)
-const void* getSurfacePixels(int surface_id, int* width, int* height, int* stride) {
-    // print "ID: " << surface_id;
-    if (surface_id < 0 || surface_id >= g_views.size()){
-        print g_views.size() <<endl;
+static void countStagedFrame(Staging& staging, int w, int h) {
+    staging.frames_staged.fetch_add(1, memory_order_relaxed);
+    staging.bytes_staged.fetch_add((uint64_t)w * h * 4, memory_order_relaxed);
+    staging.dirty_pixels.fetch_add((uint64_t)w * h, memory_order_relaxed);
+    staging.last_dirty_pixels.store(w * h, memory_order_relaxed);
+}
+
+static int makeHandle(int index) {
+    return (g_generations[index] << 16) | index;
+}
+
+// Slot index of a live handle, or -1. Doesn't touch the view itself, so it is safe to call from
+// Python while the render thread is running.
+static int slotIndex(int handle) {
+    if (handle < 0)
+        return -1;
+    int index = handle & 0xFFFF;
+    if (index >= (int)g_generations.size() || g_generations[index] != (handle >> 16))
+        return -1;
+    return index;
+}
+
+static RefPtr<View> lookupView(int handle) {
+    int index = slotIndex(handle);
+    if (index < 0)
         return nullptr;
+    return g_views[index];
+}
+
+static void allocateStaging(Staging& staging, int width, int height, int slot_count) {
+    size_t bytes = (size_t)width * height * 4;
+    staging.slots.resize(slot_count);
+    for (StagingSlot& slot : staging.slots) {
+        slot.patch.assign(bytes, 0);
+        slot.frame.assign(bytes, 0);
+        slot.rect = {0, 0, 0, 0};
+        slot.valid = false;
+        slot.stale = {0, 0, 0, 0};
     }
-    
-    RefPtr<View> view = g_views[surface_id];
-    if (!view){
-        std::cout<<"no vew?\n";
-        return nullptr;
+    staging.front = slot_count == 3 ? 0 : -1;
+    staging.middle = 1;
+    staging.back = 2;
+    staging.width = width;
+    staging.height = height;
+}
+
+static void resetCounters(Staging& staging) {
+    staging.frames_staged = 0;
+    staging.bytes_staged = 0;
+    staging.dirty_pixels = 0;
+    staging.events_dispatched = 0;
+    staging.last_dirty_pixels = 0;
+    staging.last_copy_ms = 0;
+}
+
+// Load events of all views, queued by g_load_listener on the renderer's thread and drained by pollLoadEvents
+static mutex g_load_events_mutex;
+static vector<LoadEvent> g_load_events;
+static const size_t kMaxLoadEvents = 1024; // the oldest are dropped beyond this, in case nobody polls
+
+static void queueLoadEvent(int surface_id, int type, const String& url, int error_code, const String& description) {
+    LoadEvent ev = {};
+    ev.surface_id = surface_id;
+    ev.type = type;
+    ev.error_code = error_code;
+    String8 url8 = url.utf8(), description8 = description.utf8();
+    memcpy(ev.url, url8.data(), min(url8.length(), sizeof(ev.url) - 1));
+    memcpy(ev.description, description8.data(), min(description8.length(), sizeof(ev.description) - 1));
+
+    lock_guard<mutex> lock(g_load_events_mutex);
+    if (g_load_events.size() >= kMaxLoadEvents)
+        g_load_events.erase(g_load_events.begin());
+    g_load_events.push_back(ev);
+}
+
+// Script results and page messages of all views, queued on the renderer's thread and drained by pollScriptMessages
+struct QueuedScriptMessage {
+    int surface_id;
+    int type;
+    int request_id;
+    string data;
+};
+static mutex g_script_messages_mutex;
+static deque<QueuedScriptMessage> g_script_messages;
+static vector<QueuedScriptMessage> g_script_messages_delivered; // what the last poll handed out, kept alive until the next one
+static const size_t kMaxScriptMessages = 65536; // the oldest are dropped beyond this, in case nobody polls
+
+static void queueScriptMessage(int surface_id, int type, int request_id, string data) {
+    lock_guard<mutex> lock(g_script_messages_mutex);
+    if (g_script_messages.size() >= kMaxScriptMessages)
+        g_script_messages.pop_front();
+    g_script_messages.push_back({surface_id, type, request_id, move(data)});
+}
+
+static string toUTF8(const String& text) {
+    String8 text8 = text.utf8();
+    return string(text8.data(), text8.length());
+}
+
+static string toUTF8(JSContextRef ctx, JSValueRef value) {
+    JSStringRef text = JSValueToStringCopy(ctx, value, nullptr);
+    if (!text)
+        return string();
+    string result(JSStringGetMaximumUTF8CStringSize(text), '\0');
+    size_t written = JSStringGetUTF8CString(text, &result[0], result.size()); // counts the NUL
+    result.resize(written ? written - 1 : 0);
+    JSStringRelease(text);
+    return result;
+}
+
+// __websurfacePost(handle, text): only reachable through the websurface.post() the bootstrap script defines
+static JSValueRef postScriptMessage(JSContextRef ctx, JSObjectRef function, JSObjectRef this_object,
+                                    size_t argc, const JSValueRef argv[], JSValueRef* exception) {
+    if (argc >= 2)
+        queueScriptMessage((int)JSValueToNumber(ctx, argv[0], nullptr), kScript_Message, 0, toUTF8(ctx, argv[1]));
+    return JSValueMakeUndefined(ctx);
+}
+
+// Page side of the message channel, run in every page of every view with the view's handle.
+// websurface.post(message) sends JSON.stringify(message) to Python, websurface.on(name, handler) receives
+// the data Python sends with send_js(). Messages are only queued here; Python drains them once per tick.
+static const char* kBootstrapScript = R"JS(
+(function (handle, post) {
+    var handlers = {};
+    window.websurface = {
+        post: function (message) { post(handle, JSON.stringify(message)); },
+        on: function (name, handler) { (handlers[name] = handlers[name] || []).push(handler); },
+        _receive: function (data) {
+            for (var name in data)
+                (handlers[name] || []).forEach(function (handler) { handler(data[name]); });
+        }
+    };
+})(%d, __websurfacePost);
+delete window.__websurfacePost;
+)JS";
+
+static void installBootstrap(View* view, int handle) {
+    RefPtr<JSContext> context = view->LockJSContext();
+    JSContextRef ctx = context->ctx();
+    JSStringRef name = JSStringCreateWithUTF8CString("__websurfacePost");
+    JSObjectRef function = JSObjectMakeFunctionWithCallback(ctx, name, postScriptMessage);
+    JSObjectSetProperty(ctx, JSContextGetGlobalObject(ctx), name, function, kJSPropertyAttributeNone, nullptr);
+    JSStringRelease(name);
+
+    vector<char> script(strlen(kBootstrapScript) + 16);
+    snprintf(script.data(), script.size(), kBootstrapScript, handle);
+    JSStringRef source = JSStringCreateWithUTF8CString(script.data());
+    JSEvaluateScript(ctx, source, nullptr, nullptr, 0, nullptr);
+    JSStringRelease(source);
+}
+
+// One listener for all views. Ultralight calls it from Update() (or a Load call) on the renderer's thread,
+// the only thread that touches g_views, so looking the view up there is safe.
+class SurfaceLoadListener : public LoadListener {
+    void queue(View* caller, bool is_main_frame, int type, const String& url,
+               int error_code = 0, const String& description = String()) {
+        if (!is_main_frame)
+            return; // iframes don't count
+        int handle = findHandle(caller);
+        if (handle >= 0)
+            queueLoadEvent(handle, type, url, error_code, description);
     }
 
-    auto surface = view->surface();
-    *width = surface->width();
-    *height = surface->height();
-    *stride = surface->row_bytes();
+    static int findHandle(View* view) {
+        for (int i = 0; i < (int)g_views.size(); i++) {
+            if (g_views[i].get() == view)
+                return makeHandle(i);
+        }
+        return -1;
+    }
+
+public:
+    void OnBeginLoading(View* caller, uint64_t frame_id, bool is_main_frame, const String& url) override {
+        queue(caller, is_main_frame, kLoad_Begin, url);
+    }
 
-    // return surface->LoekPixels();
-    BitmapSurface* bitmap_surface = (BitmapSurface*)(surface);
-    RefPtr<Bitmap> bitmap = bitmap_surface->bitmap();
-    return bitmap->LockPixels();
+    void OnWindowObjectReady(View* caller, uint64_t frame_id, bool is_main_frame, const String& url) override {
+        int handle = is_main_frame ? findHandle(caller) : -1;
+        if (handle >= 0)
+            installBootstrap(caller, handle);
+    }
+
+    void OnDOMReady(View* caller, uint64_t frame_id, bool is_main_frame, const String& url) override {
+        queue(caller, is_main_frame, kLoad_DOMReady, url);
+    }
+
+    void OnFinishLoading(View* caller, uint64_t frame_id, bool is_main_frame, const String& url) override {
+        queue(caller, is_main_frame, kLoad_Finish, url);
+    }
+
+    void OnFailLoading(View* caller, uint64_t frame_id, bool is_main_frame, const String& url,
+                       const String& description, const String& error_domain, int error_code) override {
+        queue(caller, is_main_frame, kLoad_Fail, url, error_code, description);
+    }
+};
+static SurfaceLoadListener g_load_listener;
+
+// Copy a w*h block of 4-byte pixels between two buffers with their own strides
+static void copyPixels(const uint8_t* src, int src_stride, int src_x, int src_y,
+                       uint8_t* dst, int dst_stride, int dst_x, int dst_y, int w, int h) {
+    size_t row = (size_t)w * 4;
+    for (int r = 0; r < h; r++) {
+        memcpy(dst + (size_t)(dst_y + r) * dst_stride + (size_t)dst_x * 4,
+               src + (size_t)(src_y + r) * src_stride + (size_t)src_x * 4, row);
+    }
 }
 
-// Release the lock when done
-void releaseSurfacePixels(int surface_id) {
-    if (surface_id < 0 || surface_id >= g_views.size())
+static IntRect unionRect(const IntRect& a, const IntRect& b) {
+    if (a.IsEmpty()) return b;
+    if (b.IsEmpty()) return a;
+    return {min(a.left, b.left), min(a.top, b.top), max(a.right, b.right), max(a.bottom, b.bottom)};
+}
+
+// Single producer (the caller's thread), single consumer (the render thread) ring buffer
+template <typename T, size_t N>
+class SpscRing {
+    T items[N];
+    atomic<size_t> head{0}; // next slot to write, owned by the producer
+    atomic<size_t> tail{0}; // next slot to read, owned by the consumer
+public:
+    bool push(const T& item) {
+        size_t h = head.load(memory_order_relaxed);
+        size_t next = (h + 1) % N;
+        if (next == tail.load(memory_order_acquire))
+            return false; // full
+        items[h] = item;
+        head.store(next, memory_order_release);
+        return true;
+    }
+
+    bool pop(T& item) {
+        size_t t = tail.load(memory_order_relaxed);
+        if (t == head.load(memory_order_acquire))
+            return false; // empty
+        item = items[t];
+        tail.store((t + 1) % N, memory_order_release);
+        return true;
+    }
+};
+
+static SpscRing<InputEvent, 4096> g_input_ring;
+static mutex g_tasks_mutex;
+static vector<function<void()>> g_tasks; // everything other than input that has to run on the render thread
+
+static bool onRenderThread() {
+    return g_render_thread_running && this_thread::get_id() == g_render_thread_id;
+}
+
+// Run `task` on the render thread without waiting, or right away when there is no render thread
+static void postTask(function<void()> task) {
+    if (!g_render_thread_running || onRenderThread()) {
+        task();
         return;
-    
-    RefPtr<View> view = g_views[surface_id];
-    if (view)
-        view->surface()->UnlockPixels();
+    }
+    lock_guard<mutex> lock(g_tasks_mutex);
+    g_tasks.push_back(move(task));
 }
 
-void dispatchMouseEvent(int surface_id, int x, int y, int button, const char * evtype) {
-    if (surface_id < 0 || surface_id >= g_views.size()) return;
-    RefPtr<View> view = g_views[surface_id];
+// Run `fn` on the render thread and wait for its result. Ultralight objects may only be
+// touched from the thread that created the renderer.
+template <typename F>
+static auto runOnRenderThread(F fn) -> decltype(fn()) {
+    if (!g_render_thread_running || onRenderThread())
+        return fn();
+    auto task = make_shared<packaged_task<decltype(fn())()>>(fn);
+    auto result = task->get_future();
+    postTask([task]() { (*task)(); });
+    return result.get();
+}
+
+static void runPendingTasks() {
+    vector<function<void()>> tasks;
+    {
+        lock_guard<mutex> lock(g_tasks_mutex);
+        tasks.swap(g_tasks);
+    }
+    for (auto& task : tasks)
+        task();
+}
+
+static void fireInputEvent(const InputEvent& ev) {
+    int index = slotIndex(ev.surface_id);
+    if (index < 0) return;
+    RefPtr<View> view = g_views[index];
+    if (!view) return;
+    g_staging[index]->events_dispatched.fetch_add(1, memory_order_relaxed);
 
-    if (view) {
+    switch (ev.type) {
+    case kInput_MouseDown:
+    case kInput_MouseUp:
+    case kInput_MouseMove: {
         MouseEvent mouseEvent;
-        
-        string ev(evtype);
-        if (ev == "down") {
+        if (ev.type == kInput_MouseDown)
             mouseEvent.type = MouseEvent::kType_MouseDown;
-        } else if (ev == "up") {
+        else if (ev.type == kInput_MouseUp)
             mouseEvent.type = MouseEvent::kType_MouseUp;
-        } else if (ev == "move") {
+        else
             mouseEvent.type = MouseEvent::kType_MouseMoved;
-        }
-        else{
-            mouseEvent.type = MouseEvent::kType_MouseUp; // default/fallback
-        }
 
         MouseEvent::Button buttons[4] = {
             MouseEvent::kButton_None,
@@ -112,106 +471,1141 @@ void dispatchMouseEvent(int surface_id, int x, int y, int button, const char * e
             MouseEvent::kButton_Middle,
             MouseEvent::kButton_Right,
         };
-        mouseEvent.button = buttons[button];
-        mouseEvent.x = x;
+        mouseEvent.button = buttons[(ev.button >= 0 && ev.button < 4) ? ev.button : 0];
+        mouseEvent.x = ev.x;
         // Apply vertical flip considering the difference in Kivy's and Ultralight's (0,0) coordinate
         // On second thought, maybe I should do it within Kivy instead
-        // mouseEvent.y = (g_view->height()) - y; 
-        mouseEvent.y = y;
+        // mouseEvent.y = (g_view->height()) - y;
+        mouseEvent.y = ev.y;
 
         view->FireMouseEvent(mouseEvent);
+        break;
+    }
+    case kInput_Scroll: {
+        ScrollEvent evt;
+        evt.delta_x = ev.x;
+        evt.delta_y = ev.y;
+        evt.type = ScrollEvent::kType_ScrollByPixel;
+        view->FireScrollEvent(evt);
+        break;
+    }
+    case kInput_KeyDown:
+    case kInput_KeyUp: {
+        if (!view->HasInputFocus()) return;
+        KeyEvent event;
+        event.type = ev.type == kInput_KeyDown ? KeyEvent::kType_RawKeyDown : KeyEvent::kType_KeyUp;
+        event.virtual_key_code = ev.keycode;
+        event.modifiers = ev.modifiers;
+        GetKeyIdentifierFromVirtualKeyCode(ev.keycode, event.key_identifier);
+        event.native_key_code = 0;
+        view->FireKeyEvent(event);
+        break;
+    }
+    case kInput_Char: {
+        if (!view->HasInputFocus()) return;
+        KeyEvent event;
+        event.type = KeyEvent::kType_Char;
+        event.text = ev.text;
+        event.unmodified_text = ev.text;
+        view->FireKeyEvent(event);
+        break;
+    }
     }
 }
 
-void dispatchScrollEvent(int surface_id, int delta_x, int delta_y) {
-    if (surface_id < 0 || surface_id >= g_views.size())
+// Fire the event right away, or queue it for the render thread when it is running
+static void submitInputEvent(const InputEvent& ev) {
+    if (!g_render_thread_running || onRenderThread()) {
+        fireInputEvent(ev);
+        return;
+    }
+    // The render thread drains the ring every frame, so a full ring only ever waits for one frame
+    while (!g_input_ring.push(ev))
+        this_thread::yield();
+}
+
+static InputEvent makeInputEvent(int surface_id, int type) {
+    InputEvent ev;
+    memset(&ev, 0, sizeof(ev));
+    ev.surface_id = surface_id;
+    ev.type = type;
+    return ev;
+}
+
+// Render thread side of the triple buffer: copy the view's surface into the back slot and publish it
+static void publishFrame(int index) {
+    RefPtr<View> view = g_views[index];
+    Staging& staging = *g_staging[index];
+    staging.focused = view->HasFocus();
+    if (!staging.visible.load(memory_order_relaxed))
         return;
 
-    RefPtr<View> view = g_views[surface_id];
+    BitmapSurface* surface = (BitmapSurface*)(view->surface());
+    int width = min((int)surface->width(), staging.width);
+    int height = min((int)surface->height(), staging.height);
+    IntRect bounds = surface->dirty_bounds();
+    surface->ClearDirtyBounds();
+    if (staging.republish.exchange(false))
+        bounds = {0, 0, width, height};
+    bounds = {max(bounds.left, 0), max(bounds.top, 0), min(bounds.right, width), min(bounds.bottom, height)};
+    if (bounds.right <= bounds.left || bounds.bottom <= bounds.top)
+        return;
+
+    // If Python hasn't taken the previous frame yet it never will, so its dirty rect has to
+    // carry over into this one. Should Python grab it in the meantime we merely upload a bit more.
+    int middle = staging.middle.load(memory_order_acquire);
+    if (middle & kFreshFrame)
+        bounds = unionRect(bounds, staging.slots[middle & 3].rect);
+
+    auto start = chrono::steady_clock::now();
+    StagingSlot& slot = staging.slots[staging.back];
+    RefPtr<Bitmap> bitmap = surface->bitmap();
+    const uint8_t* pixels = (const uint8_t*)bitmap->LockPixels();
+    if (!pixels) {
+        bitmap->UnlockPixels();
+        return;
+    }
+    int src_stride = surface->row_bytes();
+    int bw = bounds.right - bounds.left;
+    int bh = bounds.bottom - bounds.top;
+    copyPixels(pixels, src_stride, bounds.left, bounds.top, slot.patch.data(), bw * 4, 0, 0, bw, bh);
+    // This slot's frame was brought up to date when it was last published; since then the surface changed in
+    // the rects published through the other two slots, and in this one
+    IntRect sync = {0, 0, width, height};
+    if (slot.valid)
+        sync = unionRect(slot.stale, bounds);
+    copyPixels(pixels, src_stride, sync.left, sync.top, slot.frame.data(), staging.width * 4,
+               sync.left, sync.top, sync.right - sync.left, sync.bottom - sync.top);
+    bitmap->UnlockPixels();
+    staging.last_copy_ms.store(msSince(start), memory_order_relaxed);
+
+    for (int i = 0; i < (int)staging.slots.size(); i++) {
+        if (i != staging.back)
+            staging.slots[i].stale = unionRect(staging.slots[i].stale, bounds);
+    }
+    slot.stale = {0, 0, 0, 0};
+    slot.rect = bounds;
+    slot.valid = true;
+    int previous = staging.middle.exchange(staging.back | kFreshFrame, memory_order_acq_rel);
+    staging.back = previous & 3;
+}
+
+// Python side of the triple buffer: take the newest published frame, if there is one
+static int acquireFrame(Staging& staging, bool full, IntRect& bounds) {
+    if (staging.middle.load(memory_order_acquire) & kFreshFrame) {
+        int previous = staging.middle.exchange(staging.front, memory_order_acq_rel);
+        staging.front = previous & 3;
+    } else if (!full) {
+        return -1;
+    }
+
+    StagingSlot& slot = staging.slots[staging.front];
+    if (!slot.valid)
+        return -1;
+    bounds = full ? IntRect{0, 0, staging.width, staging.height} : slot.rect;
+    return staging.front;
+}
+
+static void renderThreadMain(int fps) {
+    g_render_thread_id = this_thread::get_id();
+    auto period = chrono::microseconds(1000000 / max(fps, 1));
+    auto next = chrono::steady_clock::now();
+
+    while (g_render_thread_running) {
+        runPendingTasks();
+        InputEvent ev;
+        while (g_input_ring.pop(ev))
+            fireInputEvent(ev);
+
+        if (g_renderer) {
+            if (updateAndRender())
+                g_painted_since_poll = true;
+            for (int i = 0; i < (int)g_views.size(); i++) {
+                if (g_views[i])
+                    publishFrame(i);
+            }
+        }
+
+        next += period;
+        auto now = chrono::steady_clock::now();
+        if (next < now)
+            next = now; // running behind, don't try to catch up with a burst of frames
+        else
+            this_thread::sleep_until(next);
+    }
+    // Don't leave anyone waiting on a task that was posted while we were shutting down
+    runPendingTasks();
+}
+
+// Platform settings (see configurePlatform), applied once before the renderer is first created
+static string g_file_system_dir = ".";
+static string g_resource_prefix = "resources/";
+static string g_log_path = "ultralight.log";
+static bool g_platform_initialized = false;
+
+// Asset file system: what Ultralight reads file:/// URLs and its resources through. Files come from the
+// mounted bundle (see pack_assets.py) when it has them, otherwise from disk under the root directory; files
+// read from disk are kept in an LRU cache with a byte budget, so navigating between local pages doesn't
+// read them again. A cached file is checked against the disk (size and mtime, then a content hash) when it is
+// opened and was last checked at least `revalidate_after` seconds ago: by default (0) on every open, so edits on
+// disk show up like they did without the cache; a negative value never checks (clearAssetCache() still drops them).
+
+static uint64_t fnv1a(const uint8_t* data, size_t size) {
+    uint64_t hash = 1469598103934665603ull;
+    for (size_t i = 0; i < size; i++)
+        hash = (hash ^ data[i]) * 1099511628211ull;
+    return hash;
+}
+
+// Wrap `size` bytes at `data` in a Buffer that keeps `owner` alive until Ultralight releases it
+static RefPtr<Buffer> shareBuffer(const void* data, size_t size, shared_ptr<const void> owner) {
+    return Buffer::Create(const_cast<void*>(data), size, new shared_ptr<const void>(move(owner)),
+                          [](void* user_data, void*) { delete static_cast<shared_ptr<const void>*>(user_data); });
+}
+
+static string mimeTypeFor(const string& path) {
+    static const unordered_map<string, string> types = {
+        {"html", "text/html"}, {"htm", "text/html"}, {"css", "text/css"}, {"js", "application/javascript"},
+        {"mjs", "application/javascript"}, {"json", "application/json"}, {"svg", "image/svg+xml"},
+        {"png", "image/png"}, {"jpg", "image/jpeg"}, {"jpeg", "image/jpeg"}, {"gif", "image/gif"},
+        {"webp", "image/webp"}, {"ico", "image/x-icon"}, {"woff", "font/woff"}, {"woff2", "font/woff2"},
+        {"ttf", "font/ttf"}, {"otf", "font/otf"}, {"txt", "text/plain"}, {"xml", "text/xml"},
+        {"wasm", "application/wasm"}, {"mp3", "audio/mpeg"}, {"wav", "audio/wav"}, {"mp4", "video/mp4"},
+        {"webm", "video/webm"},
+    };
+    size_t dot = path.rfind('.');
+    if (dot != string::npos) {
+        string extension = path.substr(dot + 1);
+        transform(extension.begin(), extension.end(), extension.begin(), ::tolower);
+        auto it = types.find(extension);
+        if (it != types.end())
+            return it->second;
+    }
+    return "application/octet-stream";
+}
+
+// A bundle built by pack_assets.py, mapped read-only. Layout (little endian), HEADER and ENTRY in pack_assets.py:
+//   "WSBUNDLE", uint32 version, uint32 entry count, uint64 index size, then per entry
+//   uint16 path length, uint16 mime length, uint32 0, uint64 offset, uint64 size, uint64 hash, path, mime
+// followed by the file contents at their offsets. The hash is only for pack_assets.py to tell what changed and
+// isn't read here. pack_assets.parse_index() accepts the same bundles, tests/test_pack_assets.py checks both.
+struct AssetBundle {
+    struct Entry {
+        uint64_t offset;
+        uint64_t size;
+        string mime;
+    };
+    void* data = MAP_FAILED;
+    size_t size = 0;
+    unordered_map<string, Entry> entries;
+
+    ~AssetBundle() {
+        if (data != MAP_FAILED)
+            munmap(data, size);
+    }
+
+    bool open(const char* path) {
+        int fd = ::open(path, O_RDONLY);
+        if (fd < 0)
+            return false;
+        struct stat info;
+        if (fstat(fd, &info) == 0 && info.st_size > 0) {
+            size = (size_t)info.st_size;
+            data = mmap(nullptr, size, PROT_READ, MAP_PRIVATE, fd, 0);
+        }
+        ::close(fd);
+        return data != MAP_FAILED && parseIndex();
+    }
+
+    bool parseIndex() {
+        const uint8_t* bytes = static_cast<const uint8_t*>(data);
+        auto read = [&](size_t at, auto& value) { memcpy(&value, bytes + at, sizeof(value)); };
+        uint32_t version, count;
+        uint64_t index_size;
+        if (size < 24 || memcmp(bytes, "WSBUNDLE", 8) != 0)
+            return false;
+        read(8, version);
+        read(12, count);
+        read(16, index_size);
+        if (version != 1 || index_size > size - 24)
+            return false;
+        size_t at = 24, end = 24 + index_size;
+        for (uint32_t i = 0; i < count; i++) {
+            uint16_t path_length, mime_length;
+            Entry entry;
+            if (end - at < 32)
+                return false;
+            read(at, path_length);
+            read(at + 2, mime_length);
+            read(at + 8, entry.offset);
+            read(at + 16, entry.size);
+            at += 32;
+            if (end - at < (size_t)path_length + mime_length || entry.offset > size || entry.size > size - entry.offset)
+                return false;
+            string path((const char*)bytes + at, path_length);
+            entry.mime.assign((const char*)bytes + at + path_length, mime_length);
+            at += path_length + mime_length;
+            entries[path] = move(entry);
+        }
+        return true;
+    }
+};
+
+class AssetFileSystem : public FileSystem {
+    struct CachedFile {
+        shared_ptr<const vector<uint8_t>> data;
+        string mime;
+        uint64_t hash;
+        off_t disk_size;
+        struct timespec mtime;
+        chrono::steady_clock::time_point checked;
+        list<string>::iterator lru;
+    };
+
+    string root_ = ".";
+    mutex mutex_;
+    shared_ptr<AssetBundle> bundle_;
+    unordered_map<string, CachedFile> cache_;
+    list<string> lru_; // most recently used first
+    uint64_t cache_bytes_ = 0;
+
+    string diskPath(const string& path) const {
+        return root_.empty() || root_ == "." ? path : root_ + "/" + path;
+    }
+
+    static bool sameStat(const struct stat& info, const CachedFile& file) {
+        return info.st_size == file.disk_size && info.st_mtim.tv_sec == file.mtime.tv_sec
+            && info.st_mtim.tv_nsec == file.mtime.tv_nsec;
+    }
+
+    void drop(unordered_map<string, CachedFile>::iterator it) {
+        cache_bytes_ -= it->second.data->size();
+        lru_.erase(it->second.lru);
+        cache_.erase(it);
+    }
+
+    void trim() {
+        while (cache_bytes_ > budget && !lru_.empty()) {
+            drop(cache_.find(lru_.back()));
+            stats.evictions++;
+        }
+    }
+
+    static shared_ptr<vector<uint8_t>> readFile(const string& path, struct stat& info) {
+        FILE* file = fopen(path.c_str(), "rb");
+        if (!file)
+            return nullptr;
+        shared_ptr<vector<uint8_t>> data;
+        if (fstat(fileno(file), &info) == 0 && S_ISREG(info.st_mode)) {
+            data = make_shared<vector<uint8_t>>((size_t)info.st_size);
+            if (fread(data->data(), 1, data->size(), file) != data->size())
+                data = nullptr;
+        }
+        fclose(file);
+        return data;
+    }
+
+    // The cached entry for `path`, revalidated if it is due; cache_.end() when it isn't cached (any more)
+    unordered_map<string, CachedFile>::iterator lookup(const string& path) {
+        auto it = cache_.find(path);
+        if (it == cache_.end())
+            return it;
+        CachedFile& file = it->second;
+        auto now = chrono::steady_clock::now();
+        if (revalidate_after >= 0 && chrono::duration<double>(now - file.checked).count() >= revalidate_after) {
+            file.checked = now;
+            struct stat info;
+            if (stat(diskPath(path).c_str(), &info) != 0) {
+                drop(it);
+                stats.invalidations++;
+                return cache_.end();
+            }
+            if (!sameStat(info, file)) {
+                shared_ptr<vector<uint8_t>> data = readFile(diskPath(path), info);
+                stats.disk_reads++;
+                if (!data || fnv1a(data->data(), data->size()) != file.hash) {
+                    drop(it); // changed: the next OpenFile caches the new content
+                    stats.invalidations++;
+                    return cache_.end();
+                }
+                file.disk_size = info.st_size; // only touched, same content
+                file.mtime = info.st_mtim;
+            }
+        }
+        lru_.splice(lru_.begin(), lru_, file.lru);
+        return it;
+    }
+
+    const AssetBundle::Entry* bundleEntry(const string& path) {
+        if (!bundle_)
+            return nullptr;
+        auto it = bundle_->entries.find(path);
+        return it == bundle_->entries.end() ? nullptr : &it->second;
+    }
+
+public:
+    uint64_t budget = 64ull << 20;
+    double revalidate_after = 0;
+    AssetStats stats = {};
+
+    void setRoot(const string& root) {
+        lock_guard<mutex> lock(mutex_);
+        root_ = root;
+        cache_.clear();
+        lru_.clear();
+        cache_bytes_ = 0;
+    }
+
+    bool FileExists(const String& file_path) override {
+        string path = toUTF8(file_path);
+        lock_guard<mutex> lock(mutex_);
+        if (bundleEntry(path) || lookup(path) != cache_.end())
+            return true;
+        struct stat info;
+        return stat(diskPath(path).c_str(), &info) == 0 && S_ISREG(info.st_mode);
+    }
+
+    String GetFileMimeType(const String& file_path) override {
+        string path = toUTF8(file_path);
+        lock_guard<mutex> lock(mutex_);
+        const AssetBundle::Entry* entry = bundleEntry(path);
+        return (entry && !entry->mime.empty() ? entry->mime : mimeTypeFor(path)).c_str();
+    }
+
+    String GetFileCharset(const String& file_path) override {
+        return "utf-8";
+    }
+
+    RefPtr<Buffer> OpenFile(const String& file_path) override {
+        string path = toUTF8(file_path);
+        lock_guard<mutex> lock(mutex_);
+        if (const AssetBundle::Entry* entry = bundleEntry(path)) {
+            stats.bundle_hits++;
+            return shareBuffer((const uint8_t*)bundle_->data + entry->offset, entry->size, bundle_);
+        }
+        auto it = lookup(path);
+        if (it != cache_.end()) {
+            stats.cache_hits++;
+            return shareBuffer(it->second.data->data(), it->second.data->size(), it->second.data);
+        }
+
+        struct stat info;
+        shared_ptr<vector<uint8_t>> data = readFile(diskPath(path), info);
+        if (!data)
+            return nullptr;
+        stats.disk_reads++;
+        if (data->size() <= budget) {
+            lru_.push_front(path);
+            cache_[path] = {data, mimeTypeFor(path), fnv1a(data->data(), data->size()), info.st_size, info.st_mtim,
+                            chrono::steady_clock::now(), lru_.begin()};
+            cache_bytes_ += data->size();
+            trim();
+        }
+        return shareBuffer(data->data(), data->size(), data);
+    }
+
+    // Buffers handed out keep their memory alive, so entries can go (and bundles be swapped) at any time
+    void configure(uint64_t budget_bytes, double revalidate) {
+        lock_guard<mutex> lock(mutex_);
+        budget = budget_bytes;
+        revalidate_after = revalidate;
+        trim();
+    }
+
+    void mount(shared_ptr<AssetBundle> bundle) {
+        lock_guard<mutex> lock(mutex_);
+        bundle_ = move(bundle);
+        if (!bundle_)
+            return;
+        // Cached disk copies of files the bundle now provides would never be served again
+        for (auto it = cache_.begin(); it != cache_.end();) {
+            auto current = it++;
+            if (bundle_->entries.count(current->first))
+                drop(current);
+        }
+    }
+
+    void clear() {
+        lock_guard<mutex> lock(mutex_);
+        cache_.clear();
+        lru_.clear();
+        cache_bytes_ = 0;
+    }
+
+    AssetStats getStats() {
+        lock_guard<mutex> lock(mutex_);
+        AssetStats result = stats;
+        result.cache_bytes = cache_bytes_;
+        result.cache_budget = budget;
+        result.cache_entries = (int32_t)cache_.size();
+        result.bundle_entries = bundle_ ? (int32_t)bundle_->entries.size() : 0;
+        return result;
+    }
+};
+
+// Created on first use, so it can be configured (and a bundle mounted) before the platform is initialized
+static AssetFileSystem* g_asset_file_system = nullptr;
+static mutex g_asset_file_system_mutex;
+
+static AssetFileSystem& assetFileSystem() {
+    lock_guard<mutex> lock(g_asset_file_system_mutex);
+    if (!g_asset_file_system)
+        g_asset_file_system = new AssetFileSystem(); // lives as long as the platform, i.e. the process
+    return *g_asset_file_system;
+}
+
+
+static void initPlatform() {
+  if (g_platform_initialized)
+    return;
+  g_platform_initialized = true;
+
+  Config config;
+  config.resource_path_prefix = g_resource_prefix.c_str();
+  Platform::instance().set_config(config);
+
+  Platform::instance().set_font_loader(GetPlatformFontLoader());
+
+  assetFileSystem().setRoot(g_file_system_dir);
+  Platform::instance().set_file_system(&assetFileSystem());
+
+  Platform::instance().set_logger(GetDefaultLogger(g_log_path.c_str()));
+}
+
+static void ensureRenderer() {
+    if (!g_renderer){
+        initPlatform();
+        print "Renderer created" <<endl;
+        g_renderer = Renderer::Create();
+    }
+}
+
+// Initialize renderer and load HTML
+extern "C"{
+
+// Opt-in: update and render on a dedicated native thread at `fps`, publishing finished frames
+// into a per-view triple buffer. Must be called before the first WebSurface is created, since
+// Ultralight has to live on the thread that creates the renderer. Returns false otherwise.
+bool startRenderThread(int fps) {
+    if (g_render_thread_running || g_renderer)
+        return false;
+    g_render_thread_running = true;
+    g_render_thread = thread(renderThreadMain, fps);
+    return true;
+}
+
+bool isRenderThreadRunning() {
+    return g_render_thread_running;
+}
+
+int initWebSurface(int width, int height, const char* html) {
+    string html_copy(html);
+    return runOnRenderThread([&]() {
+        ViewConfig config;
+        config.is_accelerated = false; // Ensure we use CPU renderer
+
+        ensureRenderer();
+
+        int index;
+        if (!g_free_slots.empty()) {
+            index = g_free_slots.back();
+            g_free_slots.pop_back();
+        } else if (g_views.size() < kMaxSlots) {
+            index = (int)g_views.size();
+            g_views.push_back(nullptr);
+            g_staging.emplace_back(new Staging());
+            g_generations.push_back(1);
+        } else {
+            return -1;
+        }
+
+        RefPtr<View> view;
+        if (!g_view_pool.empty()) {
+            // A pre-created view only needs resizing, which is far cheaper than creating one
+            view = g_view_pool.back();
+            g_view_pool.pop_back();
+            g_pooled_views--;
+            if ((int)view->width() != width || (int)view->height() != height)
+                view->Resize(width, height);
+        } else {
+            view = g_renderer->CreateView(width, height, config, nullptr);
+        }
+
+        g_views[index] = view;
+        view->set_load_listener(&g_load_listener);
+        resetCounters(*g_staging[index]);
+        g_staging[index]->visible = true;
+        g_staging[index]->background_interval = 0;
+        g_staging[index]->background_countdown = 0;
+        allocateStaging(*g_staging[index], width, height, g_render_thread_running ? 3 : 2);
+
+        view->LoadHTML(html_copy.c_str());
+        g_renderer->Update();
+        g_renderer->Render();
+
+        return makeHandle(index); // return the handle of the created view
+    });
+}
+
+// Force a redraw (useful when you change something). The render thread does this by itself.
+// Returns whether anything needed painting: in this frame, or with the render thread in any of
+// its frames since the last call. Frame pacing uses it to tell a static page from a live one.
+bool renderWebSurface() {
+    if (g_render_thread_running)
+        return g_painted_since_poll.exchange(false);
+    if (!g_renderer)
+        return false;
+    return updateAndRender();
+}
+
+// Retrieve the pixel buffer pointer (RGBA8)
+const void* getSurfacePixels(int surface_id, int* width, int* height, int* stride) {
+    return runOnRenderThread([&]() -> const void* {
+        // print "ID: " << surface_id;
+        RefPtr<View> view = lookupView(surface_id);
+        if (!view){
+            std::cout<<"no vew?\n";
+            return nullptr;
+        }
+
+        auto surface = view->surface();
+        *width = surface->width();
+        *height = surface->height();
+        *stride = surface->row_bytes();
+
+        // return surface->LoekPixels();
+        BitmapSurface* bitmap_surface = (BitmapSurface*)(surface);
+        RefPtr<Bitmap> bitmap = bitmap_surface->bitmap();
+        return bitmap->LockPixels();
+    });
+}
+
+// Report the region of the surface that was repainted and not staged yet, without clearing it: the bounds belong
+// to stageSurfacePixels, which would miss the region otherwise. With the render thread, frames it already
+// published are not included. Returns false (leaving the out params untouched) when nothing changed.
+bool getSurfaceDirtyBounds(int surface_id, int* left, int* top, int* right, int* bottom) {
+    return runOnRenderThread([&]() {
+        RefPtr<View> view = lookupView(surface_id);
+        if (!view)
+            return false;
+
+        Surface* surface = view->surface();
+        IntRect bounds = surface->dirty_bounds();
+        if (bounds.IsEmpty())
+            return false;
+
+        // Clamp to the surface, Ultralight may report bounds that overhang the edges
+        *left = max(bounds.left, 0);
+        *top = max(bounds.top, 0);
+        *right = min(bounds.right, (int)surface->width());
+        *bottom = min(bounds.bottom, (int)surface->height());
+        return *right > *left && *bottom > *top;
+    });
+}
+
+// Copy the dirty part of the surface into the view's staging memory (see Staging above) and
+// clear the dirty bounds. `full` forces the whole surface to be staged.
+// With the render thread this just takes the newest published frame and never blocks.
+// Returns the slot that now holds the patch, or -1 when there was nothing to stage.
+int stageSurfacePixels(int surface_id, bool full, int* x, int* y, int* w, int* h) {
+    int index = slotIndex(surface_id);
+    if (index < 0)
+        return -1;
+    Staging& staging = *g_staging[index];
+
+    if (g_render_thread_running) {
+        IntRect bounds;
+        int slot = acquireFrame(staging, full, bounds);
+        if (slot >= 0) {
+            *x = bounds.left;
+            *y = bounds.top;
+            *w = bounds.right - bounds.left;
+            *h = bounds.bottom - bounds.top;
+            countStagedFrame(staging, *w, *h);
+        }
+        return slot;
+    }
+
+    RefPtr<View> view = g_views[index];
     if (!view)
+        return -1;
+
+    BitmapSurface* surface = (BitmapSurface*)(view->surface());
+    int width = min((int)surface->width(), staging.width);
+    int height = min((int)surface->height(), staging.height);
+
+    IntRect bounds = surface->dirty_bounds();
+    surface->ClearDirtyBounds();
+    if (full)
+        bounds = {0, 0, width, height};
+    bounds = {max(bounds.left, 0), max(bounds.top, 0), min(bounds.right, width), min(bounds.bottom, height)};
+    if (bounds.right <= bounds.left || bounds.bottom <= bounds.top)
+        return -1;
+
+    auto start = chrono::steady_clock::now();
+    int back = staging.front < 0 ? 0 : 1 - staging.front;
+    StagingSlot& slot = staging.slots[back];
+
+    RefPtr<Bitmap> bitmap = surface->bitmap();
+    const uint8_t* pixels = (const uint8_t*)bitmap->LockPixels();
+    if (!pixels) {
+        bitmap->UnlockPixels();
+        return -1;
+    }
+    int src_stride = surface->row_bytes();
+    int bw = bounds.right - bounds.left;
+    int bh = bounds.bottom - bounds.top;
+
+    copyPixels(pixels, src_stride, bounds.left, bounds.top, slot.patch.data(), bw * 4, 0, 0, bw, bh);
+
+    // This slot's frame was last brought up to date two stages ago; since then the surface
+    // changed in the front slot's rect and in the current one.
+    IntRect sync = {0, 0, width, height};
+    if (slot.valid && staging.front >= 0)
+        sync = unionRect(bounds, staging.slots[staging.front].rect);
+    copyPixels(pixels, src_stride, sync.left, sync.top, slot.frame.data(), staging.width * 4,
+               sync.left, sync.top, sync.right - sync.left, sync.bottom - sync.top);
+    bitmap->UnlockPixels();
+
+    slot.rect = bounds;
+    slot.valid = true;
+    staging.front = back;
+    staging.last_copy_ms.store(msSince(start), memory_order_relaxed);
+    countStagedFrame(staging, bw, bh);
+
+    *x = bounds.left;
+    *y = bounds.top;
+    *w = bw;
+    *h = bh;
+    return back;
+}
+
+// Resize the view (and with it its surface and staging memory). The staging buffers may move,
+// so callers have to fetch their addresses again afterwards.
+bool resizeSurface(int surface_id, int width, int height) {
+    if (width <= 0 || height <= 0)
+        return false;
+    return runOnRenderThread([&]() {
+        int index = slotIndex(surface_id);
+        if (index < 0 || !g_views[index])
+            return false;
+
+        g_views[index]->Resize(width, height);
+        Staging& staging = *g_staging[index];
+        allocateStaging(staging, width, height, (int)staging.slots.size());
+        return true;
+    });
+}
+
+// Device scale of a view: CSS pixels are laid out `scale` view pixels wide, so a view created at
+// a fraction of the widget size (with the same fraction as scale) keeps the same layout.
+void setSurfaceScale(int surface_id, double scale) {
+    if (scale <= 0)
         return;
+    runOnRenderThread([&]() {
+        RefPtr<View> view = lookupView(surface_id);
+        if (view)
+            view->set_device_scale(scale);
+    });
+}
 
-    ScrollEvent evt;
-    evt.delta_x = delta_x;
-    evt.delta_y = delta_y;
-    evt.type = ScrollEvent::kType_ScrollByPixel;
-    view->FireScrollEvent(evt);
+// Number of staging slots of a view: 2, or 3 with the render thread
+int getStagingSlotCount(int surface_id) {
+    int index = slotIndex(surface_id);
+    if (index < 0)
+        return 0;
+    return (int)g_staging[index]->slots.size();
+}
+
+// Address of a staging buffer so Python can wrap it once. `frame` selects the full-frame
+// copy instead of the packed patch. The memory stays put until the view is destroyed.
+void* getStagingBuffer(int surface_id, int slot, bool frame, int* size) {
+    int index = slotIndex(surface_id);
+    if (index < 0)
+        return nullptr;
+    Staging& staging = *g_staging[index];
+    if (slot < 0 || slot >= staging.slots.size())
+        return nullptr;
+
+    StagingSlot& s = staging.slots[slot];
+    vector<uint8_t>& buffer = frame ? s.frame : s.patch;
+    *size = (int)buffer.size();
+    return buffer.data();
+}
+
+// Hide or show a view. A hidden view isn't painted by the renderer nor published by the render
+// thread; once shown again, its pending paints happen in the next frame and the render thread
+// publishes the whole surface. Cheap, doesn't wait for the render thread.
+void setSurfaceVisible(int surface_id, bool visible) {
+    int index = slotIndex(surface_id);
+    if (index < 0)
+        return;
+    Staging& staging = *g_staging[index];
+    if (visible && !staging.visible.exchange(true))
+        staging.republish = true;
+    else if (!visible)
+        staging.visible = false;
+}
+
+// Keep painting a hidden view every `frames` frames (0 stops it), so its surface is ready to be shown
+// without a paint; nothing is published or staged for it meanwhile. For prerendered views. Cheap,
+// doesn't wait for the render thread.
+void setSurfaceBackgroundInterval(int surface_id, int frames) {
+    int index = slotIndex(surface_id);
+    if (index >= 0)
+        g_staging[index]->background_interval = max(frames, 0);
+}
+
+// Counters of a view since it was created. Cheap, doesn't wait for the render thread.
+bool getSurfaceStats(int surface_id, SurfaceStats* stats) {
+    int index = slotIndex(surface_id);
+    if (index < 0)
+        return false;
+    Staging& staging = *g_staging[index];
+    stats->frames_staged = staging.frames_staged.load(memory_order_relaxed);
+    stats->bytes_staged = staging.bytes_staged.load(memory_order_relaxed);
+    stats->dirty_pixels = staging.dirty_pixels.load(memory_order_relaxed);
+    stats->events_dispatched = staging.events_dispatched.load(memory_order_relaxed);
+    stats->last_dirty_pixels = staging.last_dirty_pixels.load(memory_order_relaxed);
+    stats->last_copy_ms = staging.last_copy_ms.load(memory_order_relaxed);
+    return true;
+}
+
+// Copy the durations of up to `capacity` of the most recent renderer frames, oldest first.
+// Returns how many were copied; `frames` receives the total number of frames rendered.
+int getRendererFrameTimes(float* update_ms, float* render_ms, int capacity, uint64_t* frames) {
+    lock_guard<mutex> lock(g_frame_times_mutex);
+    *frames = g_frame_count;
+    int count = (int)min<uint64_t>(g_frame_count, (uint64_t)min(capacity, kFrameTimeCount));
+    for (int i = 0; i < count; i++) {
+        uint64_t frame = g_frame_count - count + i;
+        update_ms[i] = g_update_ms[frame % kFrameTimeCount];
+        render_ms[i] = g_render_ms[frame % kFrameTimeCount];
+    }
+    return count;
+}
+
+// Release the lock when done
+void releaseSurfacePixels(int surface_id) {
+    runOnRenderThread([&]() {
+        RefPtr<View> view = lookupView(surface_id);
+        if (view)
+            view->surface()->UnlockPixels();
+    });
+}
+
+void dispatchMouseEvent(int surface_id, int x, int y, int button, const char * evtype) {
+    InputEvent ev = makeInputEvent(surface_id, kInput_MouseUp); // default/fallback
+
+    string type(evtype);
+    if (type == "down") {
+        ev.type = kInput_MouseDown;
+    } else if (type == "up") {
+        ev.type = kInput_MouseUp;
+    } else if (type == "move") {
+        ev.type = kInput_MouseMove;
+    }
+    ev.x = x;
+    ev.y = y;
+    ev.button = button;
+    submitInputEvent(ev);
+}
+
+void dispatchScrollEvent(int surface_id, int delta_x, int delta_y) {
+    InputEvent ev = makeInputEvent(surface_id, kInput_Scroll);
+    ev.x = delta_x;
+    ev.y = delta_y;
+    submitInputEvent(ev);
 }
 
 void dispatchKeyEvent(int surface_id, const char* type, int keycode, int modifiers, const char* character){
-    if (surface_id < 0 || surface_id >= g_views.size()) return;
+    string t(type);
+    if (t != "down" && t != "up")
+        return;
 
-    RefPtr<View> view = g_views[surface_id];
-    if (!view->HasInputFocus()) return;
-    if (!view) return;
-    KeyEvent event;
-    
-    // std::cout << "mODS" << modifiers <<endl;
-    if (string(type) == "down"){
-        event.type = KeyEvent::kType_RawKeyDown;
-        event.virtual_key_code = keycode;
-        // event.native_key_code = 0;
-    }
-    else if (string(type) == "up"){
-        event.type = KeyEvent::kType_KeyUp;
-        event.virtual_key_code = keycode;
-    }
-    
-    event.modifiers = modifiers;
-    GetKeyIdentifierFromVirtualKeyCode(keycode, event.key_identifier);
-    event.native_key_code = 0;
-    view->FireKeyEvent(event);
-    
+    InputEvent ev = makeInputEvent(surface_id, t == "down" ? kInput_KeyDown : kInput_KeyUp);
+    ev.keycode = keycode;
+    ev.modifiers = modifiers;
+    submitInputEvent(ev);
 }
 
 void dispatchCharEvent(int surface_id, const char* utf8_text) {
-    if (surface_id < 0 || surface_id >= g_views.size()) return;
-    RefPtr<View> view = g_views[surface_id];
-    if (!view->HasInputFocus()) return;
-    if (!view) return;
+    // Split the text over as many events as needed, never cutting a UTF-8 sequence in half
+    size_t len = strlen(utf8_text);
+    size_t start = 0;
+    while (start < len) {
+        InputEvent ev = makeInputEvent(surface_id, kInput_Char);
+        size_t end = min(len, start + sizeof(ev.text) - 1);
+        while (end < len && end > start && ((unsigned char)utf8_text[end] & 0xC0) == 0x80)
+            end--;
+        memcpy(ev.text, utf8_text + start, end - start);
+        submitInputEvent(ev);
+        start = end;
+    }
+}
 
-    KeyEvent ev;
-    ev.type = KeyEvent::kType_Char;
-    // strncpy(ev.text, utf8_text, sizeof(ev.text) - 1);
-    ev.text = utf8_text;
-    ev.unmodified_text = utf8_text;
-    view->FireKeyEvent(ev);
+// Submit a whole batch of input in one call, in order. Returns the number of events taken.
+int dispatchInputEvents(const InputEvent* events, int count) {
+    for (int i = 0; i < count; i++)
+        submitInputEvent(events[i]);
+    return max(count, 0);
 }
 
 bool loadURL(int surface_id, const char* url) {
-    if (surface_id < 0 || surface_id >= g_views.size())
+    if (slotIndex(surface_id) < 0)
+        return false;
+    string url_copy(url);
+    postTask([surface_id, url_copy]() {
+        RefPtr<View> view = lookupView(surface_id); // may have been destroyed in the meantime
+        if (!view) return;
+        view->LoadURL(url_copy.c_str());
+        // After the call: events of the replaced load that fire inside it (cancellation) come before the marker
+        queueLoadEvent(surface_id, kLoad_Requested, url_copy.c_str(), 0, String());
+    });
+    return true;
+}
+
+// Replace the view's content with an HTML string
+bool loadHTML(int surface_id, const char* html) {
+    if (slotIndex(surface_id) < 0)
         return false;
-    g_views[surface_id]->LoadURL(url);
+    string html_copy(html);
+    postTask([surface_id, html_copy]() {
+        RefPtr<View> view = lookupView(surface_id);
+        if (!view) return;
+        view->LoadHTML(html_copy.c_str());
+        queueLoadEvent(surface_id, kLoad_Requested, String(), 0, String());
+    });
     return true;
 }
 
+// Whether the main frame of the view is still loading
+bool isLoading(int surface_id) {
+    return runOnRenderThread([&]() {
+        RefPtr<View> view = lookupView(surface_id);
+        return view ? view->is_loading() : false;
+    });
+}
+
 bool isFocused(int surface_id) {
-    if (surface_id < 0 || surface_id >= g_views.size())
+    int index = slotIndex(surface_id);
+    if (index < 0)
         return false;
-    RefPtr<View> view = g_views[surface_id];
+    if (g_render_thread_running)
+        return g_staging[index]->focused;
+
+    RefPtr<View> view = g_views[index];
     if (!view) return false;
 
     return view->HasFocus();
 }
 
+// Move up to `capacity` queued load events, oldest first, into `events`. Returns how many were moved;
+// a return value equal to `capacity` means there may be more. Cheap, doesn't wait for the render thread.
+int pollLoadEvents(LoadEvent* events, int capacity) {
+    lock_guard<mutex> lock(g_load_events_mutex);
+    int count = min(capacity, (int)g_load_events.size());
+    copy(g_load_events.begin(), g_load_events.begin() + count, events);
+    g_load_events.erase(g_load_events.begin(), g_load_events.begin() + count);
+    return count;
+}
+
+// Evaluate `script` in the view's page without waiting for it. The result (or the exception) arrives
+// through pollScriptMessages with `request_id`; with request_id 0 only exceptions are reported.
+// Returns false for a dead handle.
+bool evaluateScript(int surface_id, const char* script, int request_id) {
+    if (slotIndex(surface_id) < 0)
+        return false;
+    string script_copy(script);
+    postTask([surface_id, script_copy, request_id]() {
+        RefPtr<View> view = lookupView(surface_id);
+        if (!view) return;
+        String exception;
+        String result = view->EvaluateScript(script_copy.c_str(), &exception);
+        if (!exception.empty())
+            queueScriptMessage(surface_id, kScript_Exception, request_id, toUTF8(exception));
+        else if (request_id != 0)
+            queueScriptMessage(surface_id, kScript_Result, request_id, toUTF8(result));
+    });
+    return true;
+}
+
+// Hand out up to `capacity` queued results and messages, oldest first. Their data stays valid until the
+// next call, which releases it; a return value equal to `capacity` means there may be more.
+// Cheap, doesn't wait for the render thread.
+int pollScriptMessages(ScriptMessage* messages, int capacity) {
+    lock_guard<mutex> lock(g_script_messages_mutex);
+    g_script_messages_delivered.clear();
+    int count = min(capacity, (int)g_script_messages.size());
+    g_script_messages_delivered.reserve(count); // no reallocation below, the pointers handed out must stay put
+    for (int i = 0; i < count; i++) {
+        g_script_messages_delivered.push_back(move(g_script_messages.front()));
+        g_script_messages.pop_front();
+        const QueuedScriptMessage& queued = g_script_messages_delivered.back();
+        messages[i] = {queued.surface_id, queued.type, queued.request_id, (int32_t)queued.data.size(), queued.data.data()};
+    }
+    return count;
+}
+
 void focusView(int surface_id) {
-    if (surface_id < 0 || surface_id >= g_views.size()) return;
-    RefPtr<View> view = g_views[surface_id];
-    if (!view) return;
-    view->Focus();
+    int index = slotIndex(surface_id);
+    if (index < 0) return;
+    g_staging[index]->focused = true; // so key events right after a click aren't dropped while the task is pending
+    postTask([surface_id]() {
+        RefPtr<View> view = lookupView(surface_id);
+        if (!view) return;
+        view->Focus();
+    });
 }
 
 
 
-// Cleanup everything
+// Where Ultralight finds files: `file_system_dir` is the root for file:/// URLs, `resource_prefix`
+// is where its resources (cacert.pem, icudt67l.dat) live inside it, `log_path` is the log file.
+// NULL keeps the current value. Only possible before the renderer is created; returns false after.
+bool configurePlatform(const char* file_system_dir, const char* resource_prefix, const char* log_path) {
+    return runOnRenderThread([&]() {
+        if (g_platform_initialized)
+            return false;
+        if (file_system_dir) g_file_system_dir = file_system_dir;
+        if (resource_prefix) g_resource_prefix = resource_prefix;
+        if (log_path) g_log_path = log_path;
+        return true;
+    });
+}
+
+// Byte budget of the asset cache, and how long (seconds) a cached file is trusted before it is checked against
+// the disk again: 0 checks on every open, a negative value never does. Possible at any time; a smaller budget
+// evicts right away.
+void configureAssetCache(uint64_t budget_bytes, double revalidate_after) {
+    assetFileSystem().configure(budget_bytes, revalidate_after);
+}
+
+// Serve files from the bundle at `path` (built by pack_assets.py) ahead of the disk, replacing any bundle
+// mounted before. NULL unmounts. Returns false, keeping the current bundle, if the file isn't a valid bundle.
+// Pages already loaded keep the memory of the old bundle until they let go of it.
+bool mountAssetBundle(const char* path) {
+    if (!path) {
+        assetFileSystem().mount(nullptr);
+        return true;
+    }
+    auto bundle = make_shared<AssetBundle>();
+    if (!bundle->open(path))
+        return false;
+    assetFileSystem().mount(move(bundle));
+    return true;
+}
+
+void clearAssetCache() {
+    assetFileSystem().clear();
+}
+
+void getAssetStats(AssetStats* stats) {
+    *stats = assetFileSystem().getStats();
+}
+
+// Create the renderer and fill its font and layout caches ahead of the first WebSurface. The
+// warm-up view goes into the view pool, so the first WebSurface doesn't create one either.
+// With the render thread this happens there, without blocking the caller.
+void prewarmRenderer() {
+    g_pooled_views++;
+    postTask([]() {
+        ensureRenderer();
+        ViewConfig config;
+        config.is_accelerated = false;
+        RefPtr<View> view = g_renderer->CreateView(64, 64, config, nullptr);
+        view->LoadHTML("<html><body style='font-family: sans-serif'>Warm <b>up</b> <i>the</i> "
+                       "<span style='font-family: serif'>font</span> <code>caches</code></body></html>");
+        g_renderer->Update();
+        g_renderer->Render();
+        g_view_pool.push_back(view);
+    });
+}
+
+// Create `count` blank views of the given size ahead of time, so later WebSurfaces skip view
+// creation. With the render thread this happens there, without blocking the caller.
+void prewarmViews(int count, int width, int height) {
+    if (width <= 0 || height <= 0)
+        return;
+    g_pooled_views += count;
+    postTask([count, width, height]() {
+        ensureRenderer();
+        ViewConfig config;
+        config.is_accelerated = false;
+        for (int i = 0; i < count; i++)
+            g_view_pool.push_back(g_renderer->CreateView(width, height, config, nullptr));
+    });
+}
+
+// Counts views still being created too, so a caller topping the pool up never requests too many
+int getPooledViewCount() {
+    return g_pooled_views.load();
+}
+
+void clearViewPool() {
+    runOnRenderThread([]() { clearPool(); });
+}
+
+// Drop what the renderer keeps cached (decoded images, fonts, JS garbage, ...) and optionally the
+// view pool. Cheap to call; the caches simply refill as pages need them again.
+void purgeMemory(bool clear_view_pool) {
+    runOnRenderThread([&]() {
+        if (clear_view_pool)
+            clearPool();
+        if (g_renderer)
+            g_renderer->PurgeMemory();
+    });
+}
+
+// Writes the renderer's own breakdown of its memory usage to the Ultralight log
+void logMemoryUsage() {
+    runOnRenderThread([]() {
+        if (g_renderer)
+            g_renderer->LogMemoryUsage();
+    });
+}
+
+void getMemoryStats(MemoryStats* stats) {
+    runOnRenderThread([&]() {
+        stats->views = 0;
+        stats->staging_bytes = 0;
+        for (int i = 0; i < (int)g_views.size(); i++) {
+            if (g_views[i])
+                stats->views++;
+            for (const StagingSlot& slot : g_staging[i]->slots)
+                stats->staging_bytes += slot.patch.capacity() + slot.frame.capacity();
+        }
+        stats->pooled_views = (int)g_view_pool.size();
+    });
+}
+
+// Release the view, its staging memory and its slot. The handle (and any copy of it) is dead afterwards.
 void destroySurface(int surface_id) {
-    if (surface_id < 0 || surface_id >= g_views.size()) return;
-    RefPtr<View> view = g_views[surface_id];
-    view = nullptr;
+    runOnRenderThread([&]() {
+        int index = slotIndex(surface_id);
+        if (index < 0) return;
+
+        g_views[index]->set_load_listener(nullptr);
+        g_views[index] = nullptr;
+        Staging& staging = *g_staging[index];
+        staging.slots.clear();
+        staging.slots.shrink_to_fit();
+        staging.focused = false;
+        g_generations[index] = g_generations[index] % 0x7FFF + 1;
+        g_free_slots.push_back(index);
+    });
 }
 
+// Cleanup everything
 void destroyRenderer(){
-    g_renderer = nullptr;
+    runOnRenderThread([]() {
+        clearPool();
+        g_renderer = nullptr;
+    });
+    if (g_render_thread_running) {
+        g_render_thread_running = false;
+        g_render_thread.join();
+    }
 }
 
 } // extern "C"
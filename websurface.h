@@ -0,0 +1,159 @@
+// C interface of libwebsurface.so. Used by websurface.cpp itself and by the optional
+// compiled Python binding (build_binding.py). The part between the cdef markers is fed to
+// cffi as is, so it must stay free of preprocessor lines.
+#ifndef WEBSURFACE_H
+#define WEBSURFACE_H
+
+#include <stdint.h>
+#include <stdbool.h>
+
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+// cdef-begin
+
+// Input events in a compact, copyable form so they can be batched and queued for the render thread
+enum InputEventType {
+    kInput_MouseDown = 0,
+    kInput_MouseUp = 1,
+    kInput_MouseMove = 2,
+    kInput_Scroll = 3,   // x/y hold the scroll deltas
+    kInput_KeyDown = 4,
+    kInput_KeyUp = 5,
+    kInput_Char = 6      // text holds the UTF-8 characters
+};
+
+typedef struct InputEvent {
+    int32_t surface_id;
+    int32_t type;
+    int32_t x;
+    int32_t y;
+    int32_t button;
+    int32_t keycode;
+    int32_t modifiers;
+    char text[8]; // NUL terminated
+} InputEvent;
+
+// Per-view counters, see getSurfaceStats
+typedef struct SurfaceStats {
+    uint64_t frames_staged;     // stages that handed a frame to Python
+    uint64_t bytes_staged;      // bytes handed to Python for upload
+    uint64_t dirty_pixels;      // total area of those frames
+    uint64_t events_dispatched; // input events fired on the view
+    int32_t last_dirty_pixels;
+    float last_copy_ms;         // pixel lock + copy of the last staged frame
+} SurfaceStats;
+
+// Native memory held by the library itself, see getMemoryStats
+typedef struct MemoryStats {
+    int32_t views;          // live views
+    int32_t pooled_views;   // blank views waiting in the view pool
+    uint64_t staging_bytes; // staging buffers of all views
+} MemoryStats;
+
+// Page load progress of a view's main frame, see pollLoadEvents
+enum LoadEventType {
+    kLoad_Begin = 0,
+    kLoad_DOMReady = 1,
+    kLoad_Finish = 2,
+    kLoad_Fail = 3,      // error_code and description are set
+    kLoad_Requested = 4  // a loadURL/loadHTML call took effect: later events belong to that load
+};
+
+typedef struct LoadEvent {
+    int32_t surface_id;
+    int32_t type;
+    int32_t error_code;
+    char url[1024];        // NUL terminated, cut off if longer
+    char description[256]; // NUL terminated, cut off if longer
+} LoadEvent;
+
+// What comes back from the page, see pollScriptMessages
+enum ScriptMessageType {
+    kScript_Result = 0,    // result of evaluateScript as a string
+    kScript_Exception = 1, // evaluateScript threw, data holds the exception
+    kScript_Message = 2    // the page called websurface.post(message), data holds JSON.stringify(message)
+};
+
+typedef struct ScriptMessage {
+    int32_t surface_id;
+    int32_t type;
+    int32_t request_id; // as passed to evaluateScript, 0 for kScript_Message
+    int32_t length;
+    const char* data;   // UTF-8, `length` bytes, valid until the next pollScriptMessages call
+} ScriptMessage;
+
+// Counters of the asset file system, see getAssetStats
+typedef struct AssetStats {
+    uint64_t cache_hits;     // files served from the in-memory cache
+    uint64_t bundle_hits;    // files served from the mounted bundle
+    uint64_t disk_reads;     // files read from disk
+    uint64_t evictions;      // cache entries dropped for the byte budget
+    uint64_t invalidations;  // cache entries dropped because the file on disk changed
+    uint64_t cache_bytes;
+    uint64_t cache_budget;
+    int32_t cache_entries;
+    int32_t bundle_entries;
+} AssetStats;
+
+bool startRenderThread(int fps);
+bool isRenderThreadRunning(void);
+
+int initWebSurface(int width, int height, const char* html);
+bool renderWebSurface(void);
+
+const void* getSurfacePixels(int surface_id, int* width, int* height, int* stride);
+void releaseSurfacePixels(int surface_id);
+bool getSurfaceDirtyBounds(int surface_id, int* left, int* top, int* right, int* bottom);
+
+int stageSurfacePixels(int surface_id, bool full, int* x, int* y, int* w, int* h);
+bool resizeSurface(int surface_id, int width, int height);
+void setSurfaceScale(int surface_id, double scale);
+int getStagingSlotCount(int surface_id);
+void* getStagingBuffer(int surface_id, int slot, bool frame, int* size);
+
+void dispatchMouseEvent(int surface_id, int x, int y, int button, const char* evtype);
+void dispatchScrollEvent(int surface_id, int delta_x, int delta_y);
+void dispatchKeyEvent(int surface_id, const char* type, int keycode, int modifiers, const char* character);
+void dispatchCharEvent(int surface_id, const char* utf8_text);
+int dispatchInputEvents(const InputEvent* events, int count);
+
+void setSurfaceVisible(int surface_id, bool visible);
+void setSurfaceBackgroundInterval(int surface_id, int frames);
+bool getSurfaceStats(int surface_id, SurfaceStats* stats);
+int getRendererFrameTimes(float* update_ms, float* render_ms, int capacity, uint64_t* frames);
+
+bool loadURL(int surface_id, const char* url);
+bool loadHTML(int surface_id, const char* html);
+bool isLoading(int surface_id);
+bool isFocused(int surface_id);
+int pollLoadEvents(LoadEvent* events, int capacity);
+bool evaluateScript(int surface_id, const char* script, int request_id);
+int pollScriptMessages(ScriptMessage* messages, int capacity);
+void focusView(int surface_id);
+
+bool configurePlatform(const char* file_system_dir, const char* resource_prefix, const char* log_path);
+void configureAssetCache(uint64_t budget_bytes, double revalidate_after);
+bool mountAssetBundle(const char* path);
+void clearAssetCache(void);
+void getAssetStats(AssetStats* stats);
+void prewarmRenderer(void);
+void prewarmViews(int count, int width, int height);
+int getPooledViewCount(void);
+void clearViewPool(void);
+
+void purgeMemory(bool clear_view_pool);
+void logMemoryUsage(void);
+void getMemoryStats(MemoryStats* stats);
+
+void destroySurface(int surface_id);
+void destroyRenderer(void);
+
+// cdef-end
+
+#ifdef __cplusplus
+} // extern "C"
+#endif
+
+#endif // WEBSURFACE_H
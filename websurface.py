@@ -1,30 +1,568 @@
 # from kivy.uix.widget import Widget
 from kivy.uix.floatlayout import FloatLayout
+from kivy.uix.stencilview import StencilView
 from kivy.graphics.texture import Texture
 from kivy.properties import NumericProperty
-from kivy.graphics import Rectangle, Color
+from kivy.graphics import Rectangle, Color, Mesh, InstructionGroup
 from kivy.core.window import Window
 from kivy.clock import Clock
+from kivy.logger import Logger
 from kivy.app import App
 
-import keyboard # for global key listening
+import asyncio
+import json
+from collections import OrderedDict
+from time import perf_counter
 from core import *
+import stats
+import memory
+import recording
+
+
+class FrameScheduler:
+    ''' Drives all WebSurface instances from a single Clock event.
+    The global Ultralight renderer is updated and rendered exactly once per tick, then each registered
+    surface uploads its pixels whenever its own `fps` interval has elapsed. The tick rate follows the
+    highest `fps` among the registered surfaces.
+
+    With `adaptive` on, the tick rate drops to `idle_fps` once nothing has been painted and no input has arrived
+    for `idle_after` seconds, and goes back to full rate on the next input (see wake()) or as soon as a page
+    paints again (an animation, a timer changing the DOM, a load). Timers on a static page run at `idle_fps`
+    meanwhile, since Ultralight can't be asked whether any are pending. `idle_fps = 0` stops ticking entirely
+    until wake() is called. `tick_count` counts the ticks, to measure the effect.
+
+    With `track_visibility` on, every `visibility_interval` seconds each surface checks whether it can be seen
+    at all (see WebSurface.is_visible); hidden surfaces, and all of them while the window is minimized, are
+    neither painted nor uploaded until they show up again.'''
+    adaptive = False
+    idle_fps = 4
+    idle_after = 0.5
+    track_visibility = True
+    visibility_interval = 0.1
+
+    def __init__(self):
+        self._elapsed = {} # surface -> time since its last upload
+        self._event = None
+        self._interval = None
+        self.tick_count = 0
+        self.idle = False
+        self._last_activity = perf_counter()
+        self._last_visibility_check = 0.0
+        self.window_hidden = False
+        Window.bind(on_minimize=self._on_window_hidden, on_hide=self._on_window_hidden,
+                    on_restore=self._on_window_shown, on_show=self._on_window_shown)
+
+    def _on_window_hidden(self, *args):
+        self.window_hidden = True
+        self._last_visibility_check = 0.0 # re-check on the next tick
+
+    def _on_window_shown(self, *args):
+        self.window_hidden = False
+        self._last_visibility_check = 0.0
+        self.wake()
+
+    def register(self, surface):
+        self._elapsed[surface] = 0.0
+        self._last_activity = perf_counter() # a new page is about to load
+        self.idle = False
+        self._reschedule()
+
+    def unregister(self, surface):
+        self._elapsed.pop(surface, None)
+        self._reschedule()
+
+    def wake(self):
+        ''' Input arrived (or something else that is about to change a page): leave the idle rate right away '''
+        self._last_activity = perf_counter()
+        if self.idle:
+            self.idle = False
+            self._reschedule()
+
+    def _reschedule(self):
+        if not self._elapsed:
+            interval = None
+        elif self.idle:
+            interval = 1 / self.idle_fps if self.idle_fps > 0 else None
+        else:
+            interval = 1 / max(s.fps for s in self._elapsed)
+        if interval == self._interval:
+            return
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        self._interval = interval
+        if interval is not None:
+            self._event = Clock.schedule_interval(self._tick, interval)
+
+    def _tick(self, dt):
+        start = perf_counter()
+        self.tick_count += 1
+        had_input = False
+        for backend in backends:
+            had_input = had_input or len(backend.input_queue) > 0
+            backend.input_queue.flush() # the input gathered since the last tick, in one native call (or pipe message)
+
+        # Before rendering, so a surface that just became visible is painted and uploaded in this very tick
+        if self.track_visibility and start - self._last_visibility_check >= self.visibility_interval:
+            self._last_visibility_check = start
+            for surface in self._elapsed:
+                if surface.update_visibility(self.window_hidden):
+                    self._elapsed[surface] = 1 / surface.fps # due right away
+                    had_input = True # counts as activity for the adaptive pacing
+
+        for surface in self._elapsed:
+            if surface._js_data or surface._js_batch:
+                surface.flush_js() # one evaluation per surface, before the frame that should show its effect
+
+        painted = False
+        for backend in backends:
+            painted = backend.binding.render() or painted
+            load_events = backend.poll_load_events()
+            if load_events:
+                self._dispatch_load_events(backend, load_events)
+            script_messages = backend.poll_script_messages()
+            if script_messages:
+                self._dispatch_script_messages(backend, script_messages)
+                had_input = True
+        if stats.frame_hooks:
+            update_ms, render_ms, frames = stats.last_frame_times()
+            stats.emit({"name": "renderer", "surface": None, "start": start, "duration": perf_counter() - start,
+                        "update_ms": update_ms, "render_ms": render_ms, "frame": frames})
+        atlases = set()
+        for surface, elapsed in list(self._elapsed.items()):
+            if not surface.visible:
+                continue
+            elapsed += dt
+            period = 1 / surface.fps
+            if elapsed >= period - 0.001: # tolerate Clock jitter, or surfaces at the tick rate would skip frames
+                surface.update(elapsed)
+                if surface._atlas is not None:
+                    atlases.add(surface._atlas)
+                # Keep the remainder so in-between rates (e.g. 30 on a 40 fps tick) average out, but never build up a backlog
+                elapsed = min(max(elapsed - period, 0.0), period)
+            self._elapsed[surface] = elapsed
+        for atlas in atlases:
+            atlas.upload() # everything its cards staged this tick, in as few blits as possible
+        end = perf_counter()
+        stats.tick_times.add((end - start) * 1000)
+
+        if self.adaptive:
+            if painted or had_input:
+                self._last_activity = end
+            idle = end - self._last_activity > self.idle_after
+            if idle != self.idle:
+                self.idle = idle
+                self._reschedule()
+
+    def _surfaces_of(self, backend):
+        return {surface.index: surface for surface in self._elapsed if surface._backend is backend}
+
+    def _dispatch_load_events(self, backend, events):
+        surfaces = self._surfaces_of(backend)
+        for surface_id, type, url, error_code, description in events:
+            surface = surfaces.get(surface_id)
+            if surface is not None:
+                surface._load_event(type, url, error_code, description)
+            else: # a prerendered view, or one that has been destroyed or evicted
+                prerender_pool._load_event(backend, surface_id, type)
+
+    def _dispatch_script_messages(self, backend, messages):
+        grouped = {}
+        for surface_id, type, request_id, data in messages:
+            grouped.setdefault(surface_id, []).append((type, request_id, data))
+        surfaces = self._surfaces_of(backend)
+        for surface_id, surface_messages in grouped.items():
+            surface = surfaces.get(surface_id)
+            if surface is not None:
+                surface._script_messages(surface_messages)
+
+frame_scheduler = FrameScheduler()
+input_queue = InputQueue() # shared by all surfaces, flushed by frame_scheduler once per tick
+local_backend = Backend(lib, binding, input_queue, wrap_staging_buffer, poll_load_events, poll_script_messages) # this process' own renderer
+backends = [local_backend] # every renderer frame_scheduler drives, see start_worker_processes()
+worker_pool = None # new surfaces go to these renderer processes when set
+renderer_stats = stats.renderer_stats
+memory_policy = None # the installed MemoryPolicy, if any
+
+
+_view_pool_refill = None # (pool size, width, height) while the refill chain runs, see _start_view_pool_refill()
+
+def _start_view_pool_refill(size, width, height):
+    # A single chain for all surfaces, sized after the latest one; a running chain just takes the new target
+    global _view_pool_refill
+    running = _view_pool_refill is not None
+    _view_pool_refill = (size, width, height)
+    if not running:
+        Clock.schedule_once(_refill_view_pool)
+
+def _refill_view_pool(*args):
+    # One view per frame, so refilling never costs more than a single view creation at a time. The native count
+    # includes views still being created and doesn't wait for the render thread.
+    global _view_pool_refill
+    size, width, height = _view_pool_refill
+    if local_backend.lib.getPooledViewCount() < size:
+        local_backend.lib.prewarmViews(1, width, height)
+        Clock.schedule_once(_refill_view_pool)
+    else:
+        _view_pool_refill = None
+
+def _complete(future, error=None, result=None):
+    if not future.done():
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+
+# Wraps a batch of eval_js() scripts (and the send_js() data) into one evaluation. Each part runs on its own, so one
+# throwing doesn't stop the others, and the result is the JSON list of [failed, value] of every part.
+_JS_BATCH = '''(function () {
+    function _call(fn) { try { return [0, String(fn())]; } catch (e) { return [1, String(e)]; } }
+    function _run(source) { return _call(function () { return (0, eval)(source); }); }
+    return JSON.stringify([%s]);
+})()'''
+_JS_RECEIVE = "_call(function () { if (window.websurface) websurface._receive(%s); })"
+
+
+def _decode_message(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        return data # websurface.post(undefined) and the like
+
+
+class _Prerendered:
+    def __init__(self, backend, handle, width, height, scale, url, html):
+        self.backend, self.handle = backend, handle
+        self.width, self.height, self.scale = width, height, scale
+        self.url, self.html = url, html
+        self.load_state = "loading"
+        self.loads_requested = 0
+        self.bytes = width * height * 4 * (1 + 2 * backend.lib.getStagingSlotCount(handle)) # surface + staging
+
+
+class PrerenderPool:
+    ''' Offscreen views loaded ahead of time, for WebSurface.activate_prerendered(). They are hidden, and painted every
+    `render_interval` frames (at full rate while loading), so they are laid out and painted by the time they are shown.
+    At most `max_views` views and `max_bytes` of their pixel memory are kept, the least recently prerendered go first.
+    `prerender_pool` is the instance WebSurface uses. '''
+    render_interval = 10
+
+    def __init__(self, max_views=4, max_bytes=256 << 20):
+        self.max_views = max_views
+        self.max_bytes = max_bytes
+        self._entries = {} # key -> _Prerendered, least recently prerendered first
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def prerender(self, key, url=None, html=None, width=800, height=600, scale=1.0, backend=None):
+        ''' Loads `url` (or `html`) into a new offscreen view of the given view size and render scale, under `key`.
+        Replaces an earlier view with that key. Returns False if the view couldn't be created. '''
+        if backend is None:
+            backend = worker_pool.assign() if worker_pool is not None else local_backend
+        self.discard(key)
+        handle = backend.lib.initWebSurface(width, height, bytes(html or "", "utf8"))
+        if handle < 0:
+            return False
+        if scale != 1:
+            backend.lib.setSurfaceScale(handle, scale)
+        backend.lib.setSurfaceVisible(handle, False)
+        backend.lib.setSurfaceBackgroundInterval(handle, self.render_interval)
+        entry = _Prerendered(backend, handle, width, height, scale, url, html)
+        if url is not None:
+            entry.loads_requested = 1
+            backend.lib.loadURL(handle, bytes(url, "utf8"))
+        self._entries[key] = entry
+        self._trim()
+        frame_scheduler.wake()
+        return True
+
+    def is_ready(self, key):
+        ''' Whether the view under `key` has finished loading '''
+        entry = self._entries.get(key)
+        return entry is not None and entry.loads_requested == 0 and entry.load_state == "loaded"
+
+    def take(self, key, backend):
+        ''' Removes the view under `key` from the pool and returns it, or None if there is none for `backend` '''
+        entry = self._entries.get(key)
+        if entry is None or entry.backend is not backend:
+            return None
+        del self._entries[key]
+        if not backend.lib.getStagingSlotCount(entry.handle):
+            return None # its worker process died
+        return entry
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.backend.lib.destroySurface(entry.handle)
+
+    def discard_oldest(self):
+        if self._entries:
+            self.discard(next(iter(self._entries)))
+
+    def clear(self):
+        while self._entries:
+            self.discard_oldest()
+
+    def _trim(self):
+        while len(self._entries) > self.max_views or sum(e.bytes for e in self._entries.values()) > self.max_bytes:
+            self.discard_oldest()
+
+    def _load_event(self, backend, handle, type):
+        for entry in self._entries.values():
+            if entry.handle == handle and entry.backend is backend:
+                break
+        else:
+            return
+        if type == LOAD_REQUESTED:
+            entry.loads_requested = max(0, entry.loads_requested - 1)
+        elif entry.loads_requested == 0:
+            if type == LOAD_DOM_READY and entry.load_state == "loading":
+                entry.load_state = "dom_ready"
+            elif type == LOAD_FINISH and entry.load_state != "failed":
+                entry.load_state = "loaded"
+            elif type == LOAD_FAIL:
+                entry.load_state = "failed"
+
+prerender_pool = PrerenderPool()
+
+
+class MemoryPolicy:
+    ''' Decides when to purge the renderer's caches and when to evict hidden surfaces. Does nothing until installed:
+
+        MemoryPolicy(purge_interval=120, rss_limit=800 * 2**20, evict_after=30).install()
+
+    The caches are purged every `purge_interval` seconds, when RSS is above `rss_limit` bytes (then at most every
+    `rss_purge_interval` seconds), and shortly after surfaces are hidden (`purge_on_hide`) or destroyed (`purge_on_destroy`).
+    Hidden surfaces are evicted least recently hidden first: after `evict_after` seconds, beyond `max_hidden_views`
+    live hidden surfaces, or one per check while RSS is above `rss_limit`. See WebSurface.evict(). Above `rss_limit`,
+    prerendered views (see PrerenderPool) are dropped before any surface is evicted.
+    Purges and evictions are counted in memory.counters, which renderer_stats() includes. '''
+    check_interval = 1.0
+    rss_purge_interval = 10.0
+
+    def __init__(self, purge_interval=None, rss_limit=None, purge_on_hide=True, purge_on_destroy=True,
+                 evict_after=None, max_hidden_views=None):
+        self.purge_interval = purge_interval
+        self.rss_limit = rss_limit
+        self.purge_on_hide = purge_on_hide
+        self.purge_on_destroy = purge_on_destroy
+        self.evict_after = evict_after
+        self.max_hidden_views = max_hidden_views
+        self._hidden = {} # surface -> when it was hidden, least recently hidden first
+        self._pending = None # reason of a purge due on the next check
+        self._last_purge = perf_counter()
+        self._event = None
+
+    def install(self):
+        global memory_policy
+        if memory_policy is not None:
+            memory_policy.uninstall()
+        memory_policy = self
+        self._event = Clock.schedule_interval(self._check, self.check_interval)
+        return self
+
+    def uninstall(self):
+        global memory_policy
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        if memory_policy is self:
+            memory_policy = None
+
+    ## { Called by WebSurface
+    def surface_hidden(self, surface):
+        self._hidden.pop(surface, None)
+        self._hidden[surface] = perf_counter()
+        if self.purge_on_hide:
+            self._pending = "hidden"
+
+    def surface_shown(self, surface):
+        self._hidden.pop(surface, None)
+
+    def surface_destroyed(self, surface):
+        self._hidden.pop(surface, None)
+        if self.purge_on_destroy:
+            self._pending = "destroyed"
+    ## }
+
+    def _check(self, dt):
+        now = perf_counter()
+        rss = memory.rss_bytes() if self.rss_limit else None
+        over_limit = rss is not None and rss > self.rss_limit
+
+        if over_limit and len(prerender_pool):
+            prerender_pool.discard_oldest()
+            self._pending = "evicted"
+            over_limit = False # one step per check
+        live = [surface for surface in self._hidden if not surface.evicted]
+        excess = len(live) - self.max_hidden_views if self.max_hidden_views is not None else 0
+        for i, surface in enumerate(live):
+            if i < excess or (self.evict_after is not None and now - self._hidden[surface] >= self.evict_after) \
+                    or (over_limit and i == 0):
+                surface.evict()
+                self._pending = "evicted"
+
+        reason = self._pending
+        if reason is None and self.purge_interval and now - self._last_purge >= self.purge_interval:
+            reason = "timer"
+        if reason is None and over_limit and now - self._last_purge >= self.rss_purge_interval:
+            reason = "rss"
+        if reason is not None:
+            self._pending = None
+            self._last_purge = now
+            memory.purge(reason)
+
+
+class _Tiles:
+    ''' The textures of a tiled WebSurface: one per `tile_size` square of the view, created when the tile comes near the
+    viewport and dropped, least recently needed first, beyond `max_tiles`. Tiles that change while they are out of view
+    are only uploaded once they are near it again. '''
+
+    def __init__(self, surface):
+        self.surface = surface
+        self.size = surface.tile_size
+        self.group = InstructionGroup()
+        surface.canvas.add(self.group)
+        self.resident = OrderedDict() # (column, row) -> Rectangle, least recently needed first
+        self.dirty = set() # resident tiles whose pixels changed since their last upload
+        self.uploads = 0
+        self._buffer = bytearray(self.size * self.size * 4) # a tile's rows, packed for blit_buffer
+
+    def reset(self):
+        ''' Drops every tile, e.g. after a resize; the next update() fills the ones in view again '''
+        self.group.clear()
+        self.resident.clear()
+        self.dirty.clear()
+
+    def invalidate(self, x, y, w, h):
+        size = self.size
+        for column in range(x // size, (x + w - 1) // size + 1):
+            for row in range(y // size, (y + h - 1) // size + 1):
+                if (column, row) in self.resident:
+                    self.dirty.add((column, row))
+
+    def needed(self):
+        ''' The tiles that intersect the visible part of the widget, widened by one tile on every side so that scrolling
+        finds its next tiles filled already '''
+        surface, size = self.surface, self.size
+        area = surface._visible_rect()
+        if area is None:
+            return []
+        left, bottom, right, top = area
+        x, y = surface.to_window(surface.x, surface.y)
+        scale_x, scale_y = surface.uw / surface.width, surface.uh / surface.height
+        # Window coordinates to view pixels, rows counted from the top
+        columns = range(max(0, int((left - x) * scale_x) // size - 1),
+                        min(-(-surface.uw // size), int((right - x) * scale_x) // size + 2))
+        rows = range(max(0, int((y + surface.height - top) * scale_y) // size - 1),
+                     min(-(-surface.uh // size), int((y + surface.height - bottom) * scale_y) // size + 2))
+        return [(column, row) for row in rows for column in columns]
+
+    def update(self, frame):
+        ''' Creates or uploads the needed tiles that are missing or dirty, from `frame` (the view's latest full frame),
+        then drops the least recently needed ones beyond max_tiles '''
+        needed = self.needed()
+        for key in needed:
+            rect = self.resident.get(key)
+            if rect is None:
+                rect = self.resident[key] = self._create(key)
+                self._upload(key, rect, frame)
+            elif key in self.dirty:
+                self._upload(key, rect, frame)
+            self.resident.move_to_end(key)
+            self.dirty.discard(key)
+        # The needed tiles are the most recent ones now, so the oldest tile is only needed if all of them are
+        while len(self.resident) > self.surface.max_tiles:
+            key = next(iter(self.resident))
+            if key in needed:
+                break
+            self.group.remove(self.resident.pop(key))
+            self.dirty.discard(key)
+
+    def layout(self):
+        for key, rect in self.resident.items():
+            self._place(key, rect)
+
+    def _create(self, key):
+        surface, size = self.surface, self.size
+        w, h = min(size, surface.uw - key[0] * size), min(size, surface.uh - key[1] * size)
+        texture = Texture.create(size=(w, h), colorfmt='bgra')
+        texture.flip_vertical() # rows are uploaded top-first, like the surface's own texture
+        rect = Rectangle(texture=texture)
+        self._place(key, rect)
+        self.group.add(rect)
+        return rect
+
+    def _place(self, key, rect):
+        surface, size = self.surface, self.size
+        w, h = rect.texture.size
+        scale_x, scale_y = surface.width / surface.uw, surface.height / surface.uh
+        rect.pos = (surface.x + key[0] * size * scale_x, surface.y + surface.height - (key[1] * size + h) * scale_y)
+        rect.size = (w * scale_x, h * scale_y)
+
+    def _upload(self, key, rect, frame):
+        surface, size = self.surface, self.size
+        (w, h), stride = rect.texture.size, surface.uw * 4
+        at = key[1] * size * stride + key[0] * size * 4
+        if w == surface.uw:
+            data = frame[at:at + h * stride] # a tile as wide as the view is contiguous already
+        else:
+            row, data = w * 4, self._buffer
+            for offset in range(0, row * h, row):
+                data[offset:offset + row] = frame[at:at + row]
+                at += stride
+            data = memoryview(data)[:row * h]
+        rect.texture.blit_buffer(data, size=(w, h), colorfmt='bgra', bufferfmt='ubyte')
+        self.uploads += 1
 
 
 class WebSurface(FloatLayout):
-    _renderer_is_being_updated = False # static value that must be checked to prevent updating the global ultralight renderer for each WebSurface instance. Only one is needed
+    ''' Load events, dispatched once per frame_scheduler tick for the main frame of the page:
+    on_load_begin(url), on_dom_ready(url), on_load_finish(url) and on_load_fail(url, error_code, description).
+    Surfaces rendered in a worker process get them with an empty url and description. `load_state` follows them:
+    "loading", "dom_ready", "loaded" or "failed".
+
+    on_js_messages(messages) delivers, once per tick, everything the page sent with websurface.post(message)
+    since the last one, each message decoded from JSON. '''
+    __events__ = ("on_load_begin", "on_dom_ready", "on_load_finish", "on_load_fail", "on_js_messages")
     # index = NumericProperty(-1)
     invert_vertical_scroll = False # Property to invert vertical mouse scroll direction. Change as you please.
     scroll_delta = 20  # Amount to scroll per scroll event
+    resize_delay = 0.1 # Seconds without further size changes before the Ultralight view is actually resized
+    texture_granularity = 64 # Texture allocations are rounded up to a multiple of this, so a growing window doesn't reallocate every step
+    view_pool_size = 0 # Blank native views to keep pre-created (see prewarm_views). 0 disables the pool
+    # Dynamic render scale (see render_scale): lowered by scale_step when frames go over budget, raised again with headroom
+    dynamic_scale = False
+    min_render_scale = 0.5
+    scale_step = 0.1
+    scale_check_interval = 1.0 # seconds of frames judged before each adjustment
+    batch_js = False # eval_js() scripts wait for the next tick and run in one evaluation with everything queued until then
+    # Tiled surfaces (see tiled): edge of a tile in view pixels, and how many tile textures may stay allocated
+    tile_size = 512
+    max_tiles = 32
 
-    def __init__(self, width=200, height=200, html="<html><body><h1>Hi</h1></body></html>", fps=30, **kwargs):
+    def __init__(self, width=200, height=200, html="<html><body><h1>Hi</h1></body></html>", fps=30, render_scale=1.0,
+                 tiled=False, **kwargs):
+        ''' `render_scale` (0 < scale <= 1) renders the page at that fraction of the widget's resolution, with the same
+        device scale so the layout doesn't change, and lets the Rectangle stretch it to the widget size.
+        `tiled` splits the surface into `tile_size` tiles with a texture each, for surfaces much larger than what can be
+        seen (e.g. a long document in a ScrollView): only the tiles in and next to the visible part are uploaded, and
+        at most `max_tiles` tile textures stay allocated. Others are filled in as they scroll into view. '''
         super().__init__(width=width, height=height, size_hint=[None, None], **kwargs)
         self.current_size = (width, height)
 
-        self.uw = width # Texture width and...
-        self.uh = height # ..height
+        self.render_scale = render_scale # requested scale, the upper bound for dynamic_scale
+        self.current_scale = render_scale # scale the view currently has
+        self.uw, self.uh = self._view_size() # Texture (and view) width and height
         self.html = html
         self.fps = fps
+        self.tiled = tiled
         Window.bind(on_key_down=self._on_key_down_global,
                     on_key_up=self._on_key_up_global,
                     # on_scroll=self._on_scroll_global,
@@ -32,76 +570,584 @@ class WebSurface(FloatLayout):
 
         # Track held buttons for mouse-move logic
         self._buttons_held = set()
+        self.current_mods = 0
+        self.visible = True # as last reported to the native side, see update_visibility()
+        self.evicted = False # see evict()
+        self._restoring = False
+        self._url = None # last URL loaded with load_url(), to reload it after an eviction
+        self.load_state = "loading"
+        self._loads_requested = 0 # loads whose LOAD_REQUESTED marker hasn't arrived, events until then are stale
+        self._load_waiters = [] # (future, "dom_ready" or "loaded")
+        self._load_error = None
+        self._js_batch = [] # (script, callback) waiting for flush_js(), with batch_js
+        self._js_data = {} # name -> latest value from send_js()
+        self._js_callbacks = {} # request id -> callback(result, error)
+        self._js_request = 0
+        self._stage_times = stats.RollingWindow()
+        self._upload_times = stats.RollingWindow()
+        self._frame_costs = stats.RollingWindow() # dynamic_scale only
+        self._last_scale_check = perf_counter()
+        self._tiles = None # the tile textures, when tiled
+        self._recorder = None # see start_recording()
+        self._atlas = None # the SurfaceAtlas this surface is drawn through, if it is one of its cards
+
+        # The renderer this surface lives in: the local one, or a worker process (see start_worker_processes)
+        self._backend = worker_pool.assign() if worker_pool is not None else local_backend
+        self._lib, self._binding, self._input = self._backend.lib, self._backend.binding, self._backend.input_queue
+        if hasattr(self._backend, "restart_callbacks"):
+            self._backend.restart_callbacks.append(self._backend_restarted)
 
         self.initWebSurface()
 
     def initWebSurface(self):
-        self.index = lib.initWebSurface(
-            c_int(self.uw), 
-            c_int(self.uh), 
-            c_char_p(bytes(self.html, "utf8"))
-        )
+        self.index = self._lib.initWebSurface(self.uw, self.uh, bytes(self.html, "utf8"))
         print("INdex: ", self.index)
+        if self.current_scale != 1:
+            self._lib.setSurfaceScale(self.index, self.current_scale)
+        if self.view_pool_size and self._backend is local_backend:
+            _start_view_pool_refill(self.view_pool_size, self.uw, self.uh)
 
-        self.texture = Texture.create(size=(self.uw, self.uh), colorfmt='bgra')
-        print(dir(self.texture))
-        self.texture.flip_vertical() 
-        with self.canvas:
-            self.rect = Rectangle(pos=self.pos, size=self.size, texture=self.texture)
+        self._texture_store = None
+        if self.tiled:
+            self._tiles = _Tiles(self)
+            self.texture = None
+            self.rect = Rectangle(pos=self.pos, size=self.size) # kept up to date, but not drawn: the tiles are
+        self._allocate_texture()
+        self._wrap_staging()
+        if not self.tiled:
+            with self.canvas:
+                self.rect = Rectangle(pos=self.pos, size=self.size, texture=self.texture)
     
-        Clock.schedule_interval(self.update, 1/self.fps)
+        self._resize_trigger = Clock.create_trigger(self._apply_resize, self.resize_delay)
+        frame_scheduler.register(self)
+
+    def _allocate_texture(self):
+        ''' Points `self.texture` at a (uw x uh) region of the backing texture, which is only reallocated when it is too small.
+        Uploads go to the backing texture; since the region starts at its origin, positions are the same in both.
+        A card of a SurfaceAtlas gets its slot of the atlas texture instead, while the atlas has room for it.
+        A tiled surface drops its tiles, they are created again at the new size. '''
+        if self._tiles is not None:
+            self._tiles.reset()
+            self._needs_full_upload = True
+            return
+        if self._atlas is not None and self._atlas._place(self):
+            self._needs_full_upload = True
+            return
+        store = self._texture_store
+        if store is None or store.width < self.uw or store.height < self.uh:
+            g = self.texture_granularity
+            size = (-(-self.uw // g) * g, -(-self.uh // g) * g)
+            store = self._texture_store = Texture.create(size=size, colorfmt='bgra')
+        # Flip the region rather than the backing texture, so the region covers the rows we actually upload to
+        self.texture = store.get_region(0, 0, self.uw, self.uh)
+        self.texture.flip_vertical()
+        self._needs_full_upload = True # A fresh texture has no content yet, so the first upload must cover the whole surface
 
     def on_size(self, instance, value):
         if not hasattr(self, "rect"): return
-        self.uw, self.uh = value
-        self.texture = Texture.create(size=(self.uw, self.uh), colorfmt='bgra')
+        # The Rectangle stretches the current texture right away; the view itself is resized once
+        # the size has settled, so dragging a window edge doesn't resize and reallocate on every step
         self.rect.size = value
-        # self.destroy()
-        # self.init_ultralight()
+        if self._tiles is not None:
+            self._tiles.layout()
+        self._resize_trigger.cancel()
+        self._resize_trigger()
+
+    def _view_size(self):
+        ''' Size of the Ultralight view for the current widget size and scale '''
+        return max(1, round(self.width * self.current_scale)), max(1, round(self.height * self.current_scale))
+
+    def _to_view(self, x, y):
+        ''' Window coordinates to view pixels (Y axis inverted), whatever the scale and however the texture is stretched '''
+        return int((x - self.x) * self.uw / self.width), int(self.uh - (y - self.y) * self.uh / self.height)
+
+    def set_render_scale(self, scale):
+        ''' Changes the requested render scale; the view is resized right away '''
+        self.render_scale = scale
+        self._apply_scale(scale)
+
+    def _apply_scale(self, scale):
+        self.current_scale = scale
+        self._lib.setSurfaceScale(self.index, scale)
+        self._frame_costs.clear() # judge the new scale on its own frames
+        self._apply_resize()
+
+    def _adjust_scale(self, now):
+        ''' dynamic_scale: compare recent frame costs against the frame budget and step the scale down or up '''
+        if now - self._last_scale_check < self.scale_check_interval:
+            return
+        self._last_scale_check = now
+        costs = self._frame_costs.percentiles()
+        if costs["count"] < 5:
+            return
+        budget = 1000 / self.fps
+        scale = self.current_scale
+        if costs["p95"] > budget * 0.9 and scale > self.min_render_scale:
+            scale = max(self.min_render_scale, scale - self.scale_step)
+        elif costs["p95"] < budget * 0.5 and scale < self.render_scale:
+            scale = min(self.render_scale, scale + self.scale_step)
+        else:
+            return
+        Logger.debug(f"WebSurface: render scale {self.current_scale:.2f} -> {scale:.2f} (p95 frame cost {costs['p95']:.1f} ms, budget {budget:.1f} ms)")
+        self._apply_scale(scale)
+
+    def _apply_resize(self, *args):
+        if self.width <= 0 or self.height <= 0:
+            return
+        w, h = self._view_size()
+        if (w, h) == (self.uw, self.uh):
+            return
+        self._input.flush() # queued coordinates belong to the old size
+        if not self._lib.resizeSurface(self.index, w, h):
+            return
+        self.uw, self.uh = w, h
+        self._wrap_staging() # the native staging buffers were reallocated
+        self._allocate_texture()
+        self.rect.texture = self.texture
+        frame_scheduler.wake()
 
     def focus(self):
-        lib.focusView(c_int(self.index))
+        self._lib.focusView(self.index)
 
     def is_focused(self):
-        return lib.isFocused(c_int(self.index))
+        return self._binding.is_focused(self.index)
     
     def on_pos(self, instance, value):
         if not hasattr(self, "rect"): return
         self.rect.pos = value
+        if self._tiles is not None:
+            self._tiles.layout()
+            frame_scheduler.wake() # scrolled: tiles coming into view are due
 
     def update(self, dt):
-        if not WebSurface._renderer_is_being_updated:
-            lib.renderWebSurface()
-            # WebSurface._renderer_is_being_updated = True
-
-        width = c_int()
-        height = c_int()
-        stride = c_int()
-        pixels = lib.getSurfacePixels(self.index, byref(width), byref(height), byref(stride))
-        if pixels:
-            self.texture.blit_buffer(string_at(pixels, stride.value * height.value), colorfmt='bgra', bufferfmt='ubyte')
+        ''' Uploads whatever changed on the surface since the last call. The renderer itself is driven by `frame_scheduler`.'''
+        # Only the part of the surface Ultralight actually repainted gets uploaded.
+        # The native side packs it into a staging buffer we wrapped once in _wrap_staging(),
+        # so nothing frame-sized is allocated or copied on the Python side.
+        if self.evicted:
+            return
+        if self._restoring:
+            if self._lib.isLoading(self.index):
+                return # keep showing the snapshot until the page is back
+            self._restoring = False
+        start = perf_counter()
+        slot, x, y, w, h = self._binding.stage_surface_pixels(self.index, self._needs_full_upload)
+        if slot < 0:
+            # Nothing changed since the last tick, but a tiled surface may have scrolled to tiles it hasn't filled
+            if self._tiles is not None and self._front_slot >= 0:
+                self._tiles.update(self._frame_views[self._front_slot])
+            if self._recorder is not None:
+                self._record(False)
+            return
+        staged = perf_counter()
+        self._needs_full_upload = False
+        self._front_slot = slot
+
+        # Rows are uploaded top-first; the texture is flipped vertically, so (x, y) needs no inversion.
+        # A full-surface update comes straight from the slot's frame copy, the patch may only hold the dirty part then.
+        if (w, h) == (self.uw, self.uh):
+            source = self._frame_views[slot]
+        else:
+            source = self._patch_views[slot][:w * h * 4]
+        if self._atlas is not None:
+            self._atlas._stage(self, source, x, y, w, h) # uploaded with the other cards, see SurfaceAtlas.upload()
+        elif self._tiles is not None:
+            self._tiles.invalidate(x, y, w, h)
+            self._tiles.update(self._frame_views[slot])
+        else:
+            self._texture_store.blit_buffer(source, size=(w, h), pos=(x, y), colorfmt='bgra', bufferfmt='ubyte')
             self.rect.texture = self.texture
 
-        lib.releaseSurfacePixels(self.index)
+        end = perf_counter()
+        self._stage_times.add((staged - start) * 1000)
+        self._upload_times.add((end - staged) * 1000)
+        if self.dynamic_scale:
+            update_ms, render_ms, _ = stats.last_frame_times()
+            self._frame_costs.add(update_ms + render_ms + (end - start) * 1000)
+            self._adjust_scale(end)
+        if stats.frame_hooks:
+            stats.emit({"name": "update", "surface": self.index, "start": start, "duration": end - start,
+                        "stage_ms": (staged - start) * 1000, "upload_ms": (end - staged) * 1000, "rect": [x, y, w, h]})
+        if self._recorder is not None:
+            self._record(True)
+
+    def start_recording(self, path, fps=None, format="png", buffer_frames=8):
+        ''' Records what the surface shows at `fps` (default: the surface's own rate, which also bounds it) to `path`:
+        a directory of PNG files for "png", a frame archive for "raw" and "zlib" (see recording.py). Each capture copies
+        the staged frame into a ring buffer of `buffer_frames` frames, a background thread encodes and writes them.
+        Captures without any change since the last one are recorded as repeats, without copying pixels, and captures
+        that find the ring buffer full are dropped (and counted) instead of holding up the frame.
+        Only updates are recorded: nothing is captured while the surface is hidden or evicted. Returns the Recorder. '''
+        self.stop_recording()
+        self._recorder = recording.Recorder(path, format, buffer_frames)
+        self._record_interval = 1 / (fps or self.fps)
+        self._next_record = 0.0
+        self._record_changed = True
+        self._needs_full_upload = True # stage the current frame on the next update, even if nothing changes
+        return self._recorder
+
+    def stop_recording(self):
+        ''' Stops recording, once the frames still in the ring buffer are written. Returns the recorder's counters
+        (captured, dropped, repeated, written, error), or None when the surface wasn't recording. '''
+        recorder, self._recorder = self._recorder, None
+        if recorder is None:
+            return None
+        recorder.close()
+        return recorder.stats()
+
+    def _record(self, changed):
+        self._record_changed = self._record_changed or changed
+        now = perf_counter()
+        if now < self._next_record:
+            return
+        # Keep the cadence, but don't catch up with a burst of captures after a stall
+        self._next_record = max(self._next_record + self._record_interval, now - self._record_interval)
+        if not self._record_changed:
+            self._recorder.repeat(now)
+        elif self._front_slot >= 0 and self._recorder.offer(self._frame_views[self._front_slot], self.uw, self.uh, now):
+            self._record_changed = False # a dropped frame is tried again with the next capture
+
+    def is_visible(self):
+        ''' Whether any part of the widget can be seen: it is attached to the window, no ancestor is fully transparent,
+        and it intersects the window and every clipping (StencilView, e.g. ScrollView) ancestor.
+        Window minimization is tracked separately by `frame_scheduler`. '''
+        return self._visible_rect() is not None
+
+    def _visible_rect(self):
+        ''' The part of the widget that can be seen, as (left, bottom, right, top) in window coordinates, or None '''
+        left, bottom = self.to_window(self.x, self.y)
+        right, top = left + self.width, bottom + self.height
+        widget = self
+        while widget is not Window:
+            if widget is None or widget.opacity == 0:
+                return None # detached (e.g. an inactive Screen), or invisible
+            if widget is not self and isinstance(widget, StencilView):
+                x, y = widget.to_window(widget.x, widget.y)
+                left, bottom = max(left, x), max(bottom, y)
+                right, top = min(right, x + widget.width), min(top, y + widget.height)
+            widget = widget.parent
+        left, bottom, right, top = max(left, 0), max(bottom, 0), min(right, Window.width), min(top, Window.height)
+        return (left, bottom, right, top) if left < right and bottom < top else None
+
+    def update_visibility(self, window_hidden=False):
+        ''' Re-checks visibility and tells the native side about changes, so hidden views aren't painted.
+        Returns True when the surface has just become visible again; the next update() then uploads the whole frame. '''
+        visible = not window_hidden and self.is_visible()
+        if visible == self.visible:
+            return False
+        self.visible = visible
+        if visible and self.evicted:
+            self.restore()
+        elif not self.evicted:
+            self._lib.setSurfaceVisible(self.index, visible)
+        if memory_policy is not None:
+            (memory_policy.surface_shown if visible else memory_policy.surface_hidden)(self)
+        if visible:
+            self._needs_full_upload = True
+        return visible
+
+    def evict(self):
+        ''' Frees the native view and its staging memory. The texture keeps the last frame, so the widget goes on showing
+        that snapshot; restore() (called automatically when the surface becomes visible) recreates the view and
+        reloads its page. Page state such as the scroll position or form contents is lost. '''
+        if self.evicted:
+            return
+        self._input.flush() # nothing queued may reach the slot's next owner
+        self._lib.destroySurface(self.index)
+        self._patch_views = self._frame_views = []
+        self._front_slot = -1
+        self.evicted = True
+        self._drop_js("the view was evicted")
+        memory.counters["evictions"] += 1
+
+    def restore(self):
+        ''' Recreates an evicted view at the current size and scale, reloading its HTML or last URL.
+        The snapshot stays up until the page has loaded again. '''
+        if not self.evicted:
+            return
+        self.index = self._lib.initWebSurface(self.uw, self.uh, bytes(self.html, "utf8") if self._url is None else b"")
+        if self.current_scale != 1:
+            self._lib.setSurfaceScale(self.index, self.current_scale)
+        self.load_state = "loading"
+        self._loads_requested = 0 # markers of the old view will never arrive
+        if self._url is not None:
+            self._load_url(self._url)
+        self._wrap_staging()
+        self.evicted = False
+        self._apply_resize() # in case the widget was resized while evicted
+        self._restoring = True
+        self._needs_full_upload = True
+        memory.counters["restores"] += 1
+        frame_scheduler.wake()
+
+    def _backend_restarted(self):
+        # The worker process crashed and was started again without any views: the texture keeps the last frame,
+        # as with evict(), and the view is recreated right away if it can be seen
+        self._patch_views = self._frame_views = []
+        self._front_slot = -1
+        self.evicted = True
+        self._drop_js("the renderer process died")
+        if self.visible:
+            self.restore()
+
+    def get_stats(self):
+        ''' Counters of this surface since it was created (frames, bytes and dirty pixels staged, input events dispatched,
+        last native pixel lock + copy time) plus rolling percentiles in milliseconds of the two halves of update():
+        `stage_ms` (the native stage call) and `upload_ms` (blit_buffer into the texture). '''
+        # The native counters only exist for surfaces of this process' renderer
+        result = (stats.surface_counters(self.index) if self._backend is local_backend else None) or {}
+        result["stage_ms"] = self._stage_times.percentiles()
+        result["upload_ms"] = self._upload_times.percentiles()
+        if self._tiles is not None:
+            result["tiles"] = {"resident": len(self._tiles.resident), "uploads": self._tiles.uploads}
+        return result
  
+    def _wrap_staging(self):
+        ''' Wraps the native staging memory of this surface (double-buffered, or triple-buffered with the render thread).
+        Must be redone whenever the native side reallocates it.'''
+        slots = range(self._lib.getStagingSlotCount(self.index))
+        self._patch_views = [self._backend.wrap_staging_buffer(self.index, slot) for slot in slots]
+        self._frame_views = [self._backend.wrap_staging_buffer(self.index, slot, frame=True) for slot in slots]
+        self._front_slot = -1
+
+    def frame_array(self):
+        ''' Returns the last uploaded frame as a NumPy array of shape (height, width, 4) in BGRA order, or None before the first frame.
+        The array is a view over native memory, not a copy: it is only guaranteed to stay intact until the next update, so copy it if you need to keep it.
+        Requires NumPy.'''
+        import numpy
+        if self._front_slot < 0:
+            return None
+        return numpy.frombuffer(self._frame_views[self._front_slot], dtype=numpy.uint8).reshape(self.uh, self.uw, 4)
+
     def load_url(self, url):
         ''' Loads the given URL in the web surface. This url could be a file:// scheme or an http:// or https:// scheme '''
-        return lib.loadURL(self.index, c_char_p(bytes(url, "utf8")))
-    
+        frame_scheduler.wake()
+        self._url = url
+        if self.evicted:
+            self.load_state = "loading"
+            return True # loaded when the view is restored
+        return self._load_url(url)
+
+    def _load_url(self, url):
+        self.load_state = "loading"
+        self._loads_requested += 1
+        return self._lib.loadURL(self.index, bytes(url, "utf8"))
+
+    async def load_url_async(self, url):
+        ''' load_url(), then waits until the page has finished loading. Raises LoadError if it fails.
+        Wrap it in asyncio.wait_for() for a timeout. An evicted surface only loads once it is visible again. '''
+        self.load_url(url)
+        await self.wait_loaded()
+
+    async def wait_dom_ready(self):
+        ''' Waits until the DOM of the current page is ready (scripts may still be running and images loading),
+        returns right away if it already is. Raises LoadError if the page fails to load. '''
+        await self._wait("dom_ready")
+
+    async def wait_loaded(self):
+        ''' Waits until the current page has finished loading, returns right away if it already has.
+        Raises LoadError if the page fails to load. '''
+        await self._wait("loaded")
+
+    def _wait(self, state):
+        future = asyncio.get_running_loop().create_future()
+        if self._loads_requested == 0 and self.load_state in (state, "loaded"):
+            future.set_result(None)
+        elif self._loads_requested == 0 and self.load_state == "failed":
+            future.set_exception(self._load_error)
+        else:
+            self._load_waiters.append((future, state))
+            frame_scheduler.wake()
+        return future
+
+    def _resolve_waiters(self, state, error=None):
+        ''' Completes the waiters that `state` satisfies; "loaded" and errors complete all of them '''
+        pending = []
+        for future, waits_for in self._load_waiters:
+            if error is None and state != "loaded" and waits_for != state:
+                pending.append((future, waits_for))
+            else:
+                # The awaiting loop may run on another thread than the Kivy clock
+                future.get_loop().call_soon_threadsafe(_complete, future, error)
+        self._load_waiters = pending
+
+    def _load_event(self, type, url, error_code, description):
+        ''' Called by frame_scheduler with this surface's load events, oldest first '''
+        if type == LOAD_REQUESTED:
+            self._loads_requested = max(0, self._loads_requested - 1)
+            return
+        current = self._loads_requested == 0 # otherwise the event is left over from a load that has been replaced
+        if type == LOAD_BEGIN:
+            self.dispatch("on_load_begin", url)
+        elif type == LOAD_DOM_READY:
+            if current and self.load_state == "loading":
+                self.load_state = "dom_ready"
+                self._resolve_waiters("dom_ready")
+            self.dispatch("on_dom_ready", url)
+        elif type == LOAD_FINISH:
+            if current and self.load_state != "failed":
+                self.load_state = "loaded"
+                self._resolve_waiters("loaded")
+            self.dispatch("on_load_finish", url)
+        elif type == LOAD_FAIL:
+            if current:
+                self.load_state = "failed"
+                self._load_error = LoadError(url or self._url, error_code, description)
+                self._resolve_waiters("failed", self._load_error)
+            self.dispatch("on_load_fail", url, error_code, description)
+
+    def prerender(self, key, url=None, html=None):
+        ''' Loads `url` (or `html`) into an offscreen view at this widget's current size and render scale, kept in
+        `prerender_pool` under `key` until activate_prerendered(key) shows it. '''
+        return prerender_pool.prerender(key, url, html, self.uw, self.uh, self.current_scale, self._backend)
+
+    def activate_prerendered(self, key):
+        ''' Swaps the view prerendered under `key` into this widget, in place of the current one (which is destroyed),
+        and uploads it in this very frame: it has been laid out and painted already. With the render thread or a worker
+        process it shows up with the next frame instead, the old content stays up until then.
+        Returns False if the pool has no such view (never prerendered, dropped for the pool's limits, or prerendered for
+        another renderer process); load the page normally then. '''
+        entry = prerender_pool.take(key, self._backend)
+        if entry is None:
+            return False
+        focused = not self.evicted and self.is_focused()
+        self._input.flush() # queued events belong to the old view
+        if not self.evicted:
+            self._lib.destroySurface(self.index)
+        self._drop_js("the view was replaced")
+        self.index = entry.handle
+        self.evicted = self._restoring = False
+        self._lib.setSurfaceBackgroundInterval(self.index, 0)
+        if entry.scale != self.current_scale:
+            self._lib.setSurfaceScale(self.index, self.current_scale)
+        if (entry.width, entry.height) != (self.uw, self.uh):
+            self._lib.resizeSurface(self.index, self.uw, self.uh) # the widget changed size since, costs one layout
+        self._lib.setSurfaceVisible(self.index, self.visible)
+        if focused:
+            self._lib.focusView(self.index)
+        self._url = entry.url
+        if entry.html is not None:
+            self.html = entry.html
+        self.load_state, self._loads_requested = entry.load_state, entry.loads_requested
+        self._wrap_staging()
+        self._needs_full_upload = True
+        if self.visible:
+            self.update(0)
+            if self._atlas is not None:
+                self._atlas.upload()
+        frame_scheduler.wake()
+        return True
+
+    ## { JavaScript
+    def eval_js(self, script, callback=None):
+        ''' Evaluates `script` in the page without waiting for it. `callback(result, error)`, if given, is called on a later
+        tick with the script's value converted to a string, or with the exception text as `error`. With `batch_js` on,
+        the script waits for the next tick and runs there together with everything else queued, in a single evaluation. '''
+        if self.batch_js:
+            self._js_batch.append((script, callback))
+            return
+        request_id = self._js_request_id(callback)
+        if self.evicted or not self._lib.evaluateScript(self.index, bytes(script, "utf8"), request_id):
+            self._js_callbacks.pop(request_id, None)
+            if callback is not None:
+                callback(None, "the surface has no view")
+
+    async def eval_js_async(self, script):
+        ''' eval_js() as an awaitable: returns the result string, raises ScriptError if the script throws '''
+        future = asyncio.get_running_loop().create_future()
+        def done(result, error):
+            future.get_loop().call_soon_threadsafe(_complete, future, None if error is None else ScriptError(error), result)
+        self.eval_js(script, done)
+        return await future
+
+    def send_js(self, name, value):
+        ''' Hands `value` (anything json can encode) to the handlers the page registered with websurface.on(name, handler),
+        on the next tick. Only the latest value per name is sent, so this can be called far more often than the frame rate. '''
+        self._js_data[name] = value
+
+    def flush_js(self):
+        ''' Runs the send_js() data and the batched eval_js() scripts queued so far as a single evaluation.
+        frame_scheduler calls this every tick. '''
+        if self.evicted or not (self._js_data or self._js_batch):
+            return # an evicted surface keeps its queue until it is restored
+        parts = [_JS_RECEIVE % json.dumps(self._js_data)] if self._js_data else []
+        parts += ["_run(%s)" % json.dumps(script) for script, _ in self._js_batch]
+        callbacks = [callback for _, callback in self._js_batch]
+        has_data = bool(self._js_data)
+        self._js_data, self._js_batch = {}, []
+        request_id = self._js_request_id(lambda result, error: self._batch_done(callbacks, has_data, result, error))
+        if not self._lib.evaluateScript(self.index, bytes(_JS_BATCH % ",".join(parts), "utf8"), request_id):
+            self._js_callbacks.pop(request_id)(None, "the surface has no view")
+
+    def _js_request_id(self, callback):
+        if callback is None:
+            return 0 # no result wanted, only exceptions are reported
+        self._js_request = self._js_request % 0x7FFFFFFF + 1
+        self._js_callbacks[self._js_request] = callback
+        return self._js_request
+
+    def _batch_done(self, callbacks, has_data, result, error):
+        if error is None:
+            parts = json.loads(result)
+        else:
+            parts = [[1, error]] * (len(callbacks) + has_data)
+        if has_data and parts[0][0]:
+            Logger.warning(f"WebSurface: send_js handler failed: {parts[0][1]}")
+        for callback, (failed, value) in zip(callbacks, parts[has_data:]):
+            if callback is not None:
+                callback(None, value) if failed else callback(value, None)
+
+    def _script_messages(self, messages):
+        ''' Called by frame_scheduler with this surface's script results and page messages of one tick, oldest first '''
+        posted = []
+        for type, request_id, data in messages:
+            if type == SCRIPT_MESSAGE:
+                posted.append(_decode_message(data))
+                continue
+            callback = self._js_callbacks.pop(request_id, None)
+            if callback is not None:
+                callback(data, None) if type == SCRIPT_RESULT else callback(None, data)
+            elif type == SCRIPT_EXCEPTION:
+                Logger.warning(f"WebSurface: uncaught exception in eval_js script: {data}")
+        if posted:
+            self.dispatch("on_js_messages", posted)
+
+    def _drop_js(self, reason):
+        ''' Fails every callback still waiting for a result that will never come '''
+        callbacks, self._js_callbacks = self._js_callbacks, {}
+        for callback in callbacks.values():
+            callback(None, reason)
+
+    def on_js_messages(self, messages):
+        pass
+    ## }
+
+    def on_load_begin(self, url):
+        pass
+
+    def on_dom_ready(self, url):
+        pass
+
+    def on_load_finish(self, url):
+        pass
+
+    def on_load_fail(self, url, error_code, description):
+        pass
+
 
     ## { Event handlers
     def on_touch_down(self, touch):
         super().on_touch_down(touch)
+        frame_scheduler.wake()
         x, y = touch.pos
-        lib.focusView(self.index)
+        self._lib.focusView(self.index)
         if 'multitouch_sim' in touch.profile:
             touch.multitouch_sim = False  # Disable multitouch simulation for this touch
         print(f"Touch at: {x}, {y}")
         # print("Rect pos:", self.rect.pos, "Rect size:", self.rect.size, "Widget size:", self.size, "Widget pos:", self.pos)
         if self.x <= x <= self.x + self.width and self.y <= y <= self.y + self.height:
             # Translate Kivy touch coordinates to Ultralight coordinates
-            ul_x = int(x - self.x)
-            ul_y = int(self.uh - (y - self.y))  # Invert Y axis
+            ul_x, ul_y = self._to_view(x, y) # Y axis inverted, scaled to the view
             print(f"Dispatching to Ultralight at: {ul_x}, {ul_y}")
 
             btn = "left"  # Default to left button
@@ -110,7 +1156,7 @@ class WebSurface(FloatLayout):
                 if btn in button_codes:
                     self._buttons_held.add(btn) 
                     # Dispatch to ultralight         
-                    lib.dispatchMouseEvent(self.index, c_int(ul_x), c_int(ul_y), c_int(button_codes[btn]), create_string_buffer(b"down"))
+                    self._input.mouse(self.index, INPUT_MOUSE_DOWN, ul_x, ul_y, button_codes[btn])
                 
                 
                 elif touch.is_mouse_scrolling:
@@ -124,14 +1170,14 @@ class WebSurface(FloatLayout):
                         dx, dy = self.scroll_delta, 0
                     else:
                         dx, dy = 0, 0
-                    lib.dispatchScrollEvent(self.index, c_int(dx), c_int(dy))
+                    self._input.scroll(self.index, round(dx * self.current_scale), round(dy * self.current_scale))
 
     def on_touch_up(self, touch):
         super().on_touch_up(touch)
+        frame_scheduler.wake()
         x, y = touch.pos
         if self.x <= x <= self.x + self.width and self.y <= y <= self.y + self.height:
-            ul_x = int(x - self.x)
-            ul_y = int(self.uh - (y - self.y))  # Invert Y axis
+            ul_x, ul_y = self._to_view(x, y) # Y axis inverted, scaled to the view
 
             btn = "left"  # Default to left button
             # print(touch.profile)
@@ -142,7 +1188,7 @@ class WebSurface(FloatLayout):
                 if btn in button_codes and btn in self._buttons_held:
                     self._buttons_held.remove(btn)
                     # Dispatch to Ultralight
-                    lib.dispatchMouseEvent(self.index, c_int(ul_x), c_int(ul_y), c_int(button_codes[btn]), create_string_buffer(b"up"))
+                    self._input.mouse(self.index, INPUT_MOUSE_UP, ul_x, ul_y, button_codes[btn])
 
                 # elif touch.is_mouse_scrolling:
                 #     print("Touch up: scroll... what do I do with this?")
@@ -156,20 +1202,19 @@ class WebSurface(FloatLayout):
 
     def on_key_down(self, key, scancode, codepoint, modifiers):
         """Triggered for any key press while focused."""
+        frame_scheduler.wake()
         print(f"Key down: key={key}, code={codepoint}, mods={modifiers}, scancode={scancode}")
         print("Down: ", chr(key))
         # Combines all modifiers and passes it to the Ultralight library
         self.current_mods = make_modmask(modifiers)
         newkey = kivy_to_ultralight_vk(key)
         print("translated key: ", newkey)
-        lib.dispatchKeyEvent(c_int(self.index), create_string_buffer(b"down"), newkey, self.current_mods, create_string_buffer(bytes(chr(key), 'utf8')))
+        self._input.key(self.index, INPUT_KEY_DOWN, newkey, self.current_mods)
         
         if key not in non_printable_keycodes and codepoint is not None and key != 13: # 13 is for the "Enter" key. I have to handle that specially
-            lib.dispatchCharEvent(self.index, codepoint)
-            pass
+            self._input.char(self.index, codepoint)
         if key == 13:
-            print("here")
-            lib.dispatchCharEvent(self.index, b"\r\n")
+            self._input.char(self.index, b"\r\n")
         return True
     
     def _on_key_up_global(self, window, key, scancode):
@@ -180,51 +1225,303 @@ class WebSurface(FloatLayout):
 
     def on_key_up(self, key, scancode, *args):
         """Triggered when key is released while focused."""
+        frame_scheduler.wake()
         print(f"Key up: key={key} scancode={scancode}")
         key = kivy_to_ultralight_vk(key)
-        lib.dispatchKeyEvent(self.index, create_string_buffer(b"up"), key, self.current_mods, create_string_buffer(bytes(chr(key), 'utf8')))
+        self._input.key(self.index, INPUT_KEY_UP, key, self.current_mods)
         self.current_mods = 0
 
     def _on_scroll_global(self, window, scroll_x, scroll_y, pos):
         pass
 
-    def on_mouse_move(self, x, y, btn):
-        # Dispatch mouse event to ultralight with the held buttons
-        ul_x = int(x - self.x)
-        ul_y = int(self.uh - (y - self.y))  # Invert Y axis
-        for b in self._buttons_held:
-            lib.dispatchMouseEvent(self.index, c_int(ul_x), c_int(ul_y), c_int(button_codes), create_string_buffer(b"move"))
+    def on_mouse_move(self, x, y):
+        # Queue a mouse move for Ultralight. Moves are coalesced per frame by the input queue,
+        # so only the latest position of each frame reaches the native side.
+        ul_x, ul_y = self._to_view(x, y)
+        # Ultralight takes a single button per move, report the most significant one that is held
+        button = 0
+        for btn in ('left', 'middle', 'right'):
+            if btn in self._buttons_held:
+                button = button_codes[btn]
+                break
+        self._input.mouse(self.index, INPUT_MOUSE_MOVE, ul_x, ul_y, button)
+        frame_scheduler.wake()
 
     def _on_mouse_over_global(self, window, pos):
-        for btn in self._buttons_held:
-            # Dispatch the mouse over event to Ultralight with the buttons held, if any.
-            # For example, `lib.dispatchMouseEvent(tox, toy, button_codes[btn], b"move")`
-            x, y = pos
-            ul_x = int(x - self.x)
-            ul_y = int(self.uh - (y - self.y))  # Invert Y axis
-            lib.dispatchMouseEvent(self.index, c_int(ul_x), c_int(ul_y), c_int(button_codes[btn]), create_string_buffer(b"move"))
-            
+        x, y = pos
+        # Drags are followed everywhere, plain hovering only while the pointer is over the surface
+        if self._buttons_held or (self.x <= x <= self.x + self.width and self.y <= y <= self.y + self.height):
+            self.on_mouse_move(x, y)
+
 
     ## } End Event handlers
     
     def destroy_self(self):
         ''' Destroys this WebSurface instance'''
         try:
-            Clock.unschedule(self.update)
-            lib.destroySurface(self.index)
-            self.canvas.remove(self.rect)
+            self._input.flush() # don't leave events for a view that is about to go
+            frame_scheduler.unregister(self)
+            # The Window's bindings would otherwise keep this widget (and its textures) alive for good
+            Window.unbind(on_key_down=self._on_key_down_global,
+                          on_key_up=self._on_key_up_global,
+                          mouse_pos=self._on_mouse_over_global)
+            self._resize_trigger.cancel()
+            self._lib.destroySurface(self.index)
+            self.stop_recording()
+            if self._atlas is not None:
+                self._atlas._release(self) # gives up its slot, it has no Rectangle of its own
+            elif self._tiles is not None:
+                self.canvas.remove(self._tiles.group)
+                self._tiles.reset()
+            else:
+                self.canvas.remove(self.rect)
+            # The native staging memory is gone, make sure nothing reads it through these anymore
+            self._patch_views = self._frame_views = []
+            self._front_slot = -1
+            if memory_policy is not None:
+                memory_policy.surface_destroyed(self)
+            if hasattr(self._backend, "restart_callbacks"):
+                self._backend.restart_callbacks.remove(self._backend_restarted)
+            for future, _ in self._load_waiters:
+                future.get_loop().call_soon_threadsafe(future.cancel)
+            self._load_waiters = []
+            self._js_batch, self._js_data = [], {}
+            self._drop_js("the surface was destroyed")
         except Exception as err: print(err)
         # self._destroyed = True
     
+    @staticmethod
+    def prewarm_views(count, width, height):
+        '''Creates `count` blank native views of the given size ahead of time. New WebSurfaces take one of them
+        (resizing it if needed) instead of paying for view creation. With the render thread they are created there, otherwise right away.'''
+        lib.prewarmViews(count, width, height)
+
+    @staticmethod
+    def start_worker_processes(count=None, fps=60):
+        '''Opt-in: render new WebSurfaces in `count` separate processes (one per CPU by default) instead of this one, each
+        with its own Ultralight renderer updated at `fps`. Frames come back through shared memory, a crashed page only
+        restarts its process. Surfaces created before the call stay where they are.'''
+        global worker_pool
+        import remote
+        if worker_pool is None:
+            worker_pool = remote.WorkerPool(count, fps)
+            backends.extend(worker_pool.workers)
+        return worker_pool
+
+    @staticmethod
+    def stop_worker_processes():
+        '''Stops the worker processes. Their surfaces must have been destroyed first.'''
+        global worker_pool
+        if worker_pool is not None:
+            for worker in worker_pool.workers:
+                backends.remove(worker)
+            worker_pool.close()
+            worker_pool = None
+
+    @staticmethod
+    def start_render_thread(fps=60):
+        '''Opt-in: let the native library update and render on its own thread at `fps`, so heavy layouts no longer stall Kivy.
+        `update` then only picks up the latest finished frame and input is queued to that thread without blocking.
+        Must be called before the first WebSurface is created. Returns False if it is too late (or already running).'''
+        return lib.startRenderThread(fps)
+
     @staticmethod
     def destroy_renderer():
         '''Deactivates and removes the renderer.
         WARNING: If this method is called, you'll have to destroy and recreate all other websurfaces afterwards to reinitialize them!
-        Only call this method when you are sure you won't need any other WebSurface instances anymore.'''
-        WebSurface._renderer_is_being_updated = False
+        Only call this method when you are sure you won't need any other WebSurface instances anymore.
+        This also stops the render thread, if it was started.'''
         lib.destroyRenderer()
 
 
+class SurfaceAtlas(FloatLayout):
+    ''' A container for many small WebSurfaces ("cards") that share one texture. Every WebSurface added to it (as a
+    direct child) is drawn from its slot of the atlas texture, and all the cards are drawn together as a single Mesh.
+    That is one texture and one draw call for the whole group, instead of one of each per card. Each tick, the dirty
+    regions of the cards are first copied into a CPU-side mirror of the atlas, then uploaded together by upload().
+
+    The cards stay ordinary widgets: they are positioned like in any FloatLayout, and touches, keys, load events and
+    JavaScript work per card as before. A card's opacity only decides whether it is drawn at all. A card that doesn't
+    fit into the atlas, at first or after growing, leaves it and goes back to its own texture and Rectangle. '''
+    gap = 1 # free pixels around each slot, so filtering never samples a neighbouring card
+    max_overdraw = 2.0 # a merged band is uploaded whole while it is at most this many times the dirty area in it
+
+    def __init__(self, atlas_size=(2048, 2048), **kwargs):
+        super().__init__(**kwargs)
+        self.texture = Texture.create(size=atlas_size, colorfmt='bgra')
+        self._stride = atlas_size[0] * 4
+        self._mirror = memoryview(bytearray(self._stride * atlas_size[1]))
+        self._slots = {} # card -> (x, y, width, height) in the atlas, in drawing order
+        self._shelves = [] # [y, height, next free x]
+        self._free_slots = [] # slots of cards that left, reused as they are
+        self._top = 0 # first row below the last shelf
+        self._dirty = [] # (card, x, y, width, height, source) staged since the last upload()
+        self._upload_times = stats.RollingWindow()
+        self._counters = {"uploads": 0, "rects": 0, "blits": 0, "bytes": 0}
+        with self.canvas.before: # below the cards' own canvases
+            self._mesh = Mesh(mode='triangles', texture=self.texture)
+        self._mesh_trigger = Clock.create_trigger(self._update_mesh, -1)
+
+    def add_widget(self, widget, *args, **kwargs):
+        super().add_widget(widget, *args, **kwargs)
+        if isinstance(widget, WebSurface) and widget._atlas is None and not widget.tiled:
+            self._attach(widget)
+
+    def remove_widget(self, widget, *args, **kwargs):
+        if widget in self._slots:
+            self._detach(widget)
+        super().remove_widget(widget, *args, **kwargs)
+
+    def _attach(self, card):
+        card._atlas = self
+        card.canvas.remove(card.rect)
+        card._texture_store = None # its own texture isn't needed anymore
+        card._allocate_texture()
+        card.rect.texture = card.texture
+        if card._atlas is not self:
+            return # no room, see _place()
+        card.bind(pos=self._mesh_trigger, size=self._mesh_trigger, opacity=self._mesh_trigger)
+        if card.visible and not card.evicted:
+            card.update(0) # the slot is blank, show the current frame right away
+            self.upload()
+
+    def _detach(self, card):
+        ''' Takes the card out of the atlas: it draws its own texture again '''
+        self._release(card)
+        card._allocate_texture()
+        card.rect.texture = card.texture
+        card.canvas.add(card.rect)
+
+    def _release(self, card):
+        self._free_slots.append(self._slots.pop(card))
+        self._dirty = [rect for rect in self._dirty if rect[0] is not card]
+        card.unbind(pos=self._mesh_trigger, size=self._mesh_trigger, opacity=self._mesh_trigger)
+        card._atlas = None
+        self._mesh_trigger()
+
+    def _place(self, card):
+        ''' Gives the card a slot for its current view size, keeping the slot it has if that is big enough.
+        Returns False, and takes the card out of the atlas, if there is no room left. Rectangles the card staged but
+        hasn't uploaded yet are dropped: they point into staging memory the resize reallocated, and the card stages a
+        full frame into the new slot on its next update anyway. '''
+        self._dirty = [rect for rect in self._dirty if rect[0] is not card]
+        w, h = card.uw, card.uh
+        slot = self._slots.get(card)
+        if slot is None or slot[2] < w or slot[3] < h:
+            new = self._allocate(w, h)
+            if new is None:
+                Logger.warning(f"SurfaceAtlas: no room for a {w}x{h} card, it gets its own texture")
+                if slot is not None:
+                    self._release(card)
+                card._atlas = None
+                card.canvas.add(card.rect)
+                return False
+            if slot is not None:
+                self._free_slots.append(slot)
+            slot = self._slots[card] = new
+        card._texture_store = None
+        card.texture = self.texture.get_region(slot[0], slot[1], w, h)
+        card.texture.flip_vertical() # rows are uploaded top-first, like a surface's own texture
+        self._mesh_trigger()
+        return True
+
+    def _allocate(self, w, h):
+        ''' Shelf packing: the smallest free slot that fits, else the lowest shelf with room, else a new shelf '''
+        fitting = [slot for slot in self._free_slots if slot[2] >= w and slot[3] >= h]
+        if fitting:
+            slot = min(fitting, key=lambda slot: slot[2] * slot[3])
+            self._free_slots.remove(slot)
+            return slot
+        width, height = self.texture.size
+        shelf = None
+        for candidate in self._shelves:
+            if candidate[1] >= h and candidate[2] + w <= width and (shelf is None or candidate[1] < shelf[1]):
+                shelf = candidate
+        if shelf is None:
+            if w > width or self._top + h > height:
+                return None
+            shelf = [self._top, h, 0]
+            self._shelves.append(shelf)
+            self._top += h + self.gap
+        slot = (shelf[2], shelf[0], w, shelf[1])
+        shelf[2] += w + self.gap
+        return slot
+
+    def _stage(self, card, source, x, y, w, h):
+        ''' Copies a card's freshly staged (w x h) patch at (x, y) of its view into the mirror '''
+        left, top = self._slots[card][:2]
+        x, y = left + x, top + y
+        row, stride, mirror = w * 4, self._stride, self._mirror
+        at = y * stride + x * 4
+        for offset in range(0, row * h, row):
+            mirror[at:at + row] = source[offset:offset + row]
+            at += stride
+        self._dirty.append((card, x, y, w, h, source))
+
+    def upload(self):
+        ''' Uploads what the cards staged since the last call. Rectangles whose rows overlap are merged into a band of
+        full atlas rows, which is contiguous in the mirror and goes up in a single blit, unless that would upload more
+        than `max_overdraw` times the dirty area; then each rectangle goes up on its own from the card's staging memory.
+        Called by frame_scheduler after the cards' updates. '''
+        if not self._dirty:
+            return
+        start = perf_counter()
+        width = self.texture.width
+        bands = [] # [top, bottom, dirty area, rectangles]
+        for rect in sorted(self._dirty, key=lambda rect: rect[2]):
+            _, x, y, w, h, _ = rect
+            if bands and y <= bands[-1][1]:
+                band = bands[-1]
+                band[1] = max(band[1], y + h)
+                band[2] += w * h
+                band[3].append(rect)
+            else:
+                bands.append([y, y + h, w * h, [rect]])
+        blits = uploaded = 0
+        for top, bottom, area, rects in bands:
+            if len(rects) > 1 and (bottom - top) * width <= area * self.max_overdraw:
+                self.texture.blit_buffer(self._mirror[top * self._stride:bottom * self._stride], size=(width, bottom - top),
+                                         pos=(0, top), colorfmt='bgra', bufferfmt='ubyte')
+                blits += 1
+                uploaded += (bottom - top) * self._stride
+            else:
+                for _, x, y, w, h, source in rects:
+                    self.texture.blit_buffer(source[:w * h * 4], size=(w, h), pos=(x, y), colorfmt='bgra', bufferfmt='ubyte')
+                    blits += 1
+                    uploaded += w * h * 4
+        rects, self._dirty = len(self._dirty), []
+        end = perf_counter()
+        self._upload_times.add((end - start) * 1000)
+        counters = self._counters
+        counters["uploads"] += 1
+        counters["rects"] += rects
+        counters["blits"] += blits
+        counters["bytes"] += uploaded
+        if stats.frame_hooks:
+            stats.emit({"name": "atlas", "surface": None, "start": start, "duration": end - start,
+                        "rects": rects, "blits": blits, "bytes": uploaded})
+
+    def _update_mesh(self, *args):
+        # Four vertices per card, with the texture coordinates of its slot region (flipped like a surface's own Rectangle)
+        vertices, indices = [], []
+        for card in self._slots:
+            if card.opacity == 0:
+                continue
+            (x, y), (w, h), t = card.pos, card.size, card.texture.tex_coords
+            first = len(vertices) // 4
+            vertices += (x, y, t[0], t[1], x + w, y, t[2], t[3], x + w, y + h, t[4], t[5], x, y + h, t[6], t[7])
+            indices += (first, first + 1, first + 2, first + 2, first + 3, first)
+        self._mesh.vertices = vertices
+        self._mesh.indices = indices
+
+    def get_stats(self):
+        ''' Cards, atlas rows in use, totals of uploads, staged rectangles, blits and bytes uploaded, and rolling
+        percentiles of upload() in milliseconds '''
+        result = dict(self._counters, cards=len(self._slots), rows_used=self._top)
+        result["upload_ms"] = self._upload_times.percentiles()
+        return result
+
+
 # Minimal app for testing
 if __name__ == "__main__":
     from kivy.app import App